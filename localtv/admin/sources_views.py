@@ -12,6 +12,7 @@ from django.views.decorators.csrf import csrf_protect
 from django.views.generic import UpdateView, DeleteView
 
 from localtv.decorators import require_site_admin
+from localtv.tasks import delete_source
 from localtv.models import SiteSettings, Feed, SavedSearch, Category, VIDEO_SERVICE_REGEXES
 from localtv.utils import SortHeaders, MockQueryset
 from localtv.admin import forms
@@ -26,6 +27,18 @@ VIDEO_SERVICE_TITLES = (
 ## Source administration
 ## -------------------
 
+def _delete_source(source):
+    """
+    Deletes ``source`` in the background, so that removing a large source
+    doesn't hold the request (and the tables) hostage.
+
+    """
+    opts = source._meta
+    delete_source.delay(source_app_label=opts.app_label,
+                        source_model=opts.module_name,
+                        source_pk=source.pk)
+
+
 @require_site_admin
 @csrf_protect
 def manage_sources(request):
@@ -120,13 +133,13 @@ def manage_sources(request):
                     if request.POST.get('keep'):
                         form.instance.video_set.all().update(
                             search=None, feed=None)
-                    form.instance.delete()
+                    _delete_source(form.instance)
 
             for form in formset.deleted_forms:
                 if request.POST.get('keep'):
                     form.instance.video_set.all().update(search=None,
                                                          feed=None)
-                form.instance.delete()
+                _delete_source(form.instance)
 
             path = request.get_full_path()
             if '?' in path:
@@ -1,7 +1,7 @@
 from hashlib import sha1
 
 from daguerre.adjustments import Fill
-from daguerre.helpers import AdjustmentHelper
+from daguerre.helpers import AdjustmentHelper, AdjustmentInfoDict
 from django.contrib.sites.models import Site
 from django.contrib.syndication.views import Feed as FeedView, add_domain
 from django.core.cache import cache
@@ -173,14 +173,25 @@ class BaseVideosFeed(FeedView, SortFilterMixin):
             sizes = THUMBNAIL_SIZES
         else:
             sizes = THUMBNAIL_SIZES[:2]
+        for item in items:
+            # Set a private attribute so we can retrieve this later.
+            item._adjusted = {}
         for size in sizes:
-            helper = AdjustmentHelper(items,
+            # Use the adjustments recorded when the thumbnails were saved,
+            # and only ask daguerre about the rest.
+            missing = []
+            for item in items:
+                info_dict = item.get_thumbnail_adjustment(*size)
+                if info_dict is None:
+                    missing.append(item)
+                else:
+                    item._adjusted[size] = AdjustmentInfoDict(info_dict)
+            if not missing:
+                continue
+            helper = AdjustmentHelper(missing,
                                       [Fill(width=size[0], height=size[1])],
                                       "thumbnail")
             for item, info_dict in helper.info_dicts():
-                # Set a private attribute so we can retrieve this later.
-                if not hasattr(item, '_adjusted'):
-                    item._adjusted = {}
                 item._adjusted[size] = info_dict
         # set the default adjustment as a public attribute so that it
         # can be accessed from the description template.
@@ -0,0 +1,97 @@
+"""
+A small HyperLogLog implementation used to estimate the number of unique
+viewers of a video without storing every viewer.
+
+Sketches have a fixed size (``2 ** precision`` one-byte registers), can be
+merged with each other, and serialize to a short string suitable for a
+database text field.
+
+"""
+import base64
+import hashlib
+import math
+import struct
+import zlib
+
+
+DEFAULT_PRECISION = 10
+
+
+class HyperLogLog(object):
+    """
+    Approximate distinct counter. With the default precision of 10 (1024
+    registers), the standard error is roughly 3%.
+
+    """
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            registers = bytearray(self.size)
+        elif len(registers) != self.size:
+            raise ValueError("Expected %i registers, got %i." %
+                             (self.size, len(registers)))
+        self.registers = registers
+
+    def add(self, value):
+        """
+        Adds ``value`` to the sketch. Returns ``True`` if the sketch changed.
+
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        x = struct.unpack('>Q', hashlib.sha1(value).digest()[:8])[0]
+        index = x >> (64 - self.precision)
+        remaining = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        """Merges ``other`` into this sketch in place."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision.")
+        registers = self.registers
+        for i, value in enumerate(other.registers):
+            if value > registers[i]:
+                registers[i] = value
+
+    def __len__(self):
+        size = self.size
+        if size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / size)
+        elif size == 64:
+            alpha = 0.709
+        elif size == 32:
+            alpha = 0.697
+        else:
+            alpha = 0.673
+        estimate = alpha * size * size / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * size:
+            # Small range correction: use linear counting.
+            zeros = self.registers.count('\x00')
+            if zeros:
+                estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def serialize(self):
+        """
+        Returns a compact ASCII representation of the sketch. Sparse sketches
+        compress very well.
+
+        """
+        return base64.b64encode(zlib.compress(str(self.registers)))
+
+    @classmethod
+    def deserialize(cls, data, precision=DEFAULT_PRECISION):
+        """
+        Returns a sketch built from the output of :meth:`serialize`. Empty
+        data results in an empty sketch.
+
+        """
+        if not data:
+            return cls(precision)
+        return cls(precision,
+                   bytearray(zlib.decompress(base64.b64decode(data))))
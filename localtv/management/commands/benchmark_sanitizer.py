@@ -0,0 +1,102 @@
+import glob
+import os
+import re
+import time
+from optparse import make_option
+
+from bs4 import BeautifulSoup
+from django.core.management.base import BaseCommand
+import feedparser
+
+import localtv
+from localtv import sanitizer
+from localtv.templatetags.filters import sanitize
+
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize(html, unwrap=False):
+    """
+    Returns ``html`` with whitespace collapsed, for comparing the two
+    sanitizers' output. If ``unwrap`` is ``True``, the paragraph which
+    BeautifulSoup wraps around leading text is removed.
+
+    """
+    html = WHITESPACE_RE.sub(' ', html.replace('<br/>', '<br>')).strip()
+    if unwrap and html.startswith('<p>'):
+        html = WHITESPACE_RE.sub(' ', html[3:].replace('</p>', '', 1)).strip()
+    return html
+
+
+def sanitize_with_soup(description):
+    """The description sanitizing imports did before :mod:`localtv.sanitizer`."""
+    soup = BeautifulSoup(description)
+    for tag in soup.find_all('div', {'class': "miro-community-description"}):
+        description = unicode(tag)
+        break
+    return sanitize(description, extra_filters=['img'])
+
+
+class Command(BaseCommand):
+    args = '[feed file or url ...]'
+    help = ('Compares the output and speed of the import description '
+            'sanitizer with the sanitize filter on the descriptions in the '
+            'given feeds (by default, the feeds in the test data).')
+    option_list = BaseCommand.option_list + (
+        make_option('--show', action='store', dest='show', default=5,
+                    type='int', help='Number of mismatched outputs to show.'),
+        make_option('--repeat', action='store', dest='repeat', default=5,
+                    type='int', help='Number of passes over the descriptions.'),
+    )
+
+    def handle(self, *feeds, **options):
+        if not feeds:
+            feeds = glob.glob(os.path.join(os.path.dirname(localtv.__file__),
+                                           'tests', 'data', 'feeds', '*'))
+        descriptions = []
+        for feed in feeds:
+            parsed = feedparser.parse(feed)
+            descriptions.extend(entry.summary for entry in parsed.entries
+                                if entry.get('summary'))
+        if not descriptions:
+            self.stderr.write('No descriptions found.\n')
+            return
+
+        sanitizer.clear_cache()
+        mismatches = 0
+        for description in descriptions:
+            old = sanitize_with_soup(description)
+            new = sanitizer.sanitize_description(description)
+            if (normalize(old, unwrap=not new.lstrip().startswith('<p>')) !=
+                    normalize(new)):
+                mismatches += 1
+                if mismatches <= options['show']:
+                    self.stdout.write('Mismatch for %r:\n  sanitize: %r\n'
+                                      '  sanitize_description: %r\n' % (
+                                      description, old, new))
+        self.stdout.write('%i of %i descriptions sanitized differently\n' % (
+                              mismatches, len(descriptions)))
+
+        def uncached(description):
+            sanitizer.clear_cache()
+            return sanitizer.sanitize_description(description)
+
+        sanitizer.clear_cache()
+        timings = []
+        for name, function in (('sanitize', sanitize_with_soup),
+                               ('sanitize_description (uncached)', uncached),
+                               ('sanitize_description (cached)',
+                                sanitizer.sanitize_description)):
+            start = time.time()
+            for i in xrange(options['repeat']):
+                for description in descriptions:
+                    function(description)
+            timings.append((name, time.time() - start))
+
+        self.stdout.write('%i descriptions x %i passes\n' % (
+                              len(descriptions), options['repeat']))
+        baseline = timings[0][1]
+        for name, elapsed in timings:
+            self.stdout.write('%-34s %8.3fs %6.1fx\n' % (
+                                  name, elapsed, baseline / elapsed))
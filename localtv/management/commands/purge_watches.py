@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from localtv.management import site_too_old
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', action='store', dest='days', default=None,
+                    type='int', help='Number of days of raw watches to keep. Defaults to LOCALTV_WATCH_RETENTION_DAYS.'),
+        make_option('--history-days', action='store', dest='history_days',
+                    default=None, type='int', help='Number of days of daily watch counts to keep. Defaults to LOCALTV_WATCH_HISTORY_RETENTION_DAYS.'),
+    )
+
+    def handle_noargs(self, **options):
+        if site_too_old():
+            return
+
+        from localtv import settings as lsettings
+        from localtv.tasks import purge_watches
+
+        days = options['days']
+        if days is None:
+            days = lsettings.WATCH_RETENTION_DAYS
+        history_days = options['history_days']
+        if history_days is None:
+            history_days = lsettings.WATCH_HISTORY_RETENTION_DAYS
+
+        stats = purge_watches.apply(kwargs={'retention_days': days,
+                                            'history_days': history_days}
+                                    ).get()
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write('%(watches)i watches and %(days)i daily counts '
+                              'deleted.\n' % stats)
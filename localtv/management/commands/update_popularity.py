@@ -1,26 +1,23 @@
-from datetime import datetime, timedelta
 from optparse import make_option
 
 from django.core.management.base import LabelCommand
 
 from localtv.management import site_too_old
-from localtv.models import Video
 
 
 class Command(LabelCommand):
     option_list = (
         make_option('--since', action='store', dest='since', default=11,
-                    type='int', help='The number of days in the past for which all watched videos should be reindexed.'),
+                    type='int', help='Deprecated. Videos are now reindexed whenever their watch count has changed since it was last indexed.'),
     ) + LabelCommand.option_list
 
     def handle(self, **options):
         if site_too_old():
             return
 
-        since = options['since']
-        from localtv.tasks import haystack_batch_update
+        from localtv.tasks import update_popularity
 
-        haystack_batch_update.delay(Video._meta.app_label,
-                                    Video._meta.module_name,
-                                    start=datetime.now() - timedelta(since),
-                                    date_lookup='watch__timestamp')
+        stats = update_popularity.apply().get()
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write('%(sent)i documents sent, %(skipped)i '
+                              'skipped.\n' % stats)
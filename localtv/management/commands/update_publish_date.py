@@ -1,25 +1,76 @@
-from django.core.management.base import NoArgsCommand
+from optparse import make_option
 
-import vidscraper
+from django.core.management.base import NoArgsCommand
 
 from localtv.management import site_too_old
-from localtv.settings import API_KEYS
 from localtv import models
+from localtv.tasks import haystack_batch_update, scrape_publish_dates
 
-class Command(NoArgsCommand):
 
-    args = ''
+class Command(NoArgsCommand):
+    help = 'Scrapes the publish dates of videos which are missing them.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+                    default=100, type='int',
+                    help='Number of videos scraped at a time.'),
+        make_option('--threads', action='store', dest='threads', default=4,
+                    type='int',
+                    help='Number of groups of videos scraped at the same time.'),
+        make_option('--after', action='store', dest='after', default=None,
+                    type='int',
+                    help='Only scrape videos with a higher id. Defaults to where the last run stopped, if it was interrupted.'),
+    )
 
     def handle_noargs(self, **options):
         if site_too_old():
             return
-        for v in models.Video.objects.filter(when_published__isnull=True):
-            try:
-                video = vidscraper.auto_scrape(v.website_url, fields=[
-                        'publish_datetime'], api_keys=API_KEYS)
-            except:
-                pass
-            else:
-                if video:
-                    v.when_published = video.publish_datetime
-                    v.save()
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+
+        checkpoint = models.CommandCheckpoint.objects.get_or_create(
+                                        command='update_publish_date')[0]
+        stats = {'updated': 0, 'undated': 0, 'unhandled': 0, 'failed': 0}
+        if options['after'] is not None:
+            cursor = options['after']
+        elif checkpoint.cursor is not None:
+            # Pick up the interrupted run, counts and all.
+            cursor = checkpoint.cursor
+            stats.update(checkpoint.get_stats())
+            if verbosity >= 1:
+                self.stdout.write('Resuming after video %i\n' % cursor)
+        else:
+            cursor = 0
+        updated_before = stats['updated']
+
+        videos = models.Video.objects.filter(when_published__isnull=True
+                                    ).order_by('pk')
+        updated = []
+        try:
+            while True:
+                pks = list(videos.filter(pk__gt=cursor).values_list(
+                                        'pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                batch = scrape_publish_dates(pks, threads=options['threads'])
+                updated.extend(batch.pop('updated'))
+                stats['updated'] = updated_before + len(updated)
+                for key, value in batch.iteritems():
+                    stats[key] += value
+                cursor = pks[-1]
+                checkpoint.cursor = cursor
+                checkpoint.set_stats(stats)
+                checkpoint.save()
+                if verbosity >= 1:
+                    self.stdout.write('%(updated)i updated, %(undated)i '
+                                      'undated, %(unhandled)i unhandled, '
+                                      '%(failed)i failed\n' % stats)
+            # The run is finished; the next one starts from the beginning.
+            checkpoint.cursor = None
+            checkpoint.save()
+        finally:
+            # Reindex everything which was updated at once, even if the run
+            # was interrupted.
+            if updated:
+                opts = models.Video._meta
+                haystack_batch_update.delay(opts.app_label, opts.module_name,
+                                            pks=updated)
@@ -1,28 +1,80 @@
-import sys
-import traceback
+from optparse import make_option
 
 from django.core.files.storage import default_storage
 from django.core.management.base import NoArgsCommand
 
 from localtv.management import site_too_old
 from localtv import models
-from localtv.tasks import video_save_thumbnail
+from localtv import settings as lsettings
+from localtv.tasks import THUMBNAIL_DIRECTORY, save_thumbnails
+from localtv.utils import list_storage
 
-class Command(NoArgsCommand):
 
-    args = ''
+class Command(NoArgsCommand):
+    help = ('Refetches the thumbnails of videos whose thumbnail files are '
+            'missing from storage.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+                    default=100, type='int',
+                    help='Number of videos checked and refetched at a time.'),
+        make_option('--threads', action='store', dest='threads',
+                    default=None, type='int',
+                    help='Number of thumbnails downloaded at the same time. Defaults to LOCALTV_THUMBNAIL_DOWNLOAD_THREADS.'),
+        make_option('--after', action='store', dest='after', default=0,
+                    type='int',
+                    help='Only check videos with a higher id, to resume an interrupted run.'),
+    )
 
-    def handle_noargs(self, verbosity=0, **options):
+    def handle_noargs(self, **options):
         if site_too_old():
             return
-        for v in models.Video.objects.exclude(thumbnail_url=''):
-            if (not v.thumbnail or
-                not default_storage.exists(v.thumbnail.name)):
-                if verbosity >= 1:
-                    print >> sys.stderr, 'saving', repr(v), '(%i)' % v.pk
-                try:
-                    # resave the thumbnail
-                    video_save_thumbnail.apply(args=(v.pk,))
-                except Exception:
-                    traceback.print_exc()
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+        threads = options['threads'] or lsettings.THUMBNAIL_DOWNLOAD_THREADS
+
+        stored = list_storage(THUMBNAIL_DIRECTORY)
+        if verbosity >= 2:
+            self.stdout.write('%i thumbnail files in storage.\n' %
+                              len(stored))
+
+        videos = models.Video.objects.exclude(thumbnail_url=''
+                                    ).order_by('pk')
+        cursor = options['after']
+        checked = saved = erased = 0
+        failed = []
+        while True:
+            rows = list(videos.filter(pk__gt=cursor).values_list(
+                                    'pk', 'thumbnail')[:batch_size])
+            if not rows:
+                break
+            missing = [pk for pk, name in rows
+                       if not self.is_stored(name, stored)]
+            if missing:
+                stats = save_thumbnails(missing, threads=threads)
+                saved += stats['saved']
+                erased += stats['erased']
+                failed.extend(stats['failed'])
+            checked += len(rows)
+            cursor = rows[-1][0]
+            if verbosity >= 1:
+                self.stdout.write('%i checked, %i saved, %i erased, %i '
+                                  'failed; resume with --after=%i\n' % (
+                                  checked, saved, erased, len(failed),
+                                  cursor))
+        if failed and verbosity >= 1:
+            self.stdout.write('Failed: %s\n' % ', '.join(str(pk)
+                                                         for pk in failed))
+
+    def is_stored(self, name, stored):
+        """
+        Returns ``True`` if the thumbnail file ``name`` is in storage. Names
+        below :data:`THUMBNAIL_DIRECTORY` are looked up in the listing
+        ``stored``; older thumbnails (e.g. ``localtv/video_thumbs/<pk>/``)
+        live elsewhere and are checked one by one.
 
+        """
+        if not name:
+            return False
+        if name.startswith(THUMBNAIL_DIRECTORY):
+            return name in stored
+        return default_storage.exists(name)
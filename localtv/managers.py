@@ -1,12 +1,20 @@
 import datetime
+import logging
+from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+
+from localtv import settings as lsettings
+from localtv.hyperloglog import HyperLogLog
 
 
 EMPTY = object()
 
+_warned_unshared_buffer = False
+
 
 class SiteRelatedManager(models.Manager):
     """
@@ -65,6 +73,42 @@ class SiteRelatedManager(models.Manager):
             models.signals.post_save.connect(self._post_save, sender=model)
 
 
+def popularity_start(since=EMPTY):
+    """
+    Returns the first day which counts towards popularity. By default, this is
+    the first day of the last :data:`POPULARITY_DAYS` days (including today).
+
+    """
+    if since is EMPTY:
+        return (datetime.date.today() -
+                datetime.timedelta(days=lsettings.POPULARITY_DAYS - 1))
+    if isinstance(since, datetime.datetime):
+        return since.date()
+    return since
+
+
+def popularity_field():
+    """
+    Returns the name of the :class:`.DailyWatchCount` field which popularity
+    is measured by, based on :data:`POPULARITY_METRIC`.
+
+    """
+    if lsettings.POPULARITY_METRIC == 'viewers':
+        return 'viewer_count'
+    return 'count'
+
+
+def viewer_key(user_pk, ip_address):
+    """
+    Returns the value which identifies a unique viewer: the user if there is
+    one, and otherwise the IP address.
+
+    """
+    if user_pk is not None:
+        return 'user:%s' % user_pk
+    return 'ip:%s' % ip_address
+
+
 class VideoQuerySet(models.query.QuerySet):
 
     def with_best_date(self, use_original_date=True):
@@ -76,20 +120,36 @@ class VideoQuerySet(models.query.QuerySet):
 COALESCE(%slocaltv_video.when_approved,
 localtv_video.when_submitted)""" % published})
 
-    def _popular_q(self, since=EMPTY):
-        if since is EMPTY:
-            since = datetime.datetime.now() - datetime.timedelta(days=7)
+    def with_watch_count(self, since=EMPTY):
+        """
+        Annotates each video with a ``watch_count`` from the daily watch
+        rollup, using a correlated subquery so that unwatched videos are kept
+        (with a count of 0) and the result stays a lazy, sliceable
+        :class:`QuerySet`. If popularity is measured by viewers, this is the
+        sum of each day's unique viewers.
 
-        return models.Q(watch__timestamp__gte=since)
+        """
+        return self.extra(select={'watch_count': """
+COALESCE((SELECT SUM(localtv_dailywatchcount.%s)
+FROM localtv_dailywatchcount
+WHERE localtv_dailywatchcount.video_id = localtv_video.id
+AND localtv_dailywatchcount.day >= %%s), 0)""" % popularity_field()},
+                          select_params=(popularity_start(since),))
+
+    def _popular_q(self, since=EMPTY):
+        return models.Q(dailywatchcount__day__gte=popularity_start(since))
 
     def popular(self, since=EMPTY):
         """
         Returns a QuerySet of videos which have been watched since ``since``,
-        sorted by the number of watches since then.
+        sorted by the number of watches since then. Counts are read from the
+        daily watch rollup, so ``since`` is only precise to the day.
 
         """
         return self.filter(self._popular_q(since)
-                  ).distinct().annotate(watch_count=models.Count('watch')
+                  ).distinct().annotate(
+                      watch_count=models.Sum('dailywatchcount__%s' %
+                                             popularity_field())
                   ).order_by('-watch_count')
 
     def not_popular(self, since=EMPTY):
@@ -109,6 +169,9 @@ class VideoManager(models.Manager):
     def with_best_date(self, *args, **kwargs):
         return self.get_query_set().with_best_date(*args, **kwargs)
 
+    def with_watch_count(self, *args, **kwargs):
+        return self.get_query_set().with_watch_count(*args, **kwargs)
+
     def popular_since(self, *args, **kwargs):
         return self.get_query_set().popular_since(*args, **kwargs)
 
@@ -220,3 +283,310 @@ class VideoManager(models.Manager):
         return qs.order_by('-feedimportindex__source_import__start',
                            'feedimportindex__index',
                            '-id')
+
+
+class WatchManager(models.Manager):
+    """
+    Adds support for write-behind recording of watches. Buffered watches are
+    stored in the cache in numbered slots; :meth:`flush_buffer` saves them to
+    the database with one bulk insert per batch.
+
+    """
+    buffer_key = 'localtv_watch_buffer'
+
+    def _buffer_key(self, suffix):
+        return '%s:%s' % (self.buffer_key, suffix)
+
+    def buffer_is_shared(self):
+        """
+        Returns ``False`` if the default cache only lives in this process, or
+        doesn't keep anything; buffered watches would then never reach the
+        worker which flushes them. Logs a warning the first time.
+
+        """
+        global _warned_unshared_buffer
+        backend = cache.__class__.__module__
+        if not backend.endswith(('.locmem', '.dummy')):
+            return True
+        if not _warned_unshared_buffer:
+            logging.warning('LOCALTV_WATCH_BUFFER is enabled, but the %s '
+                            'cache backend is not shared between processes; '
+                            'saving watches directly instead.', backend)
+            _warned_unshared_buffer = True
+        return False
+
+    def buffer(self, video, user=None, ip_address='0.0.0.0', timestamp=None):
+        """
+        Adds a watch to the buffer instead of saving it immediately. If the
+        buffer has grown by :attr:`WATCH_BUFFER_FLUSH_SIZE` watches, a flush
+        is queued.
+
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        video_pk = getattr(video, 'pk', video)
+        user_pk = getattr(user, 'pk', user)
+
+        tail_key = self._buffer_key('tail')
+        cache.add(tail_key, 0, lsettings.WATCH_BUFFER_TIMEOUT)
+        try:
+            slot = cache.incr(tail_key)
+        except ValueError:
+            # The key expired between add() and incr().
+            cache.add(tail_key, 0, lsettings.WATCH_BUFFER_TIMEOUT)
+            slot = cache.incr(tail_key)
+        cache.set(self._buffer_key(slot),
+                  (video_pk, user_pk, ip_address, timestamp),
+                  lsettings.WATCH_BUFFER_TIMEOUT)
+
+        if slot % lsettings.WATCH_BUFFER_FLUSH_SIZE == 0:
+            from localtv.tasks import flush_watch_buffer
+            flush_watch_buffer.delay()
+
+    def flush_buffer(self, batch_size=None):
+        """
+        Saves all buffered watches to the database and returns the number of
+        watches saved. Only one flush can run at a time; if another flush is
+        already running, this returns 0 immediately.
+
+        """
+        if batch_size is None:
+            batch_size = lsettings.WATCH_BUFFER_FLUSH_SIZE
+        lock_key = self._buffer_key('lock')
+        if not cache.add(lock_key, True, lsettings.WATCH_BUFFER_LOCK_TIMEOUT):
+            return 0
+
+        saved = 0
+        try:
+            head_key = self._buffer_key('head')
+            stall_key = self._buffer_key('stall')
+            tail = cache.get(self._buffer_key('tail'), 0)
+            head = cache.get(head_key, 0)
+            if tail < head:
+                # The tail counter was lost from the cache and restarted.
+                head = 0
+
+            while head < tail:
+                end = min(head + batch_size, tail)
+                slots = range(head + 1, end + 1)
+                entries = cache.get_many([self._buffer_key(slot)
+                                          for slot in slots])
+                watches = []
+                for slot in slots:
+                    try:
+                        video_pk, user_pk, ip_address, timestamp = \
+                            entries[self._buffer_key(slot)]
+                    except KeyError:
+                        # A slot can be claimed a moment before its watch is
+                        # written. Give it until the next flush to show up.
+                        if cache.get(stall_key) != slot:
+                            cache.set(stall_key, slot,
+                                      lsettings.WATCH_BUFFER_TIMEOUT)
+                            end = slot - 1
+                            break
+                        continue
+                    watches.append(self.model(video_id=video_pk,
+                                              user_id=user_pk,
+                                              ip_address=ip_address,
+                                              timestamp=timestamp))
+                if watches:
+                    self.bulk_create(watches)
+                    # bulk_create doesn't send post_save, so the rollup has
+                    # to be updated explicitly.
+                    models.get_model('localtv', 'DailyWatchCount'
+                                     ).objects.add_watches(watches)
+                    saved += len(watches)
+                cache.delete_many([self._buffer_key(slot)
+                                   for slot in xrange(head + 1, end + 1)])
+                cache.set(head_key, end, lsettings.WATCH_BUFFER_TIMEOUT)
+                if end < slots[-1]:
+                    break
+                head = end
+        finally:
+            cache.delete(lock_key)
+        return saved
+
+
+class DailyWatchCountManager(models.Manager):
+    """
+    Keeps the per-video, per-day watch rollup up to date.
+
+    """
+    def increment(self, video_pk, day, count=1, viewers=()):
+        """
+        Adds ``count`` watches to the rollup row for ``video_pk`` on ``day``,
+        creating the row if necessary. ``viewers`` is an iterable of
+        :func:`viewer_key` values to add to the row's unique viewer sketch.
+
+        """
+        using = self._db or 'default'
+        qs = self.using(using).filter(video=video_pk, day=day)
+        if not qs.update(count=models.F('count') + count):
+            sid = transaction.savepoint(using=using)
+            try:
+                self.using(using).create(video_id=video_pk, day=day,
+                                         count=count)
+            except IntegrityError:
+                # Someone else created the row first.
+                transaction.savepoint_rollback(sid, using=using)
+                qs.update(count=models.F('count') + count)
+            else:
+                transaction.savepoint_commit(sid, using=using)
+        if viewers:
+            self.add_viewers(video_pk, day, viewers)
+
+    def add_viewers(self, video_pk, day, viewers):
+        """
+        Adds ``viewers`` to the unique viewer sketch for an existing rollup
+        row. The row is only written if the sketch changed. The row is locked
+        until the caller's transaction ends.
+
+        """
+        using = self._db or 'default'
+        row = self.using(using).select_for_update().get(video=video_pk,
+                                                        day=day)
+        sketch = HyperLogLog.deserialize(row.viewers)
+        changed = False
+        for viewer in viewers:
+            changed = sketch.add(viewer) or changed
+        if changed:
+            self.using(using).filter(pk=row.pk).update(
+                viewers=sketch.serialize(),
+                viewer_count=len(sketch))
+
+    def add_watches(self, watches):
+        """
+        Adds the given :class:`.Watch` instances to the rollup with one update
+        per video and day.
+
+        """
+        counts = defaultdict(int)
+        viewers = defaultdict(set)
+        for watch in watches:
+            key = (watch.video_id, watch.timestamp.date())
+            counts[key] += 1
+            viewers[key].add(viewer_key(watch.user_id, watch.ip_address))
+        for (video_pk, day), count in counts.iteritems():
+            self.increment(video_pk, day, count, viewers[(video_pk, day)])
+
+    def get_watch_count(self, video, since=EMPTY):
+        """
+        Returns the number of times ``video`` has been watched since the
+        given day.
+
+        """
+        return self.filter(video=video, day__gte=popularity_start(since)
+                           ).aggregate(total=models.Sum('count'))['total'] or 0
+
+    def get_viewer_count(self, video, since=EMPTY, until=None):
+        """
+        Returns the approximate number of unique viewers of ``video`` between
+        ``since`` and ``until`` (inclusive), by merging the daily sketches.
+
+        """
+        qs = self.filter(video=video, day__gte=popularity_start(since))
+        if until is not None:
+            qs = qs.filter(day__lte=until)
+        sketch = HyperLogLog()
+        for data in qs.values_list('viewers', flat=True).iterator():
+            sketch.merge(HyperLogLog.deserialize(data))
+        return len(sketch)
+
+    def get_popularity_counts(self, since=EMPTY, **filters):
+        """
+        Returns a dictionary mapping video pks to their popularity since
+        ``since``, as measured by :data:`POPULARITY_METRIC`. Like
+        :meth:`.VideoQuerySet.with_watch_count`, this is the sum of the daily
+        counts, so a viewer who comes back on another day is counted again.
+        Additional keyword arguments filter the rollup rows.
+
+        """
+        qs = self.filter(day__gte=popularity_start(since), **filters)
+        return dict(qs.values('video').annotate(
+                        total=models.Sum(popularity_field())
+                    ).values_list('video', 'total'))
+
+    def _count_watches(self, watches):
+        """
+        Returns a (counts, sketches) tuple of dictionaries keyed by (video
+        pk, day) for the given :class:`.Watch` queryset.
+
+        """
+        counts = defaultdict(int)
+        sketches = defaultdict(HyperLogLog)
+        rows = watches.values_list('video', 'timestamp', 'user', 'ip_address')
+        for video_pk, timestamp, user_pk, ip_address in rows.iterator():
+            key = (video_pk, timestamp.date())
+            counts[key] += 1
+            sketches[key].add(viewer_key(user_pk, ip_address))
+        return counts, sketches
+
+    def refresh_viewers(self, since, chunk_size=100):
+        """
+        Recalculates the unique viewer sketches of rollup rows from ``since``
+        (a date) on from the watch table, ``chunk_size`` videos at a time.
+        Watches saved directly only update the rollup's count; this brings
+        their viewers in. Only rows whose sketch changed are written.
+
+        """
+        Watch = models.get_model('localtv', 'Watch')
+        using = self._db or 'default'
+        rollup = self.using(using).filter(day__gte=since)
+        watches = Watch.objects.using(using).filter(
+                timestamp__gte=datetime.datetime.combine(since,
+                                                         datetime.time()))
+        video_pks = sorted(rollup.values_list('video', flat=True).distinct())
+        updated = 0
+        for start in xrange(0, len(video_pks), chunk_size):
+            chunk = video_pks[start:start + chunk_size]
+            counts, sketches = self._count_watches(
+                                        watches.filter(video__in=chunk))
+            rows = rollup.filter(video__in=chunk).values_list(
+                                        'pk', 'video', 'day', 'viewers')
+            for pk, video_pk, day, viewers in rows:
+                sketch = sketches.get((video_pk, day))
+                if sketch is None:
+                    continue
+                data = sketch.serialize()
+                if data != viewers:
+                    self.using(using).filter(pk=pk).update(
+                        viewers=data, viewer_count=len(sketch))
+                    updated += 1
+        return updated
+
+    def rebuild(self, since=None, chunk_size=100, batch_size=1000):
+        """
+        Recalculates the rollup from the watch table. If ``since`` (a date) is
+        given, only days from then on are recalculated. Note that rows for
+        days whose watches have already been purged will be lost.
+
+        Videos are handled ``chunk_size`` at a time, so only one chunk's
+        watches are counted in memory, and each chunk's rows are replaced in
+        a single transaction.
+
+        """
+        Watch = models.get_model('localtv', 'Watch')
+        using = self._db or 'default'
+        rollup = self.using(using).all()
+        watches = Watch.objects.using(using).all()
+        if since is not None:
+            rollup = rollup.filter(day__gte=since)
+            watches = watches.filter(timestamp__gte=datetime.datetime.combine(
+                                                 since, datetime.time()))
+        video_pks = set(watches.values_list('video', flat=True).distinct())
+        video_pks.update(rollup.values_list('video', flat=True).distinct())
+        video_pks = sorted(video_pks)
+
+        for start in xrange(0, len(video_pks), chunk_size):
+            chunk = video_pks[start:start + chunk_size]
+            counts, sketches = self._count_watches(
+                                        watches.filter(video__in=chunk))
+            rows = [self.model(video_id=video_pk, day=day, count=count,
+                               viewers=sketches[(video_pk, day)].serialize(),
+                               viewer_count=len(sketches[(video_pk, day)]))
+                    for (video_pk, day), count in counts.iteritems()]
+            with transaction.commit_on_success(using=using):
+                rollup.filter(video__in=chunk).delete()
+                for row_start in xrange(0, len(rows), batch_size):
+                    self.using(using).bulk_create(
+                                rows[row_start:row_start + batch_size])
@@ -1,29 +1,36 @@
 import datetime
+import hashlib
 import itertools
 import re
-import urllib2
 import mimetypes
+import multiprocessing
 import operator
 import logging
+import random
 import sys
+import time
 import traceback
 import warnings
+from multiprocessing.pool import ThreadPool
 
 import tagging
 import tagging.models
 import vidscraper
-from bs4 import BeautifulSoup
 from django.conf import settings
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD
 from django.contrib.auth.models import User
 from django.contrib.comments.moderation import CommentModerator, moderator
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
 from django.core.signals import request_finished
 from django.core.validators import ipv4_re
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.template import Context, loader
+from django.utils import simplejson
 from django.utils.html import escape as html_escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
@@ -33,9 +40,11 @@ from notification import models as notification
 from slugify import slugify
 
 from localtv import utils, settings as lsettings
-from localtv.managers import SiteRelatedManager, VideoManager
+from localtv.managers import (SiteRelatedManager, VideoManager, WatchManager,
+                              DailyWatchCountManager)
+from localtv.outbound import fetch, host_slot
+from localtv.sanitizer import sanitize_description
 from localtv.signals import post_video_from_vidscraper, submit_finished
-from localtv.templatetags.filters import sanitize
 
 
 VIDEO_SERVICE_REGEXES = (
@@ -273,16 +282,67 @@ class Source(Thumbnailable):
     auto_categories = models.ManyToManyField("Category", blank=True)
     auto_authors = models.ManyToManyField("auth.User", blank=True,
                                           related_name='auto_%(class)s_set')
+    #: When :func:`localtv.tasks.update_sources` should next update this
+    #: source. ``None`` if it hasn't been scheduled yet.
+    next_poll_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    #: The current time, in seconds, between automatic updates.
+    poll_interval = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         abstract = True
 
-    def update(self, video_iter, source_import, clear_rejected=False):
+    def get_poll_interval(self):
+        if self.poll_interval is None:
+            return lsettings.POLL_MIN_INTERVAL
+        return self.poll_interval
+
+    def schedule_poll(self, interval=None):
+        """
+        Sets :attr:`next_poll_at` to ``interval`` seconds from now (by default,
+        the current :attr:`poll_interval`), give or take
+        ``LOCALTV_POLL_JITTER``. Saves only the scheduling fields.
+
+        """
+        if interval is None:
+            interval = self.get_poll_interval()
+        jitter = lsettings.POLL_JITTER
+        delay = interval * random.uniform(1 - jitter, 1 + jitter)
+        self.poll_interval = interval
+        self.next_poll_at = (datetime.datetime.now() +
+                             datetime.timedelta(seconds=delay))
+        self.__class__._default_manager.filter(pk=self.pk).update(
+                                            poll_interval=self.poll_interval,
+                                            next_poll_at=self.next_poll_at)
+
+    def reschedule_poll(self, changed):
+        """
+        Adapts the poll interval to the result of an update: it is halved if
+        the update found new videos (``changed``) and doubled otherwise,
+        within ``LOCALTV_POLL_MIN_INTERVAL`` and ``LOCALTV_POLL_MAX_INTERVAL``.
+
+        """
+        interval = self.get_poll_interval()
+        if changed:
+            interval = max(interval // 2, lsettings.POLL_MIN_INTERVAL)
+        else:
+            interval = min(interval * 2, lsettings.POLL_MAX_INTERVAL)
+        self.schedule_poll(interval)
+
+    def update(self, video_iter, source_import, clear_rejected=False,
+               start=0):
         """
         Imports videos from a feed/search.  `videos` is an iterable which
         returns :class:`vidscraper.videos.Video` objects.  We use
         :method:`.Video.from_vidscraper_video` to map the Vidscraper fields to
-        Video attributes.
+        Video attributes. Videos are imported in batches of
+        ``LOCALTV_IMPORT_BATCH_SIZE``.
+
+        The iterable is consumed as it's queued, so long sources are streamed:
+        queueing pauses while too many videos are outstanding, and the
+        position in the source is saved on the import every
+        ``LOCALTV_IMPORT_CHECKPOINT_SIZE`` videos. ``start`` is the number of
+        videos an interrupted run of the import already queued; ``video_iter``
+        should begin after them.
 
         If ``clear_rejected`` is ``True``, rejected versions of videos that are
         found in the ``video_iter`` will be deleted and re-imported.
@@ -293,30 +353,45 @@ class Source(Thumbnailable):
 
         import_opts = source_import.__class__._meta
 
-        from localtv.tasks import video_from_vidscraper_video, mark_import_pending
+        from localtv.tasks import videos_from_vidscraper_videos
 
-        total_videos = 0
+        total_videos = start
 
-        try:
-            for vidscraper_video in video_iter:
-                total_videos += 1
-                try:
-                    video_from_vidscraper_video.delay(
-                        vidscraper_video.serialize(),
-                        site_pk=self.site_id,
-                        import_app_label=import_opts.app_label,
-                        import_model=import_opts.module_name,
-                        import_pk=source_import.pk,
-                        status=Video.PENDING,
-                        author_pks=author_pks,
-                        category_pks=category_pks,
-                        clear_rejected=clear_rejected)
-                except Exception:
+        def queue_batch(batch):
+            source_import.wait_for_capacity(total_videos - len(batch))
+            try:
+                videos_from_vidscraper_videos.delay(
+                    [vidscraper_video.serialize()
+                     for vidscraper_video in batch],
+                    site_pk=self.site_id,
+                    import_app_label=import_opts.app_label,
+                    import_model=import_opts.module_name,
+                    import_pk=source_import.pk,
+                    status=Video.PENDING,
+                    author_pks=author_pks,
+                    category_pks=category_pks,
+                    clear_rejected=clear_rejected)
+            except Exception:
+                for vidscraper_video in batch:
                     source_import.handle_error(
                         'Import task creation failed for %r' % (
                             vidscraper_video.url,),
                         is_skip=True,
                         with_exception=True)
+
+        try:
+            batch = []
+            for vidscraper_video in video_iter:
+                total_videos += 1
+                batch.append(vidscraper_video)
+                if len(batch) >= lsettings.IMPORT_BATCH_SIZE:
+                    queue_batch(batch)
+                    batch = []
+                    if (total_videos - source_import.cursor >=
+                        lsettings.IMPORT_CHECKPOINT_SIZE):
+                        source_import.checkpoint(total_videos)
+            if batch:
+                queue_batch(batch)
         except Exception:
             source_import.fail(with_exception=True)
             return
@@ -324,11 +399,31 @@ class Source(Thumbnailable):
         source_import.__class__._default_manager.filter(
             pk=source_import.pk
         ).update(
-            total_videos=total_videos
+            total_videos=total_videos,
+            cursor=total_videos
         )
-        mark_import_pending.delay(import_app_label=import_opts.app_label,
-                                  import_model=import_opts.module_name,
-                                  import_pk=source_import.pk)
+        # The import tasks may all have finished already.
+        source_import.mark_pending_if_done()
+
+
+def _feed_not_modified(video_iter):
+    """
+    Returns ``True`` if loading ``video_iter`` got a "304 Not Modified"
+    response. Only feedparser-based feeds send conditional requests.
+
+    """
+    response = getattr(video_iter, '_response', None)
+    return isinstance(response, dict) and response.get('status') == 304
+
+
+def _videos_hash(videos):
+    """
+    Returns a SHA1 hex digest of the data for a list of vidscraper videos.
+
+    """
+    data = [video.serialize() for video in videos]
+    return hashlib.sha1(simplejson.dumps(data, sort_keys=True,
+                                         default=unicode)).hexdigest()
 
 
 class Feed(Source):
@@ -349,6 +444,12 @@ class Feed(Source):
       - status: one of Feed.STATUS_CHOICES
       - etag: used to see whether or not the feed has changed since our last
         update.
+      - last_modified: the modification date the feed reported at our last
+        update; sent back with the etag.
+      - content_hash: a hash of the feed's videos at our last update, for
+        servers which ignore conditional requests.
+      - skipped_updates: how many updates were skipped because the feed
+        hadn't changed.
       - auto_approve: whether or not to set all videos in this feed to approved
         during the import process
       - user: a user that submitted this feed, if any
@@ -372,6 +473,9 @@ class Feed(Source):
     last_updated = models.DateTimeField()
     when_submitted = models.DateTimeField(auto_now_add=True)
     etag = models.CharField(max_length=250, blank=True)
+    last_modified = models.DateTimeField(null=True, blank=True)
+    content_hash = models.CharField(max_length=40, blank=True)
+    skipped_updates = models.PositiveIntegerField(default=0)
     calculated_source_type = models.CharField(max_length=255, blank=True, default='')
     status = models.IntegerField(choices=STATUS_CHOICES, default=INACTIVE)
 
@@ -393,31 +497,69 @@ class Feed(Source):
 
         """
         try:
-            FeedImport.objects.get(source=self,
-                                   status=FeedImport.STARTED)
+            feed_import = FeedImport.objects.get(source=self,
+                                                 status=FeedImport.STARTED)
         except FeedImport.DoesNotExist:
             pass
         else:
-            logging.info('Skipping import of %s: already in progress' % self)
+            if feed_import.claim_for_resume():
+                logging.info('Resuming interrupted import of %s from video '
+                             '%i' % (self, feed_import.cursor))
+                self._resume_import(feed_import, **kwargs)
+            else:
+                logging.info('Skipping import of %s: already in progress' %
+                             self)
             return
 
-        feed_import = FeedImport.objects.create(source=self,
-                                                auto_approve=self.auto_approve)
-
+        # Conditional requests are skipped for the first import and for
+        # re-imports of rejected videos, which need the whole feed.
+        conditional = (self.status == self.ACTIVE and
+                       not kwargs.get('clear_rejected'))
         video_iter = vidscraper.auto_feed(
             self.feed_url,
             max_results=None if self.status == self.INACTIVE else 100,
             api_keys=lsettings.API_KEYS,
+            etag=(self.etag or None) if conditional else None,
+            last_modified=self.last_modified if conditional else None,
         )
 
+        # Full imports are streamed rather than read up front; they're never
+        # conditional, so they don't need the content hash.
+        streamed = self.status == self.INACTIVE
         try:
-            video_iter.load()
+            with host_slot(self.feed_url):
+                video_iter.load()
+                if _feed_not_modified(video_iter):
+                    videos = None
+                elif streamed:
+                    videos = video_iter
+                else:
+                    videos = list(video_iter)
         except Exception:
+            feed_import = FeedImport.objects.create(
+                                                source=self,
+                                                auto_approve=self.auto_approve)
             feed_import.fail("Data loading failed for {source}",
                              with_exception=True)
             return
 
+        content_hash = (None if videos is None or streamed
+                        else _videos_hash(videos))
+        if conditional and (videos is None or
+                            content_hash == self.content_hash):
+            logging.info('Skipping import of %s: feed unchanged' % self)
+            Feed.objects.filter(pk=self.pk).update(
+                last_updated=datetime.datetime.now(),
+                skipped_updates=models.F('skipped_updates') + 1)
+            self.reschedule_poll(changed=False)
+            return
+
+        feed_import = FeedImport.objects.create(source=self,
+                                                auto_approve=self.auto_approve)
+
         self.etag = getattr(video_iter, 'etag', None) or ''
+        self.last_modified = getattr(video_iter, 'last_modified', None)
+        self.content_hash = content_hash or ''
         self.last_updated = datetime.datetime.now()
         if self.status == self.INACTIVE:
             # If these fields have already been changed, don't
@@ -431,9 +573,49 @@ class Feed(Source):
                 self.description = video_iter.description or ''
         self.save()
 
-        super(Feed, self).update(video_iter, source_import=feed_import,
+        super(Feed, self).update(videos, source_import=feed_import,
                                  **kwargs)
 
+    def _resume_import(self, feed_import, **kwargs):
+        """
+        Continues ``feed_import`` from the video after its last checkpoint.
+        Videos queued after the checkpoint by the interrupted run are queued
+        again and skipped as duplicates.
+
+        """
+        if self.status == self.INACTIVE:
+            max_results = None
+        else:
+            max_results = 100 - feed_import.cursor
+        skip = 0
+        if max_results is not None and max_results <= 0:
+            video_iter = []
+        else:
+            video_iter = vidscraper.auto_feed(
+                self.feed_url,
+                max_results=max_results,
+                api_keys=lsettings.API_KEYS,
+                start_index=feed_import.cursor + 1,
+            )
+            if video_iter.per_page is None:
+                # Unpaged feeds (e.g. plain RSS and Atom) can only be read
+                # from the start, so skip the videos which were queued.
+                skip = feed_import.cursor
+                video_iter.start_index = 1
+                if max_results is not None:
+                    video_iter.max_results = max_results + skip
+            try:
+                with host_slot(self.feed_url):
+                    video_iter.load()
+            except Exception:
+                feed_import.fail("Data loading failed for {source}",
+                                 with_exception=True)
+                return
+            if skip:
+                video_iter = itertools.islice(video_iter, skip, None)
+        super(Feed, self).update(video_iter, source_import=feed_import,
+                                 start=feed_import.cursor, **kwargs)
+
     def source_type(self):
         return self.calculated_source_type
 
@@ -444,6 +626,17 @@ class Feed(Source):
         else:
             return u'User: %s' % video_service
 
+    def _calculate_video_source_type(self):
+        """
+        Returns the source type of videos from this feed which didn't also
+        come from a saved search.
+
+        """
+        video_service = self.video_service()
+        if video_service:
+            return u'User: %s: %s' % (video_service, self.name)
+        return u'Feed: %s' % self.name
+
     def video_service(self):
         for service, regexp in VIDEO_SERVICE_REGEXES:
             if re.search(regexp, self.feed_url, re.I):
@@ -453,15 +646,24 @@ class Feed(Source):
 def pre_save_set_calculated_source_type(instance, **kwargs):
     # Always save the calculated_source_type
     instance.calculated_source_type = instance._calculate_source_type()
-    # Plus, if the name changed, we have to recalculate all the Videos that depend on us.
+    # Plus, if the name or service changed, we have to recalculate all the
+    # Videos that depend on us.
     try:
         v = Feed.objects.get(id=instance.id)
     except Feed.DoesNotExist:
         return instance
-    if v.name != instance.name:
-        # recalculate all the sad little videos' calculated_source_type
-        for vid in instance.video_set.all():
-            vid.save()
+    source_type = instance._calculate_video_source_type()
+    if v._calculate_video_source_type() != source_type:
+        videos = Video.objects.filter(feed=instance, search__isnull=True)
+        pks = list(videos.values_list('pk', flat=True))
+        if not pks:
+            return instance
+        videos.update(calculated_source_type=source_type)
+        if lsettings.USE_HAYSTACK:
+            from localtv.tasks import haystack_batch_update
+            opts = Video._meta
+            haystack_batch_update.delay(opts.app_label, opts.module_name,
+                                        pks=pks)
 models.signals.pre_save.connect(pre_save_set_calculated_source_type,
                                 sender=Feed)
 
@@ -601,16 +803,35 @@ class SavedSearch(Source):
             api_keys=lsettings.API_KEYS,
         )
 
+        # Load the backends concurrently, so that the slowest one (up to the
+        # deadline) rather than the sum of all of them sets the start time.
+        searches = list(searches)
+        pool = ThreadPool(max(1, min(len(searches),
+                                     lsettings.SEARCH_LOAD_THREADS)))
+        results = [pool.apply_async(video_iter.load)
+                   for video_iter in searches]
+        pool.close()
+        deadline = time.time() + lsettings.SEARCH_LOAD_DEADLINE
+
         video_iters = []
-        for video_iter in searches:
+        for video_iter, result in zip(searches, results):
             try:
-                video_iter.load()
+                result.get(max(deadline - time.time(), 0))
+            except multiprocessing.TimeoutError:
+                search_import.handle_error(u'Skipping import of search results '
+                               u'from %s: not loaded within %gs' % (
+                                   video_iter.__class__.__name__,
+                                   lsettings.SEARCH_LOAD_DEADLINE))
+                continue
             except Exception:
                 search_import.handle_error(u'Skipping import of search results '
                                u'from %s' % video_iter.__class__.__name__,
                                with_exception=True)
                 continue
             video_iters.append(video_iter)
+        # Backends which missed the deadline are left to finish in the
+        # background; their results are discarded.
+        pool.terminate()
 
         if video_iters:
             super(SavedSearch, self).update(itertools.chain(*video_iters),
@@ -624,6 +845,10 @@ class SavedSearch(Source):
     def source_type(self):
         return u'Search'
 
+    def _calculate_video_source_type(self):
+        """Returns the source type of videos from this search."""
+        return u'Search: %s' % self
+
 
 class SourceImportIndex(models.Model):
     video = models.OneToOneField('Video', unique=True)
@@ -660,6 +885,36 @@ class SearchImportError(SourceImportError):
     source_import = models.ForeignKey('SearchImport', related_name='errors')
 
 
+class SourceImportCounter(models.Model):
+    """
+    One shard of an import's progress counts. Import tasks add to a random
+    shard rather than to the import itself, so that many tasks working on the
+    same import don't queue up for a lock on a single row. The shards are
+    folded into the import once all its videos are handled.
+
+    """
+    shard = models.PositiveSmallIntegerField()
+    videos_imported = models.PositiveIntegerField(default=0)
+    videos_skipped = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class FeedImportCounter(SourceImportCounter):
+    source_import = models.ForeignKey('FeedImport', related_name='counters')
+
+    class Meta:
+        unique_together = ('source_import', 'shard')
+
+
+class SearchImportCounter(SourceImportCounter):
+    source_import = models.ForeignKey('SearchImport', related_name='counters')
+
+    class Meta:
+        unique_together = ('source_import', 'shard')
+
+
 class SourceImport(models.Model):
     STARTED = 'started'
     PENDING = 'pending'
@@ -676,6 +931,8 @@ class SourceImport(models.Model):
     total_videos = models.PositiveIntegerField(blank=True, null=True)
     videos_imported = models.PositiveIntegerField(default=0)
     videos_skipped = models.PositiveIntegerField(default=0)
+    #: The number of videos from the source queued as of the last checkpoint.
+    cursor = models.PositiveIntegerField(default=0)
     #: Caches the auto_approve of the search on the import, so that the imported
     #: videos can be approved en masse at the end of the import based on the
     #: settings at the beginning of the import.
@@ -706,6 +963,58 @@ class SourceImport(models.Model):
     def get_videos(self):
         raise NotImplementedError
 
+    def checkpoint(self, cursor=None):
+        """
+        Records that the import is still alive and, if given, that ``cursor``
+        videos from the source have been queued.
+
+        """
+        self.last_activity = datetime.datetime.now()
+        updates = {'last_activity': self.last_activity}
+        if cursor is not None:
+            self.cursor = updates['cursor'] = cursor
+        self.__class__._default_manager.filter(pk=self.pk).update(**updates)
+
+    def wait_for_capacity(self, queued):
+        """
+        Blocks while more than ``LOCALTV_IMPORT_MAX_OUTSTANDING`` of the
+        ``queued`` videos are still waiting to be handled, for at most
+        ``LOCALTV_IMPORT_BACKPRESSURE_WAIT`` seconds.
+
+        """
+        if queued <= lsettings.IMPORT_MAX_OUTSTANDING:
+            return
+        deadline = time.time() + lsettings.IMPORT_BACKPRESSURE_WAIT
+        while True:
+            progress = self.get_progress()
+            outstanding = queued - progress['imported'] - progress['skipped']
+            if outstanding <= lsettings.IMPORT_MAX_OUTSTANDING:
+                return
+            if time.time() >= deadline:
+                logging.warn('%s still has %i videos outstanding; queueing '
+                             'more anyway.', self, outstanding)
+                return
+            # Keep the import from looking interrupted while it waits.
+            self.checkpoint()
+            time.sleep(1)
+
+    def claim_for_resume(self):
+        """
+        Returns ``True`` if the import was interrupted while queueing videos
+        and this call claimed it for resuming. Only one caller can claim an
+        import.
+
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+                                    seconds=lsettings.IMPORT_RESUME_AFTER)
+        return bool(self.__class__._default_manager.filter(
+            models.Q(last_activity__lt=cutoff) |
+            models.Q(last_activity__isnull=True, start__lt=cutoff),
+            pk=self.pk,
+            status=self.STARTED,
+            total_videos__isnull=True,
+        ).update(last_activity=datetime.datetime.now()))
+
     def handle_error(self, message, is_skip=False, with_exception=False):
         """
         Logs the error with the default logger and to the database.
@@ -731,8 +1040,7 @@ class SourceImport(models.Model):
                            traceback=tb,
                            is_skip=is_skip)
         if is_skip:
-            self.__class__._default_manager.filter(pk=self.pk
-                        ).update(videos_skipped=models.F('videos_skipped') + 1)
+            self.add_progress(skipped=1)
 
     def get_index_creation_kwargs(self, video, vidscraper_video):
         return {
@@ -752,20 +1060,149 @@ class SourceImport(models.Model):
         """
         self.indexes.create(
                     **self.get_index_creation_kwargs(video, vidscraper_video))
-        self.__class__._default_manager.filter(pk=self.pk
-                    ).update(videos_imported=models.F('videos_imported') + 1)
+        self.add_progress(imported=1)
+
+    def handle_videos(self, videos):
+        """
+        Batch version of :meth:`handle_video`, which creates all the index
+        instances in a single query.
+
+        :param videos: A list of (video, vidscraper_video) tuples.
+
+        """
+        if not videos:
+            return
+        index_class = self.indexes.model
+        index_class._default_manager.bulk_create([
+            index_class(**self.get_index_creation_kwargs(video,
+                                                         vidscraper_video))
+            for video, vidscraper_video in videos])
+        self.add_progress(imported=len(videos))
+
+    def add_progress(self, imported=0, skipped=0):
+        """
+        Adds to the import's progress counts, through one of
+        ``LOCALTV_IMPORT_COUNTER_SHARDS`` counter rows picked at random.
+
+        """
+        shard = random.randrange(lsettings.IMPORT_COUNTER_SHARDS)
+        counters = self.counters.filter(shard=shard)
+        increments = {
+            'videos_imported': models.F('videos_imported') + imported,
+            'videos_skipped': models.F('videos_skipped') + skipped,
+        }
+        if counters.update(**increments):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.counters.create(shard=shard, videos_imported=imported,
+                                 videos_skipped=skipped)
+        except IntegrityError:
+            # Someone else created the shard first.
+            transaction.savepoint_rollback(sid)
+            counters.update(**increments)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def _get_counter_totals(self):
+        totals = self.counters.aggregate(
+                                   imported=models.Sum('videos_imported'),
+                                   skipped=models.Sum('videos_skipped'))
+        return totals['imported'] or 0, totals['skipped'] or 0
+
+    def _read_counters(self):
+        """
+        Returns a list of (pk, imported, skipped) tuples for the import's
+        counter rows, and the imported and skipped totals.
+
+        """
+        rows = list(self.counters.values_list('pk', 'videos_imported',
+                                              'videos_skipped'))
+        return (rows, sum(row[1] for row in rows),
+                sum(row[2] for row in rows))
+
+    def _drain_counters(self, rows):
+        """
+        Takes the amounts in ``rows`` (as returned by :meth:`_read_counters`)
+        back out of the counter rows once they've been folded into the
+        import. Increments which landed after the rows were read stay in the
+        counters; emptied rows are deleted.
+
+        """
+        for pk, imported, skipped in rows:
+            if imported or skipped:
+                self.counters.filter(pk=pk).update(
+                    videos_imported=models.F('videos_imported') - imported,
+                    videos_skipped=models.F('videos_skipped') - skipped)
+        self.counters.filter(videos_imported=0, videos_skipped=0).delete()
+
+    def get_progress(self):
+        """
+        Returns a dictionary with the numbers of videos ``imported`` and
+        ``skipped`` so far, including those which haven't been folded into
+        the import yet.
+
+        """
+        imported, skipped = self._get_counter_totals()
+        return {'imported': self.videos_imported + imported,
+                'skipped': self.videos_skipped + skipped}
+
+    def mark_pending_if_done(self):
+        """
+        Moves the import on to its second stage if each of its videos has
+        been imported or skipped. The status change is a single conditional
+        update, so when several import tasks finish at once only one of them
+        starts the second stage. Returns ``True`` if this call started it.
+
+        """
+        rows, imported, skipped = self._read_counters()
+        updated = self.__class__._default_manager.filter(
+            pk=self.pk,
+            status=self.STARTED,
+            total_videos__isnull=False,
+            total_videos__lte=(models.F('videos_imported') +
+                               models.F('videos_skipped') +
+                               imported + skipped)
+        ).update(status=self.PENDING,
+                 last_activity=datetime.datetime.now(),
+                 videos_imported=models.F('videos_imported') + imported,
+                 videos_skipped=models.F('videos_skipped') + skipped)
+        if not updated:
+            return False
+        # The counts read now live on the import itself.
+        self._drain_counters(rows)
+
+        from localtv.tasks import mark_import_pending
+
+        self.status = self.PENDING
+        opts = self._meta
+        mark_import_pending.delay(import_app_label=opts.app_label,
+                                  import_model=opts.module_name,
+                                  import_pk=self.pk)
+        return True
 
     def fail(self, message="Import failed for {source}", with_exception=False):
         """
         Mark an import as failed, along with some post-fail cleanup.
 
         """
+        rows, imported, skipped = self._read_counters()
         self.status = self.FAILED
         self.last_activity = datetime.datetime.now()
-        self.save()
+        self.__class__._default_manager.filter(pk=self.pk).update(
+                status=self.status,
+                last_activity=self.last_activity,
+                videos_imported=models.F('videos_imported') + imported,
+                videos_skipped=models.F('videos_skipped') + skipped)
+        self._drain_counters(rows)
         self.handle_error(message.format(source=self.source),
                           with_exception=with_exception)
-        self.get_videos().delete()
+        from localtv.tasks import delete_import_videos
+        opts = self._meta
+        delete_import_videos.delay(import_app_label=opts.app_label,
+                                   import_model=opts.module_name,
+                                   import_pk=self.pk)
+        self.source.reschedule_poll(changed=False)
 
 
 class FeedImport(SourceImport):
@@ -788,6 +1225,152 @@ class SearchImport(SourceImport):
         return Video.objects.filter(searchimportindex__source_import=self)
 
 
+#: The most users kept in the :func:`_get_vidscraper_authors` cache before
+#: it's emptied.
+AUTHOR_CACHE_SIZE = 10000
+
+_author_cache = {}
+#: Maps the pks of cached users to the usernames they're cached under.
+_author_usernames = {}
+
+
+def clear_author_cache():
+    """Empties the cache of users used for imported videos."""
+    _author_cache.clear()
+    _author_usernames.clear()
+
+
+def _split_name(name):
+    if ' ' in name:
+        first, last = name.split(' ', 1)
+    else:
+        first, last = name, ''
+    return first[:30], last[:30]
+
+
+def _get_vidscraper_authors(videos):
+    """
+    Returns a dictionary mapping the usernames of the users who own
+    ``videos`` on their video services (truncated to fit
+    :attr:`User.username`) to :class:`User` instances. Users who don't exist
+    yet are created in bulk, along with their profiles.
+
+    Existing users are cached for the life of the process; users created here
+    aren't cached until they're seen again, in case the surrounding
+    transaction is rolled back.
+
+    """
+    authors = {}
+    users = {}
+    for video in videos:
+        if not video.user:
+            continue
+        username = video.user[:30]
+        if username in _author_cache:
+            authors[username] = _author_cache[username]
+        else:
+            users.setdefault(username, (video.user, video.user_url))
+    if not users:
+        return authors
+
+    found = dict((author.username, author)
+                 for author in User.objects.filter(username__in=users))
+    if len(_author_cache) + len(found) > AUTHOR_CACHE_SIZE:
+        clear_author_cache()
+    _author_cache.update(found)
+    for username, author in found.iteritems():
+        _author_usernames.setdefault(author.pk, set()).add(username)
+    authors.update(found)
+
+    missing = [username for username in users if username not in found]
+    if not missing:
+        return authors
+    new_users = []
+    for username in missing:
+        first, last = _split_name(users[username][0])
+        new_users.append(User(username=username, first_name=first,
+                              last_name=last, password=UNUSABLE_PASSWORD))
+    sid = transaction.savepoint()
+    try:
+        User.objects.bulk_create(new_users)
+    except IntegrityError:
+        # Someone else created some of the users first.
+        transaction.savepoint_rollback(sid)
+        for username in missing:
+            first, last = _split_name(users[username][0])
+            author, created = User.objects.get_or_create(
+                username=username,
+                defaults={'first_name': first,
+                          'last_name': last,
+                          'password': UNUSABLE_PASSWORD})
+            if created:
+                utils.get_profile_model()._default_manager.create(
+                    user=author, website=users[username][1] or '')
+            authors[username] = author
+        return authors
+    transaction.savepoint_commit(sid)
+
+    # bulk_create doesn't set primary keys, so fetch the new users.
+    created = User.objects.filter(username__in=missing)
+    Profile = utils.get_profile_model()
+    Profile._default_manager.bulk_create([
+        Profile(user=author, website=users[author.username][1] or '')
+        for author in created])
+    authors.update((author.username, author) for author in created)
+    return authors
+
+
+def _get_vidscraper_tag_names(video):
+    """
+    Returns the set of cleaned-up tag names for a vidscraper ``video``.
+
+    """
+    if not video.tags:
+        return set()
+    return set(utils.normalize_tag_name(tag) for tag in video.tags
+               if tag.strip())
+
+
+def _source_type_cache_key(model, pk):
+    opts = model._meta
+    return 'localtv_source_type-%s.%s-%s' % (opts.app_label,
+                                             opts.module_name, pk)
+
+
+def _get_video_source_type(model, pk):
+    """
+    Returns the source type of videos from the :class:`Feed` or
+    :class:`SavedSearch` with the given ``pk``, or an empty string if it
+    doesn't exist. Results are kept in the shared cache for
+    ``LOCALTV_SOURCE_TYPE_CACHE_TIMEOUT`` seconds.
+
+    """
+    key = _source_type_cache_key(model, pk)
+    source_type = cache.get(key)
+    if source_type is not None:
+        return source_type
+    try:
+        source = model._default_manager.get(pk=pk)
+    except model.DoesNotExist:
+        source_type = u''
+    else:
+        source_type = source._calculate_video_source_type()
+    cache.set(key, source_type, lsettings.SOURCE_TYPE_CACHE_TIMEOUT)
+    return source_type
+
+
+def source_changed_forget_source_type(sender, instance, **kwargs):
+    cache.delete(_source_type_cache_key(sender, instance.pk))
+models.signals.post_save.connect(source_changed_forget_source_type,
+                                 sender=Feed)
+models.signals.post_delete.connect(source_changed_forget_source_type,
+                                   sender=Feed)
+models.signals.post_save.connect(source_changed_forget_source_type,
+                                 sender=SavedSearch)
+models.signals.post_delete.connect(source_changed_forget_source_type,
+                                   sender=SavedSearch)
+
+
 class Video(Thumbnailable):
     """
     Fields:
@@ -881,6 +1464,10 @@ class Video(Thumbnailable):
                                blank=True)
     notes = models.TextField(verbose_name='Notes (optional)', blank=True)
     calculated_source_type = models.CharField(max_length=255, blank=True, default='')
+    #: JSON record of the adjusted versions of the thumbnail made by
+    #: :func:`localtv.tasks.videos_adjust_thumbnails`.
+    thumbnail_adjustments = models.TextField(blank=True, default='',
+                                             editable=False)
 
     objects = VideoManager()
 
@@ -902,30 +1489,70 @@ class Video(Thumbnailable):
         # videos are not excluded.
         self._check_for_duplicates(exclude_rejected=True)
 
-    def _check_for_duplicates(self, exclude_rejected=True):
-        if not self.embed_code and not self.file_url:
-            raise ValidationError("Video has no embed code or file url.")
-
-        qs = Video.objects.filter(site=self.site_id)
-
-        if exclude_rejected:
-            qs = qs.exclude(status=Video.REJECTED)
+    def get_identifiers(self):
+        """
+        Returns a list of (kind, hash) tuples for the :class:`VideoIdentifier`
+        instances which should exist for this video.
 
-        if self.pk is not None:
-            qs = qs.exclude(pk=self.pk)
+        """
+        identifiers = []
+        for kind, _verbose in VideoIdentifier.KIND_CHOICES:
+            value = getattr(self, kind)
+            if value:
+                identifiers.append((kind, utils.identifier_hash(
+                          value, is_url=kind in VideoIdentifier.URL_KINDS)))
+        return identifiers
 
-        if self.guid and qs.filter(guid=self.guid).exists():
-            raise ValidationError("Another video with the same guid "
-                                  "already exists.")
+    def _check_for_duplicates(self, exclude_rejected=True):
+        error = Video._find_duplicates([self],
+                                       exclude_rejected=exclude_rejected)[0]
+        if error is not None:
+            raise error
 
-        if (self.website_url and
-            qs.filter(website_url=self.website_url).exists()):
-            raise ValidationError("Another video with the same website url "
-                                  "already exists.")
+    @classmethod
+    def _find_duplicates(cls, videos, exclude_rejected=True):
+        """
+        Batch version of :meth:`_check_for_duplicates`. Returns a list with a
+        :exc:`ValidationError` for each of the ``videos`` which duplicates an
+        existing video or an earlier video in the list, and ``None`` for the
+        others. Uses a single query on :class:`VideoIdentifier`.
 
-        if self.file_url and qs.filter(file_url=self.file_url).exists():
-            raise ValidationError("Another video with the same file url "
-                                  "already exists.")
+        """
+        identifiers = [video.get_identifiers() for video in videos]
+        hashes = set(hash for video_identifiers in identifiers
+                     for kind, hash in video_identifiers)
+        if hashes:
+            qs = VideoIdentifier.objects.filter(
+                hash__in=hashes,
+                video__site__in=set(video.site_id for video in videos))
+            if exclude_rejected:
+                qs = qs.exclude(video__status=Video.REJECTED)
+            pks = [video.pk for video in videos if video.pk is not None]
+            if pks:
+                qs = qs.exclude(video__in=pks)
+            seen = set(qs.values_list('video__site', 'kind', 'hash'))
+        else:
+            seen = set()
+
+        verbose_kinds = dict(VideoIdentifier.KIND_CHOICES)
+        errors = []
+        for video, video_identifiers in zip(videos, identifiers):
+            error = None
+            if not video.embed_code and not video.file_url:
+                error = ValidationError("Video has no embed code or file "
+                                        "url.")
+            else:
+                for kind, hash in video_identifiers:
+                    if (video.site_id, kind, hash) in seen:
+                        error = ValidationError("Another video with the same "
+                                                "%s already exists." %
+                                                verbose_kinds[kind])
+                        break
+            if error is None:
+                seen.update((video.site_id, kind, hash)
+                            for kind, hash in video_identifiers)
+            errors.append(error)
+        return errors
 
     def clear_rejected_duplicates(self):
         """
@@ -933,20 +1560,28 @@ class Video(Thumbnailable):
         website_url, and guid fields.
 
         """
-        if not any((self.website_url, self.file_url, self.guid)):
-            return
+        Video._clear_rejected_duplicates([self])
+
+    @classmethod
+    def _clear_rejected_duplicates(cls, videos):
+        """
+        Deletes rejected copies of any of the ``videos``, finding them with a
+        single query on :class:`VideoIdentifier`.
 
-        q_filter = models.Q()
-        if self.website_url:
-            q_filter |= models.Q(website_url=self.website_url)
-        if self.file_url:
-            q_filter |= models.Q(file_url=self.file_url)
-        if self.guid:
-            q_filter |= models.Q(guid=self.guid)
-        qs = Video.objects.filter(
-            site=self.site_id,
-            status=Video.REJECTED).filter(q_filter)
-        qs.delete()
+        """
+        wanted = set((video.site_id, kind, hash) for video in videos
+                     for kind, hash in video.get_identifiers())
+        if not wanted:
+            return
+        rows = VideoIdentifier.objects.filter(
+            hash__in=set(hash for site_pk, kind, hash in wanted),
+            video__site__in=set(site_pk for site_pk, kind, hash in wanted),
+            video__status=Video.REJECTED
+        ).values_list('video', 'video__site', 'kind', 'hash')
+        pks = set(video_pk for video_pk, site_pk, kind, hash in rows
+                  if (site_pk, kind, hash) in wanted)
+        if pks:
+            Video.objects.filter(pk__in=pks).delete()
 
     @models.permalink
     def get_absolute_url(self):
@@ -954,6 +1589,24 @@ class Video(Thumbnailable):
                 {'video_id': self.id,
                  'slug': slugify(self.name)[:30]})
 
+    #: The fields :meth:`source_type` depends on.
+    SOURCE_TYPE_FIELDS = ('feed_id', 'search_id', 'website_url',
+                          'video_service_user')
+
+    def __init__(self, *args, **kwargs):
+        super(Video, self).__init__(*args, **kwargs)
+        # Videos loaded from the database already have an up-to-date
+        # calculated_source_type.
+        if self.pk is None:
+            self._source_type_state = None
+        else:
+            self._source_type_state = self._get_source_type_state()
+
+    def _get_source_type_state(self):
+        # Read from __dict__ so that deferred fields aren't loaded.
+        return (bool(self.id),) + tuple(self.__dict__.get(attname)
+                                        for attname in self.SOURCE_TYPE_FIELDS)
+
     def save(self, **kwargs):
         """
         Adds support for an ```update_index`` kwarg, defaulting to ``True``.
@@ -1012,13 +1665,7 @@ class Video(Thumbnailable):
         )
 
         if instance.description:
-            soup = BeautifulSoup(video.description)
-            for tag in soup.find_all(
-                'div', {'class': "miro-community-description"}):
-                instance.description = unicode(tag)
-                break
-            instance.description = sanitize(instance.description,
-                                            extra_filters=['img'])
+            instance.description = sanitize_description(video.description)
 
         instance._vidscraper_video = video
 
@@ -1029,34 +1676,19 @@ class Video(Thumbnailable):
             if authors:
                 instance.authors = authors
             if video.user:
-                name = video.user
-                if ' ' in name:
-                    first, last = name.split(' ', 1)
-                else:
-                    first, last = name, ''
-                author, created = User.objects.get_or_create(
-                    username=name[:30],
-                    defaults={'first_name': first[:30],
-                              'last_name': last[:30]})
-                if created:
-                    author.set_unusable_password()
-                    author.save()
-                    utils.get_profile_model()._default_manager.create(
-                        user=author, website=video.user_url or '')
-                instance.authors.add(author)
+                instance.authors.add(
+                          _get_vidscraper_authors([video])[video.user[:30]])
             if categories:
                 instance.categories = categories
-            if video.tags:
-                if settings.FORCE_LOWERCASE_TAGS:
-                    fix = lambda t: t.lower().strip()
-                else:
-                    fix = lambda t: t.strip()
-                tags = set(fix(tag) for tag in video.tags if tag.strip())
-                for tag_name in tags:
-                    tag, created = \
-                        tagging.models.Tag._default_manager.get_or_create(name=tag_name)
-                    tagging.models.TaggedItem._default_manager.create(
-                        tag=tag, object=instance)
+            tag_names = _get_vidscraper_tag_names(video)
+            if tag_names:
+                tags = utils.get_tags(tag_names)
+                content_type = ContentType.objects.get_for_model(instance)
+                tagging.models.TaggedItem._default_manager.bulk_create([
+                    tagging.models.TaggedItem(tag=tags[tag_name],
+                                              content_type=content_type,
+                                              object_id=instance.pk)
+                    for tag_name in tag_names])
             if source_import is not None:
                 source_import.handle_video(instance, video)
             post_video_from_vidscraper.send(sender=cls, instance=instance,
@@ -1073,6 +1705,67 @@ class Video(Thumbnailable):
             instance.save_m2m = save_m2m
         return instance
 
+    @classmethod
+    def bulk_save_from_vidscraper(cls, instances, source_import=None,
+                                  authors=None, categories=None):
+        """
+        Saves a list of :class:`Video` instances built by
+        :meth:`from_vidscraper_video` with ``commit=False``, then creates
+        their identifiers, authors, categories, tags and import indexes with a
+        few queries per batch instead of several per video. This should be run
+        inside a transaction.
+
+        """
+        identifiers = []
+        for instance in instances:
+            instance._defer_identifiers = True
+            instance.save(update_index=False)
+            del instance._defer_identifiers
+            identifiers.extend(
+                VideoIdentifier(video=instance, kind=kind, hash=hash)
+                for kind, hash in instance.get_identifiers())
+        VideoIdentifier.objects.bulk_create(identifiers)
+
+        vidscraper_videos = [instance._vidscraper_video
+                             for instance in instances]
+        service_authors = _get_vidscraper_authors(vidscraper_videos)
+        tags = utils.get_tags(set(itertools.chain(*[
+                                 _get_vidscraper_tag_names(video)
+                                 for video in vidscraper_videos])))
+        authors = list(authors or ())
+        categories = list(categories or ())
+        content_type = ContentType.objects.get_for_model(cls)
+
+        author_rows = set()
+        category_rows = []
+        tagged_items = []
+        for instance, video in zip(instances, vidscraper_videos):
+            author_rows.update((instance.pk, author.pk) for author in authors)
+            if video.user:
+                author_rows.add((instance.pk,
+                                 service_authors[video.user[:30]].pk))
+            category_rows.extend((instance.pk, category.pk)
+                                 for category in categories)
+            tagged_items.extend(
+                tagging.models.TaggedItem(tag=tags[tag_name],
+                                          content_type=content_type,
+                                          object_id=instance.pk)
+                for tag_name in _get_vidscraper_tag_names(video))
+
+        cls.authors.through._default_manager.bulk_create([
+            cls.authors.through(video_id=video_pk, user_id=user_pk)
+            for video_pk, user_pk in author_rows])
+        cls.categories.through._default_manager.bulk_create([
+            cls.categories.through(video_id=video_pk, category_id=category_pk)
+            for video_pk, category_pk in category_rows])
+        tagging.models.TaggedItem._default_manager.bulk_create(tagged_items)
+
+        if source_import is not None:
+            source_import.handle_videos(zip(instances, vidscraper_videos))
+        for instance, video in zip(instances, vidscraper_videos):
+            post_video_from_vidscraper.send(sender=cls, instance=instance,
+                                            vidscraper_video=video)
+
     def get_tags(self):
         if self.pk is None:
             vidscraper_video = getattr(self, '_vidscraper_video', None)
@@ -1094,15 +1787,16 @@ class Video(Thumbnailable):
         if not self.file_url:
             return
 
-        request = urllib2.Request(utils.quote_unicode_url(self.file_url))
-        request.get_method = lambda: 'HEAD'
         try:
-            http_file = urllib2.urlopen(request, timeout=5)
+            response = fetch(utils.quote_unicode_url(self.file_url),
+                             method='HEAD', timeout=5, allow_redirects=True)
         except Exception:
             pass
         else:
-            self.file_url_length = http_file.headers.get('content-length')
-            self.file_url_mimetype = http_file.headers.get('content-type', '')
+            if response.status_code >= 400:
+                return
+            self.file_url_length = response.headers.get('content-length')
+            self.file_url_mimetype = response.headers.get('content-type', '')
             if self.file_url_mimetype in ('application/octet-stream', ''):
                 # We got a not-useful MIME type; guess!
                 guess = mimetypes.guess_type(self.file_url)
@@ -1135,23 +1829,34 @@ class Video(Thumbnailable):
             return self.when_published
         return self.when_approved or self.when_submitted
 
+    def get_thumbnail_adjustment(self, width, height):
+        """
+        Returns the recorded info dict for this video's thumbnail filled to
+        ``width`` x ``height``, or ``None`` if that adjustment hasn't been
+        made for the current thumbnail.
+
+        """
+        if not self.thumbnail or not self.thumbnail_adjustments:
+            return None
+        cached = getattr(self, '_thumbnail_adjustments_cache', None)
+        if cached is None or cached[0] != self.thumbnail_adjustments:
+            try:
+                data = simplejson.loads(self.thumbnail_adjustments)
+            except ValueError:
+                data = {}
+            cached = (self.thumbnail_adjustments, data)
+            self._thumbnail_adjustments_cache = cached
+        data = cached[1]
+        if data.get('thumbnail') != self.thumbnail.name:
+            return None
+        return data.get('sizes', {}).get('%ix%i' % (width, height))
+
     def source_type(self):
         if self.id and self.search_id:
-            try:
-                return u'Search: %s' % self.search
-            except SavedSearch.DoesNotExist:
-                return u''
+            return _get_video_source_type(SavedSearch, self.search_id)
 
         if self.id and self.feed_id:
-            try:
-                if self.feed.video_service():
-                    return u'User: %s: %s' % (
-                        self.feed.video_service(),
-                        self.feed.name)
-                else:
-                    return 'Feed: %s' % self.feed.name
-            except Feed.DoesNotExist:
-                return ''
+            return _get_video_source_type(Feed, self.feed_id)
 
         if self.video_service_user:
             return u'User: %s: %s' % (self.video_service(),
@@ -1204,12 +1909,69 @@ class Video(Thumbnailable):
 
 
 def pre_save_video_set_calculated_source_type(instance, **kwargs):
-    # Always recalculate the source_type field.
-    instance.calculated_source_type = instance.source_type()
+    # Recalculate the source_type field if anything it depends on has
+    # changed since it was last calculated.
+    state = instance._get_source_type_state()
+    if state != instance._source_type_state:
+        instance.calculated_source_type = instance.source_type()
+        instance._source_type_state = state
 models.signals.pre_save.connect(pre_save_video_set_calculated_source_type,
                                 sender=Video)
 
 
+
+class VideoIdentifier(models.Model):
+    """
+    A hashed, normalized identifier of a video (its guid, website url or file
+    url), used to find duplicate videos with indexed lookups instead of
+    comparisons on the long url columns. Kept in sync with :class:`Video` by
+    :func:`video_post_save_update_identifiers`.
+
+    """
+    GUID = 'guid'
+    WEBSITE_URL = 'website_url'
+    FILE_URL = 'file_url'
+    KIND_CHOICES = (
+        (GUID, 'guid'),
+        (WEBSITE_URL, 'website url'),
+        (FILE_URL, 'file url'),
+    )
+    URL_KINDS = (WEBSITE_URL, FILE_URL)
+
+    video = models.ForeignKey(Video, related_name='identifiers')
+    kind = models.CharField(max_length=11, choices=KIND_CHOICES)
+    hash = models.CharField(max_length=40, db_index=True)
+
+
+def video_post_save_update_identifiers(sender, instance, created, **kwargs):
+    if getattr(instance, '_defer_identifiers', False):
+        return
+    identifiers = set(instance.get_identifiers())
+    if not created:
+        existing = set(instance.identifiers.values_list('kind', 'hash'))
+        if existing == identifiers:
+            return
+        instance.identifiers.all().delete()
+    VideoIdentifier.objects.bulk_create([
+        VideoIdentifier(video=instance, kind=kind, hash=hash)
+        for kind, hash in identifiers])
+models.signals.post_save.connect(video_post_save_update_identifiers,
+                                 sender=Video)
+
+
+def tag_post_delete_forget(sender, instance, **kwargs):
+    utils.forget_tag(instance)
+models.signals.post_delete.connect(tag_post_delete_forget,
+                                   sender=tagging.models.Tag)
+
+
+def user_changed_forget(sender, instance, **kwargs):
+    # The username may have changed, so drop every entry for the user.
+    for username in _author_usernames.pop(instance.pk, ()):
+        _author_cache.pop(username, None)
+models.signals.post_save.connect(user_changed_forget, sender=User)
+models.signals.post_delete.connect(user_changed_forget, sender=User)
+
 class Watch(models.Model):
     """
     Record of a video being watched.
@@ -1221,16 +1983,25 @@ class Watch(models.Model):
      - ip_address: IP address of the user
     """
     video = models.ForeignKey(Video)
-    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Not auto_now_add, so that buffered watches keep the time they happened
+    # rather than the time they were flushed.
+    timestamp = models.DateTimeField(default=datetime.datetime.now,
+                                     db_index=True)
     user = models.ForeignKey('auth.User', blank=True, null=True)
     ip_address = models.IPAddressField()
 
+    objects = WatchManager()
+
     @classmethod
     def add(Class, request, video):
         """
         Adds a record of a watched video to the database.  If the request came
         from localhost, check to see if it was forwarded to (hopefully) get the
         right IP address.
+
+        If ``LOCALTV_WATCH_BUFFER`` is ``True`` and the cache is shared
+        between processes, the watch is buffered and saved later by
+        :func:`localtv.tasks.flush_watch_buffer`.
         """
         ignored_bots = getattr(settings, 'LOCALTV_WATCH_IGNORED_USER_AGENTS',
                                ('bot', 'spider', 'crawler'))
@@ -1250,11 +2021,86 @@ class Watch(models.Model):
             user = None
 
         try:
-            Class(video=video, user=user, ip_address=ip).save()
+            if (lsettings.WATCH_BUFFER_ENABLED and
+                    Class.objects.buffer_is_shared()):
+                Class.objects.buffer(video, user, ip)
+            else:
+                Class(video=video, user=user, ip_address=ip).save()
         except Exception:
             pass
 
 
+class DailyWatchCount(models.Model):
+    """
+    Number of times (and approximate number of unique viewers by which) a
+    video was watched on a given day. This is kept up to date as watches are
+    saved, and is used for popularity calculations so that they don't need to
+    aggregate the raw watch table.
+
+    """
+    video = models.ForeignKey(Video)
+    day = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+    #: Serialized :class:`~localtv.hyperloglog.HyperLogLog` sketch of the
+    #: day's unique viewers.
+    viewers = models.TextField(blank=True)
+    #: Estimated number of unique viewers on this day.
+    viewer_count = models.PositiveIntegerField(default=0)
+
+    objects = DailyWatchCountManager()
+
+    class Meta:
+        unique_together = ('video', 'day')
+
+
+class IndexedWatchCount(models.Model):
+    """
+    The watch count which was last sent to the search index for a video. This
+    lets :func:`localtv.tasks.update_popularity` skip videos whose count
+    hasn't changed. Videos whose indexed count is 0 have no row.
+
+    """
+    video = models.OneToOneField(Video, primary_key=True)
+    count = models.PositiveIntegerField(default=0)
+
+
+class CommandCheckpoint(models.Model):
+    """
+    Where the last run of a long-running management command got to, so that
+    an interrupted run can be picked up after the last object it handled.
+    ``cursor`` is ``None`` once a run has finished; ``stats`` holds the
+    run's counts as JSON.
+
+    """
+    command = models.CharField(max_length=100, unique=True)
+    cursor = models.PositiveIntegerField(null=True, blank=True)
+    stats = models.TextField(blank=True)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.command
+
+    def get_stats(self):
+        """Returns the run's counts as a dictionary."""
+        if not self.stats:
+            return {}
+        return simplejson.loads(self.stats)
+
+    def set_stats(self, stats):
+        self.stats = simplejson.dumps(stats)
+
+
+def watch_post_save_update_rollup(sender, instance, created, **kwargs):
+    if created:
+        # Only the count is updated here, to keep page views cheap; the
+        # viewer sketches are brought up to date by
+        # DailyWatchCountManager.refresh_viewers().
+        DailyWatchCount.objects.increment(instance.video_id,
+                                          instance.timestamp.date())
+models.signals.post_save.connect(watch_post_save_update_rollup,
+                                 sender=Watch)
+
+
 class VideoModerator(CommentModerator):
 
     def allow(self, comment, video, request):
@@ -1418,6 +2264,9 @@ models.signals.post_syncdb.connect(create_email_notices)
 
 
 def delete_comments(sender, instance, **kwargs):
+    if getattr(instance, '_comments_deleted', False):
+        # Already deleted in bulk; see localtv.tasks.delete_videos().
+        return
     from django.contrib.comments import get_model
     get_model().objects.filter(
         object_pk=instance.pk,
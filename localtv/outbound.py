@@ -0,0 +1,150 @@
+"""
+Shared handling for outbound HTTP requests to video sites and feeds.
+
+Our own requests go through :func:`fetch`, which uses a single keep-alive
+session. Requests made by other libraries (vidscraper, feedparser) are wrapped
+in :func:`host_slot`. Both apply per-host limits on concurrent requests and on
+requests per second. The limits are tracked in the cache, so they hold across
+worker processes when the cache is shared.
+
+"""
+import contextlib
+import logging
+import time
+import urlparse
+
+from django.core.cache import cache
+import requests
+
+from localtv import settings as lsettings
+
+
+#: How long a concurrency counter lives without being touched, so that slots
+#: leaked by killed workers are eventually freed.
+SLOT_TIMEOUT = 5 * 60
+
+_session = None
+
+
+def get_session():
+    """
+    Returns the shared :mod:`requests` session, which keeps connections alive
+    and pools them per host.
+
+    """
+    global _session
+    if _session is None:
+        _session = requests.session(
+            timeout=lsettings.HTTP_TIMEOUT,
+            config={'keep_alive': True,
+                    'pool_connections': lsettings.HTTP_POOL_SIZE,
+                    'pool_maxsize': lsettings.HTTP_POOL_SIZE})
+    return _session
+
+
+def get_host(url):
+    """
+    Returns the lowercased host name of ``url``, or an empty string if it
+    has none.
+
+    """
+    if not url:
+        return ''
+    return (urlparse.urlsplit(url).hostname or '').lower()
+
+
+def get_host_limits(host):
+    """
+    Returns a (concurrency, rate) tuple for ``host``. Entries in
+    ``LOCALTV_HTTP_HOST_LIMITS`` apply to the named domain and its
+    subdomains; the most specific one wins.
+
+    """
+    limits = {'concurrency': lsettings.HTTP_HOST_CONCURRENCY,
+              'rate': lsettings.HTTP_HOST_RATE}
+    matches = [domain for domain in lsettings.HTTP_HOST_LIMITS
+               if host == domain or host.endswith('.' + domain)]
+    if matches:
+        limits.update(lsettings.HTTP_HOST_LIMITS[max(matches, key=len)])
+    return limits['concurrency'], limits['rate']
+
+
+def _acquire(host, concurrency):
+    key = 'localtv_http_active:%s' % host
+    deadline = time.time() + lsettings.HTTP_HOST_WAIT
+    while True:
+        cache.add(key, 0, SLOT_TIMEOUT)
+        try:
+            active = cache.incr(key)
+        except ValueError:
+            # The counter expired between the add and the incr, or the cache
+            # doesn't keep values at all. Don't hold things up.
+            return False
+        if active <= concurrency:
+            return True
+        cache.decr(key)
+        if time.time() >= deadline:
+            logging.warn('Waited %is for a connection slot for %s; going '
+                         'ahead anyway.', lsettings.HTTP_HOST_WAIT, host)
+            return False
+        time.sleep(0.1)
+
+
+def _release(host):
+    try:
+        cache.decr('localtv_http_active:%s' % host)
+    except ValueError:
+        pass
+
+
+def _throttle(host, rate):
+    """
+    Waits until ``host`` has had fewer than ``rate`` requests in the current
+    one-second window.
+
+    """
+    while True:
+        now = time.time()
+        key = 'localtv_http_rate:%s:%i' % (host, now)
+        cache.add(key, 0, 2)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            count = 1
+        if count <= rate:
+            return
+        time.sleep(int(now) + 1 - now)
+
+
+@contextlib.contextmanager
+def host_slot(url):
+    """
+    Context manager which holds one of the concurrent request slots for the
+    host of ``url`` while its body runs, after waiting out the host's rate
+    limit. URLs without a host aren't limited.
+
+    """
+    host = get_host(url)
+    if not host:
+        yield
+        return
+    concurrency, rate = get_host_limits(host)
+    acquired = concurrency is None or _acquire(host, concurrency)
+    try:
+        if rate:
+            _throttle(host, rate)
+        yield
+    finally:
+        if concurrency is not None and acquired:
+            _release(host)
+
+
+def fetch(url, method='GET', **kwargs):
+    """
+    Makes a request for ``url`` with the shared session, within the host's
+    limits, and returns the :class:`requests.Response`. Keyword arguments are
+    passed on to :meth:`requests.Session.request`.
+
+    """
+    with host_slot(url):
+        return get_session().request(method, url, **kwargs)
@@ -1,4 +1,3 @@
-import itertools
 import operator
 
 from django.db.models.query import Q
@@ -188,7 +187,11 @@ class PopularSort(Sort):
 
     def sort(self, queryset):
         if not isinstance(queryset, SearchQuerySet):
-            popular = queryset.popular()
-            not_popular = queryset.not_popular()
-            return itertools.chain(popular, not_popular)
+            # Keep the queryset's existing ordering as a tie-breaker so that
+            # videos with equal counts (e.g. unwatched ones) are still
+            # ordered sensibly and pagination is stable.
+            ordering = (list(queryset.query.order_by) or
+                        list(queryset.model._meta.ordering))
+            queryset = queryset.with_watch_count()
+            return queryset.order_by(self.get_order_by(queryset), *ordering)
         return super(PopularSort, self).sort(queryset)
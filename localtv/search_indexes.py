@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
@@ -6,7 +6,7 @@ from django.db.models import signals
 from haystack import indexes
 from haystack.query import SearchQuerySet
 
-from localtv.models import Video, Feed, SavedSearch
+from localtv.models import Video, Feed, SavedSearch, DailyWatchCount
 from localtv.playlists.models import PlaylistItem
 from localtv.tasks import haystack_update, haystack_remove
 
@@ -171,8 +171,8 @@ class VideoIndex(QueuedSearchIndex, indexes.Indexable):
         return self._prepare_rel_field(video, 'playlists')
 
     def prepare_watch_count(self, video):
-        since = datetime.now() - timedelta(7)
-        return video.watch_set.filter(timestamp__gt=since).count()
+        counts = DailyWatchCount.objects.get_popularity_counts(video=video)
+        return counts.get(video.pk, 0)
 
     def prepare_best_date(self, video):
         return video.when_approved or video.when_submitted
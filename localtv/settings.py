@@ -1,6 +1,20 @@
 from django.conf import settings
 
-__all__ = ('USE_HAYSTACK', 'API_KEYS')
+__all__ = ('USE_HAYSTACK', 'API_KEYS', 'POPULARITY_DAYS', 'POPULARITY_METRIC',
+           'WATCH_BUFFER_ENABLED', 'WATCH_BUFFER_FLUSH_SIZE',
+           'WATCH_BUFFER_FLUSH_INTERVAL', 'WATCH_BUFFER_TIMEOUT',
+           'WATCH_BUFFER_LOCK_TIMEOUT',
+           'WATCH_RETENTION_DAYS', 'WATCH_HISTORY_RETENTION_DAYS',
+           'PURGE_CHUNK_SIZE', 'PURGE_CHUNK_PAUSE', 'IMPORT_BATCH_SIZE',
+           'POLL_MIN_INTERVAL', 'POLL_MAX_INTERVAL', 'POLL_JITTER',
+           'HTTP_TIMEOUT', 'HTTP_POOL_SIZE', 'HTTP_HOST_CONCURRENCY',
+           'HTTP_HOST_RATE', 'HTTP_HOST_LIMITS', 'HTTP_HOST_WAIT',
+           'SEARCH_LOAD_THREADS', 'SEARCH_LOAD_DEADLINE',
+           'IMPORT_COUNTER_SHARDS', 'IMPORT_CHECKPOINT_SIZE',
+           'IMPORT_MAX_OUTSTANDING', 'IMPORT_BACKPRESSURE_WAIT',
+           'IMPORT_RESUME_AFTER', 'THUMBNAIL_MAX_BYTES',
+           'THUMBNAIL_TIMEOUT', 'THUMBNAIL_DOWNLOAD_THREADS',
+           'THUMBNAIL_ADJUSTMENT_SIZES', 'SOURCE_TYPE_CACHE_TIMEOUT')
 
 USE_HAYSTACK = getattr(settings, 'LOCALTV_USE_HAYSTACK', True)
 
@@ -14,3 +28,134 @@ _keymap = {
 API_KEYS = dict((k, getattr(settings, v))
                 for k, v in _keymap.iteritems()
                 if getattr(settings, v, None) is not None)
+
+#: The number of days (including today) of watches which count towards a
+#: video's popularity.
+POPULARITY_DAYS = getattr(settings, 'LOCALTV_POPULARITY_DAYS', 7)
+#: What popularity is measured by: ``'watches'`` (the number of times a video
+#: was watched) or ``'viewers'`` (the sum of each day's approximate number of
+#: unique viewers, so a viewer is counted once per day they watch).
+POPULARITY_METRIC = getattr(settings, 'LOCALTV_POPULARITY_METRIC', 'watches')
+
+#: If ``True``, watches are written to a cache-backed buffer and saved to the
+#: database in bulk by the :func:`localtv.tasks.flush_watch_buffer` task
+#: rather than being saved on each request.
+WATCH_BUFFER_ENABLED = getattr(settings, 'LOCALTV_WATCH_BUFFER', False)
+#: The maximum number of buffered watches saved in a single bulk insert. A
+#: flush is also queued whenever this many watches have been buffered.
+WATCH_BUFFER_FLUSH_SIZE = getattr(settings,
+                                  'LOCALTV_WATCH_BUFFER_FLUSH_SIZE', 500)
+#: How often (in seconds) the periodic flush task runs.
+WATCH_BUFFER_FLUSH_INTERVAL = getattr(settings,
+                                      'LOCALTV_WATCH_BUFFER_FLUSH_INTERVAL', 60)
+#: How long (in seconds) a buffered watch is kept in the cache before it is
+#: considered lost.
+WATCH_BUFFER_TIMEOUT = getattr(settings, 'LOCALTV_WATCH_BUFFER_TIMEOUT',
+                               60 * 60 * 24)
+#: How long (in seconds) a flush holds the buffer lock. If a flush dies
+#: without releasing the lock, flushing resumes after this long.
+WATCH_BUFFER_LOCK_TIMEOUT = getattr(settings,
+                                    'LOCALTV_WATCH_BUFFER_LOCK_TIMEOUT',
+                                    5 * WATCH_BUFFER_FLUSH_INTERVAL)
+
+#: How many days of raw watches to keep. Older watches are deleted by the
+#: ``purge_watches`` command once they are part of the daily rollup. If
+#: ``None``, watches are kept forever. Must be at least
+#: :data:`POPULARITY_DAYS`.
+WATCH_RETENTION_DAYS = getattr(settings, 'LOCALTV_WATCH_RETENTION_DAYS', None)
+#: How many days of daily watch rollup rows to keep. If ``None``, the rollup
+#: is kept forever.
+WATCH_HISTORY_RETENTION_DAYS = getattr(settings,
+                                       'LOCALTV_WATCH_HISTORY_RETENTION_DAYS',
+                                       None)
+#: The maximum number of rows deleted by a single statement during bulk
+#: cleanups.
+PURGE_CHUNK_SIZE = getattr(settings, 'LOCALTV_PURGE_CHUNK_SIZE', 1000)
+#: The number of seconds to wait between chunks during bulk cleanups, to give
+#: other queries a chance at the tables.
+PURGE_CHUNK_PAUSE = getattr(settings, 'LOCALTV_PURGE_CHUNK_PAUSE', 0)
+
+#: The number of feed or search entries handled by each import task.
+IMPORT_BATCH_SIZE = getattr(settings, 'LOCALTV_IMPORT_BATCH_SIZE', 25)
+
+#: How long (in seconds) the source types of feeds and searches are cached.
+#: Saving or deleting a feed or search clears its entry; changes made without
+#: saving (e.g. queryset updates) are picked up within this time.
+SOURCE_TYPE_CACHE_TIMEOUT = getattr(settings,
+                                    'LOCALTV_SOURCE_TYPE_CACHE_TIMEOUT', 60)
+
+#: The shortest time, in seconds, between two automatic updates of a source.
+#: Sources which have new videos are polled more often, down to this interval.
+POLL_MIN_INTERVAL = getattr(settings, 'LOCALTV_POLL_MIN_INTERVAL', 15 * 60)
+#: The longest time, in seconds, between two automatic updates of a source.
+#: Quiet or failing sources back off up to this interval.
+POLL_MAX_INTERVAL = getattr(settings, 'LOCALTV_POLL_MAX_INTERVAL',
+                            24 * 60 * 60)
+#: The fraction by which poll intervals are randomly lengthened or shortened,
+#: so that sources don't all come due at once.
+POLL_JITTER = getattr(settings, 'LOCALTV_POLL_JITTER', 0.1)
+
+#: Timeout, in seconds, for outbound HTTP requests.
+HTTP_TIMEOUT = getattr(settings, 'LOCALTV_HTTP_TIMEOUT', 10)
+#: The number of kept-alive connections pooled for each host.
+HTTP_POOL_SIZE = getattr(settings, 'LOCALTV_HTTP_POOL_SIZE', 10)
+#: The maximum number of concurrent requests to a single host, or ``None``
+#: for no limit.
+HTTP_HOST_CONCURRENCY = getattr(settings, 'LOCALTV_HTTP_HOST_CONCURRENCY', 4)
+#: The maximum number of requests per second to a single host, or ``None``
+#: for no limit.
+HTTP_HOST_RATE = getattr(settings, 'LOCALTV_HTTP_HOST_RATE', 5)
+#: Per-domain overrides for the limits above, e.g.
+#: ``{'youtube.com': {'concurrency': 2, 'rate': 2}}``. A domain's limits also
+#: apply to its subdomains.
+HTTP_HOST_LIMITS = getattr(settings, 'LOCALTV_HTTP_HOST_LIMITS', {})
+#: How long, in seconds, to wait for a free slot on a busy host before making
+#: the request anyway.
+HTTP_HOST_WAIT = getattr(settings, 'LOCALTV_HTTP_HOST_WAIT', 30)
+
+#: The number of search backends loaded at the same time when updating a
+#: saved search.
+SEARCH_LOAD_THREADS = getattr(settings, 'LOCALTV_SEARCH_LOAD_THREADS', 4)
+#: How long, in seconds, to wait for all the search backends to load. Backends
+#: which haven't loaded by then are skipped.
+SEARCH_LOAD_DEADLINE = getattr(settings, 'LOCALTV_SEARCH_LOAD_DEADLINE', 30)
+
+#: The number of counter rows each import's progress is spread over. More
+#: shards mean less waiting between import tasks working on the same import.
+IMPORT_COUNTER_SHARDS = getattr(settings, 'LOCALTV_IMPORT_COUNTER_SHARDS', 8)
+#: How many videos an import queues between saving its position in the
+#: source, from which it can resume if the worker dies.
+IMPORT_CHECKPOINT_SIZE = getattr(settings, 'LOCALTV_IMPORT_CHECKPOINT_SIZE',
+                                 500)
+#: The most videos an import may have queued but not yet handled. Imports
+#: wait before queueing more.
+IMPORT_MAX_OUTSTANDING = getattr(settings, 'LOCALTV_IMPORT_MAX_OUTSTANDING',
+                                 1000)
+#: How long, in seconds, an import waits for outstanding videos to be handled
+#: before queueing more anyway.
+IMPORT_BACKPRESSURE_WAIT = getattr(settings,
+                                   'LOCALTV_IMPORT_BACKPRESSURE_WAIT', 600)
+#: How long, in seconds, a feed import which is still queueing videos can go
+#: without activity before it's considered interrupted and resumed from its
+#: last checkpoint.
+IMPORT_RESUME_AFTER = getattr(settings, 'LOCALTV_IMPORT_RESUME_AFTER', 3600)
+
+#: The largest thumbnail, in bytes, which will be downloaded. Larger images
+#: are treated as invalid.
+THUMBNAIL_MAX_BYTES = getattr(settings, 'LOCALTV_THUMBNAIL_MAX_BYTES',
+                              10 * 1024 * 1024)
+#: How long, in seconds, to wait for a thumbnail server to respond.
+THUMBNAIL_TIMEOUT = getattr(settings, 'LOCALTV_THUMBNAIL_TIMEOUT', 30)
+#: The number of thumbnails downloaded at the same time by one task.
+THUMBNAIL_DOWNLOAD_THREADS = getattr(settings,
+                                     'LOCALTV_THUMBNAIL_DOWNLOAD_THREADS', 4)
+
+#: The (width, height) sizes to which video thumbnails are adjusted as soon
+#: as they're saved. The defaults are the sizes used by the video feeds.
+THUMBNAIL_ADJUSTMENT_SIZES = getattr(settings,
+                                     'LOCALTV_THUMBNAIL_ADJUSTMENT_SIZES', (
+    (375, 295),
+    (222, 169),
+    (140, 110),
+    (88, 68),
+))
@@ -9,10 +9,11 @@ from tagging.forms import TagField
 import vidscraper
 from vidscraper.exceptions import UnhandledVideo
 
-from localtv.models import Video, SiteSettings
+from localtv.models import Video, VideoIdentifier, SiteSettings
 from localtv.settings import API_KEYS
 from localtv.tasks import video_save_thumbnail
 from localtv.templatetags.filters import sanitize
+from localtv.utils import identifier_hash
 
 
 class SubmitURLForm(forms.Form):
@@ -22,9 +23,12 @@ class SubmitURLForm(forms.Form):
     def _validate_unique(self, url=None, guid=None):
         identifiers = Q()
         if url is not None:
-            identifiers |= Q(website_url=url) | Q(file_url=url)
+            identifiers |= Q(identifiers__kind__in=VideoIdentifier.URL_KINDS,
+                             identifiers__hash=identifier_hash(url,
+                                                               is_url=True))
         if guid is not None:
-            identifiers |= Q(guid=guid)
+            identifiers |= Q(identifiers__kind=VideoIdentifier.GUID,
+                             identifiers__hash=identifier_hash(guid))
         videos = Video.objects.filter(identifiers,
                                       ~Q(status=Video.REJECTED),
                                       site=Site.objects.get_current())
@@ -1,21 +1,29 @@
 import datetime
-import httplib
+import hashlib
 import logging
 import random
-import urllib
+from multiprocessing.pool import ThreadPool
 
-from celery.exceptions import MaxRetriesExceededError
-from celery.task import task
-from daguerre.utils import make_hash, KEEP_FORMATS, DEFAULT_FORMAT
-from django.core.exceptions import ValidationError
+from celery.task import periodic_task, task
+from daguerre.adjustments import Fill
+from daguerre.helpers import AdjustmentHelper
+from daguerre.utils import KEEP_FORMATS, DEFAULT_FORMAT
+from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.core.files.base import File
 from django.core.files.temp import NamedTemporaryFile
 from django.core.files.storage import default_storage
+from django.db import connections as db_connections, router, transaction
 from django.db.models import Q
+from django.db.models.deletion import Collector
 from django.db.models.loading import get_model
+from django.utils import simplejson
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from haystack import connection_router, connections
-from haystack.query import SearchQuerySet
+from requests.exceptions import (RequestException, HTTPError, InvalidURL,
+                                 MissingSchema, InvalidSchema)
+from vidscraper.exceptions import UnhandledVideo
+from vidscraper.suites import registry as vidscraper_registry
 from vidscraper.videos import Video as VidscraperVideo
 try:
     from PIL import Image
@@ -31,22 +39,49 @@ try:
 except ImportError:
     LockError = DummyException
 
-from localtv.models import Video, Feed, SavedSearch, Category
-from localtv.settings import USE_HAYSTACK, API_KEYS
+from localtv.models import (Video, Feed, FeedImport, SavedSearch, Category,
+                            Watch, DailyWatchCount, IndexedWatchCount)
+from localtv.settings import (USE_HAYSTACK, API_KEYS, POPULARITY_DAYS,
+                               POPULARITY_METRIC,
+                               POLL_MIN_INTERVAL,
+                               WATCH_BUFFER_FLUSH_INTERVAL,
+                               WATCH_RETENTION_DAYS,
+                               WATCH_HISTORY_RETENTION_DAYS,
+                               PURGE_CHUNK_SIZE, PURGE_CHUNK_PAUSE,
+                               THUMBNAIL_MAX_BYTES, THUMBNAIL_TIMEOUT,
+                               THUMBNAIL_DOWNLOAD_THREADS,
+                               THUMBNAIL_ADJUSTMENT_SIZES)
+from localtv.outbound import fetch, host_slot
 from localtv.signals import pre_mark_as_active
-from localtv.utils import quote_unicode_url
+from localtv.utils import quote_unicode_url, delete_in_chunks
 
 
 @task(ignore_result=True)
 def update_sources():
-    feeds = Feed.objects.filter(status=Feed.ACTIVE,
-                                auto_update=True)
-    for feed_pk in feeds.values_list('pk', flat=True):
-        feed_update.delay(feed_pk)
+    """
+    Queues updates for the sources which are due to be polled, and pushes
+    their next poll back so that they aren't queued again while the update
+    runs. Sources which have never been scheduled are given a random start
+    time within ``LOCALTV_POLL_MIN_INTERVAL`` instead of all being updated
+    at once.
 
-    searches = SavedSearch.objects.filter(auto_update=True)
-    for search_pk in searches.values_list('pk', flat=True):
-        search_update.delay(search_pk)
+    """
+    now = datetime.datetime.now()
+    sources = (
+        (Feed.objects.filter(status=Feed.ACTIVE, auto_update=True),
+         feed_update),
+        (SavedSearch.objects.filter(auto_update=True), search_update),
+    )
+    for queryset, update_task in sources:
+        unscheduled = queryset.filter(next_poll_at__isnull=True)
+        for pk in unscheduled.values_list('pk', flat=True):
+            next_poll_at = now + datetime.timedelta(
+                        seconds=random.uniform(0, POLL_MIN_INTERVAL))
+            unscheduled.filter(pk=pk).update(next_poll_at=next_poll_at)
+
+        for source in queryset.filter(next_poll_at__lte=now):
+            source.schedule_poll()
+            update_task.delay(source.pk)
 
 
 @task(ignore_result=True)
@@ -74,46 +109,26 @@ def search_update(search_id):
     search.update(clear_rejected=True)
 
 
-@task(ignore_result=True, max_retries=None, default_retry_delay=30)
+@task(ignore_result=True, max_retries=10, default_retry_delay=30)
 def mark_import_pending(import_app_label, import_model, import_pk):
     """
-    Checks whether an import's first stage is complete. If it's not, retries
-    the task with a countdown of 30.
+    Runs an import's second stage once its first stage has been claimed by
+    :meth:`.SourceImport.mark_pending_if_done`: approves the imported videos
+    if the import allows it, then indexes them and marks the import complete.
+    If indexing fails, the import is left pending and the task is retried.
 
     """
     import_class = get_model(import_app_label, import_model)
     try:
         source_import = import_class._default_manager.get(
                                                     pk=import_pk,
-                                                    status=import_class.STARTED)
+                                                    status=import_class.PENDING)
     except import_class.DoesNotExist:
-        logging.debug('Expected %s instance (pk=%r) missing.',
-                      import_class.__name__, import_pk)
-        # If this is the problem, don't retry indefinitely.
-        if mark_import_pending.request.retries > 10:
-            raise MaxRetriesExceededError
-        mark_import_pending.retry()
-    source_import.last_activity = datetime.datetime.now()
-    if source_import.total_videos is None:
-        source_import.save()
-        mark_import_pending.retry()
-    # get the correct counts from the database, rather than the race-condition
-    # prone count fields
-    import_count = source_import.indexes.count()
-    skipped_count = source_import.errors.filter(is_skip=True).count()
-    if import_count != source_import.videos_imported:
-        source_import.videos_imported = import_count
-    if skipped_count != source_import.videos_skipped:
-        source_import.videos_skipped = skipped_count
-    if (source_import.videos_imported + source_import.videos_skipped
-        < source_import.total_videos):
-        # Then the import is incomplete. Requeue it.
-        source_import.save()
-        # Retry raises an exception, ending task execution.
-        mark_import_pending.retry()
-
-    # Otherwise the first stage is complete. Check whether they can take all
-    # the videos.
+        logging.warn('Expected %s instance (pk=%r) missing.',
+                     import_class.__name__, import_pk)
+        return
+
+    # Check whether they can take all the videos.
     if source_import.auto_approve:
         active_set = source_import.get_videos().filter(
             status=Video.PENDING)
@@ -132,24 +147,20 @@ def mark_import_pending(import_app_label, import_model, import_pk):
     source_import.get_videos().filter(status=Video.PENDING).update(
         status=Video.UNAPPROVED)
 
-    source_import.status = import_class.PENDING
-    source_import.save()
-
-    active_pks = source_import.get_videos().filter(
-                         status=Video.ACTIVE).values_list('pk', flat=True)
-    if active_pks:
-        opts = Video._meta
-        haystack_batch_update.delay(opts.app_label, opts.module_name,
-                                    pks=list(active_pks), remove=False)
-
-    mark_import_complete.delay(import_app_label, import_model, import_pk)
+    try:
+        _complete_import(source_import)
+    except Exception, e:
+        logging.warn('Error indexing %s instance (pk=%r); retrying.',
+                     import_class.__name__, import_pk, exc_info=True)
+        mark_import_pending.retry(exc=e)
 
 
-@task(ignore_result=True, max_retries=None, default_retry_delay=30)
+@task(ignore_result=True, max_retries=10, default_retry_delay=30)
 def mark_import_complete(import_app_label, import_model, import_pk):
     """
-    Checks whether an import's second stage is complete. If it's not, retries
-    the task with a countdown of 30.
+    Indexes the active videos of a pending import and marks it complete.
+    :func:`mark_import_pending` now does this itself; this task remains for
+    messages queued by earlier versions.
 
     """
     import_class = get_model(import_app_label, import_model)
@@ -160,43 +171,43 @@ def mark_import_complete(import_app_label, import_model, import_pk):
     except import_class.DoesNotExist:
         logging.warn('Expected %s instance (pk=%r) missing.',
                      import_class.__name__, import_pk)
-        # If this is the problem, don't retry indefinitely.
-        if mark_import_complete.request.retries > 10:
-            raise MaxRetriesExceededError
-        mark_import_complete.retry()
-
-    if not USE_HAYSTACK:
-        # No need to do any comparisons - just mark it complete.
-        video_count = haystack_count = 0
-        logging.debug(('mark_import_complete(%s, %s, %i). Skipping '
-                       'check because haystack is disabled.'), import_app_label,
-                       import_model, import_pk)
-    else:
-        video_pks = list(source_import.get_videos().filter(
-                                status=Video.ACTIVE).values_list('pk', flat=True))
-        video_count = len(video_pks)
-        if not video_pks:
-            # Don't bother with the haystack query.
-            haystack_count = 0
-        else:
-            haystack_filter = {'django_id__in': video_pks}
-            haystack_count = SearchQuerySet().models(Video).filter(
-               **haystack_filter).count()
-        logging.debug(('mark_import_complete(%s, %s, %i). video_count: '
-                       '%i, haystack_count: %i'), import_app_label, import_model,
-                       import_pk, video_count, haystack_count)
-
-    if haystack_count >= video_count:
-        source_import.status = import_class.COMPLETE
-        if import_app_label == 'localtv' and import_model == 'feedimport':
-            source_import.source.status = source_import.source.ACTIVE
-            source_import.source.save()
+        return
+    try:
+        _complete_import(source_import)
+    except Exception, e:
+        logging.warn('Error indexing %s instance (pk=%r); retrying.',
+                     import_class.__name__, import_pk, exc_info=True)
+        mark_import_complete.retry(exc=e)
+
+
+def _complete_import(source_import, batch_size=100):
+    """
+    Updates the index for the active videos of ``source_import`` in this
+    process, rather than queueing the updates and polling the index until
+    they're done, then marks the import complete. Indexing errors are raised
+    before the import is touched, so that the caller can retry.
 
+    """
+    if USE_HAYSTACK:
+        active_pks = list(source_import.get_videos().filter(
+                          status=Video.ACTIVE).values_list('pk', flat=True))
+        using = connection_router.for_write()[0]
+        backend = connections[using].get_backend()
+        index = connections[using].get_unified_index().get_index(Video)
+        for start in xrange(0, len(active_pks), batch_size):
+            qs = index.index_queryset().filter(
+                                pk__in=active_pks[start:start + batch_size])
+            if qs:
+                backend.update(index, qs)
+
+    source_import.status = source_import.COMPLETE
+    if isinstance(source_import, FeedImport):
+        source_import.source.status = source_import.source.ACTIVE
+        source_import.source.save()
     source_import.last_activity = datetime.datetime.now()
     source_import.save()
-
-    if source_import.status == import_class.PENDING:
-        mark_import_complete.retry()
+    source_import.source.reschedule_poll(
+                                changed=source_import.videos_imported > 0)
 
 
 @task(ignore_result=True, max_retries=6, default_retry_delay=10)
@@ -217,7 +228,8 @@ def video_from_vidscraper_video(video_dict, site_pk,
 
     try:
         try:
-            vidscraper_video.load()
+            with host_slot(vidscraper_video.url):
+                vidscraper_video.load()
         except Exception:
             source_import.handle_error(
                 ('Skipped %r: Could not load video data.'
@@ -273,6 +285,231 @@ def video_from_vidscraper_video(video_dict, site_pk,
                                     % vidscraper_video.url),
                                    is_skip=True, with_exception=True)
         raise # so it shows up in the Celery log
+    finally:
+        source_import.mark_pending_if_done()
+
+@task(ignore_result=True, max_retries=6, default_retry_delay=10)
+def videos_from_vidscraper_videos(video_dicts, site_pk,
+                                  import_app_label=None, import_model=None,
+                                  import_pk=None, status=None,
+                                  author_pks=None, category_pks=None,
+                                  clear_rejected=False):
+    """
+    Batch version of :func:`video_from_vidscraper_video`. Validates and
+    deduplicates all the videos at once, then saves them along with their
+    relations in a single transaction. If saving the batch fails, each video
+    is retried on its own so that errors are recorded per video.
+
+    """
+    import_class = get_model(import_app_label, import_model)
+    try:
+        source_import = import_class.objects.get(
+           pk=import_pk,
+           status=import_class.STARTED)
+    except import_class.DoesNotExist:
+        logging.warn('Retrying batch of %i videos: expected %s instance '
+                     '(pk=%r) missing.', len(video_dicts),
+                     import_class.__name__, import_pk)
+        videos_from_vidscraper_videos.retry()
+
+    try:
+        _import_batch(source_import, video_dicts, site_pk, status,
+                      author_pks, category_pks, clear_rejected)
+    finally:
+        source_import.mark_pending_if_done()
+
+
+def _import_batch(source_import, video_dicts, site_pk, status, author_pks,
+                  category_pks, clear_rejected):
+    if category_pks:
+        categories = list(Category.objects.filter(pk__in=category_pks))
+    else:
+        categories = None
+
+    if author_pks:
+        authors = list(User.objects.filter(pk__in=author_pks))
+    else:
+        authors = None
+
+    videos = []
+    for video_dict in video_dicts:
+        vidscraper_video = VidscraperVideo.deserialize(video_dict, API_KEYS)
+        try:
+            with host_slot(vidscraper_video.url):
+                vidscraper_video.load()
+        except Exception:
+            source_import.handle_error(
+                ('Skipped %r: Could not load video data.'
+                 % vidscraper_video.url),
+                is_skip=True, with_exception=True)
+            continue
+
+        try:
+            video = Video.from_vidscraper_video(vidscraper_video,
+                                                status=status,
+                                                source_import=source_import,
+                                                authors=authors,
+                                                categories=categories,
+                                                site_pk=site_pk,
+                                                commit=False,
+                                                update_index=False)
+            video.clean_fields()
+            video.validate_unique()
+        except ValidationError, e:
+            source_import.handle_error(("Skipping %r: %r" % (
+                                        vidscraper_video.url, e.message)),
+                                       is_skip=True)
+        except Exception:
+            source_import.handle_error(('Unknown error during import of %r'
+                                        % vidscraper_video.url),
+                                       is_skip=True, with_exception=True)
+        else:
+            videos.append(video)
+
+    # See video_from_vidscraper_video for why rejected videos are included.
+    errors = Video._find_duplicates(videos, exclude_rejected=False)
+    for video, error in zip(videos, errors):
+        if error is not None:
+            source_import.handle_error(("Skipping %r: %r" % (
+                                        video._vidscraper_video.url,
+                                        error.message)),
+                                       is_skip=True)
+    videos = [video for video, error in zip(videos, errors) if error is None]
+    if not videos:
+        return
+
+    try:
+        with transaction.commit_on_success():
+            Video.bulk_save_from_vidscraper(videos,
+                                            source_import=source_import,
+                                            authors=authors,
+                                            categories=categories)
+            if clear_rejected:
+                Video._clear_rejected_duplicates(videos)
+    except Exception:
+        logging.warn('Batch import failed; importing %i videos one by one.',
+                     len(videos), exc_info=True)
+        saved = []
+        for video in videos:
+            video.pk = None
+            try:
+                with transaction.commit_on_success():
+                    video.save(update_index=False)
+                    video.save_m2m()
+                    if clear_rejected:
+                        video.clear_rejected_duplicates()
+            except Exception:
+                source_import.handle_error(('Unknown error during import of '
+                                            '%r' % video._vidscraper_video.url),
+                                           is_skip=True, with_exception=True)
+            else:
+                saved.append(video)
+        videos = saved
+
+    thumbnail_pks = []
+    for video in videos:
+        logging.debug('Made video %i: %r', video.pk, video.name)
+        if video.thumbnail_url:
+            thumbnail_pks.append(video.pk)
+    if thumbnail_pks:
+        videos_save_thumbnails.delay(thumbnail_pks)
+
+
+class InvalidThumbnail(Exception):
+    """
+    Raised when a thumbnail URL doesn't lead to a usable image, so there's no
+    point in trying it again.
+
+    """
+
+
+#: Thumbnails are stored under this directory, named after their content.
+THUMBNAIL_DIRECTORY = 'localtv/video/thumbnail/'
+
+
+def _download_thumbnail(thumbnail_url):
+    """
+    Streams the image at ``thumbnail_url`` into a temporary file, giving up
+    once it passes ``LOCALTV_THUMBNAIL_MAX_BYTES``. Returns a (file, SHA1
+    hexdigest, format) tuple; the file is rewound.
+
+    Raises :exc:`InvalidThumbnail` if the URL or the image is unusable, and
+    :exc:`RequestException` for errors which might be temporary.
+
+    """
+    try:
+        response = fetch(quote_unicode_url(thumbnail_url), prefetch=False,
+                         timeout=THUMBNAIL_TIMEOUT)
+    except (InvalidURL, MissingSchema, InvalidSchema):
+        raise InvalidThumbnail(thumbnail_url)
+
+    if response.status_code != 200:
+        logging.info("Code %i when getting %r, retrying",
+                     response.status_code, thumbnail_url)
+        raise HTTPError('Code %i' % response.status_code)
+
+    length = response.headers.get('content-length')
+    if length and length.isdigit() and int(length) > THUMBNAIL_MAX_BYTES:
+        raise InvalidThumbnail(thumbnail_url)
+
+    temp = NamedTemporaryFile()
+    try:
+        digest = hashlib.sha1()
+        size = 0
+        for chunk in response.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > THUMBNAIL_MAX_BYTES:
+                raise InvalidThumbnail(thumbnail_url)
+            digest.update(chunk)
+            temp.write(chunk)
+        temp.seek(0)
+        try:
+            im = Image.open(temp)
+            im.verify()
+        except Exception:
+            raise InvalidThumbnail(thumbnail_url)
+        temp.seek(0)
+    except Exception:
+        temp.close()
+        raise
+    format = im.format if im.format in KEEP_FORMATS else DEFAULT_FORMAT
+    return temp, digest.hexdigest(), format
+
+
+def _store_thumbnail(thumbnail_url):
+    """
+    Downloads the image at ``thumbnail_url`` and returns its storage path.
+    Images are named after a hash of their content, so an image which is
+    already stored, e.g. a feed's default thumbnail, is shared rather than
+    saved again.
+
+    """
+    temp, digest, format = _download_thumbnail(thumbnail_url)
+    try:
+        path = '%s%s/%s.%s' % (THUMBNAIL_DIRECTORY, digest[:2], digest,
+                               format.lower())
+        if not default_storage.exists(path):
+            path = default_storage.save(path, File(temp))
+    finally:
+        temp.close()
+    return path
+
+
+def _try_store_thumbnail(thumbnail_url):
+    """
+    Returns a (path, exception) tuple for ``thumbnail_url``, for use in
+    thread pools.
+
+    """
+    try:
+        return _store_thumbnail(thumbnail_url), None
+    except (InvalidThumbnail, RequestException), e:
+        return None, e
+    except Exception, e:
+        logging.warn('Error storing thumbnail %r', thumbnail_url,
+                     exc_info=True)
+        return None, e
+
 
 @task(ignore_result=True)
 def video_save_thumbnail(video_pk):
@@ -287,56 +524,386 @@ def video_save_thumbnail(video_pk):
     if not video.thumbnail_url:
         return
 
-    thumbnail_url = quote_unicode_url(video.thumbnail_url)
-
     try:
-        remote_file = urllib.urlopen(thumbnail_url)
-    except httplib.InvalidURL:
-        # If the URL isn't valid, erase it.
+        path = _store_thumbnail(video.thumbnail_url)
+    except InvalidThumbnail:
+        # If the URL or the file isn't valid, erase the url.
         Video.objects.filter(pk=video.pk
                     ).update(thumbnail_url='')
         return
-
-    if remote_file.getcode() != 200:
-        logging.info("Code %i when getting %r, retrying",
-                     remote_file.getcode(), video.thumbnail_url)
-        video_save_thumbnail.retry()
-
-    temp = NamedTemporaryFile()
-    try:
-        temp.write(remote_file.read())
-    except IOError:
+    except RequestException:
         # Could be a temporary disruption - try again later if this was
         # a task. Otherwise reraise.
         if video_save_thumbnail.request.called_directly:
             raise
         video_save_thumbnail.retry()
 
-    temp.seek(0)
+    # We update the path with a query to avoid overwriting other changes
+    # that might have happened simultaneously.
+    Video.objects.filter(pk=video.pk
+                ).update(thumbnail=path)
+    videos_adjust_thumbnails.delay([video.pk])
+
+
+def save_thumbnails(video_pks, threads=THUMBNAIL_DOWNLOAD_THREADS):
+    """
+    Saves the thumbnails of the videos with the given pks. Each distinct
+    thumbnail URL is downloaded once, with up to ``threads`` downloads at a
+    time.
+
+    Returns a dictionary with the number of videos whose thumbnails were
+    ``saved`` and whose urls were ``erased`` as unusable, and a ``failed``
+    list of the pks of videos whose downloads failed in a way which might be
+    temporary.
+
+    """
+    stats = {'saved': 0, 'erased': 0, 'failed': []}
+    urls = {}
+    for pk, url in Video.objects.filter(pk__in=video_pks).exclude(
+                            thumbnail_url='').values_list('pk',
+                                                          'thumbnail_url'):
+        urls.setdefault(url, []).append(pk)
+    if not urls:
+        return stats
+
+    urls = urls.items()
+    pool = ThreadPool(max(1, min(threads, len(urls))))
     try:
-        im = Image.open(temp)
-        im.verify()
-    except Exception:
-        # If the file isn't valid, erase the url.
-        Video.objects.filter(pk=video.pk
-                    ).update(thumbnail_url='')
+        results = pool.map(_try_store_thumbnail, [url for url, pks in urls])
+    finally:
+        pool.close()
+        pool.join()
+
+    saved_pks = []
+    for (url, pks), (path, error) in zip(urls, results):
+        # Only update videos whose URL hasn't changed in the meantime.
+        videos = Video.objects.filter(pk__in=pks, thumbnail_url=url)
+        if path is not None:
+            stats['saved'] += videos.update(thumbnail=path)
+            saved_pks.extend(pks)
+        elif isinstance(error, InvalidThumbnail):
+            stats['erased'] += videos.update(thumbnail_url='')
+        else:
+            stats['failed'].extend(pks)
+    if saved_pks:
+        videos_adjust_thumbnails.delay(saved_pks)
+    return stats
+
+
+@task(ignore_result=True, max_retries=6, default_retry_delay=10)
+def videos_save_thumbnails(video_pks):
+    """
+    Saves the thumbnails of several videos at once with
+    :func:`save_thumbnails`. Videos whose downloads failed are retried
+    together.
+
+    """
+    retry_pks = save_thumbnails(video_pks)['failed']
+    if retry_pks:
+        if videos_save_thumbnails.request.called_directly:
+            return
+        videos_save_thumbnails.retry(args=(retry_pks,))
+
+
+@task(ignore_result=True)
+def videos_adjust_thumbnails(video_pks, sizes=THUMBNAIL_ADJUSTMENT_SIZES):
+    """
+    Fills the thumbnails of the videos with the given pks to each of the
+    (width, height) ``sizes``, and records the adjusted images' info dicts
+    on the videos for :meth:`.Video.get_thumbnail_adjustment`.
+
+    """
+    videos = list(Video.objects.filter(pk__in=video_pks).exclude(
+                                                            thumbnail=''))
+    if not videos:
         return
+    adjusted = dict((video.pk, {}) for video in videos)
+    for width, height in sizes:
+        helper = AdjustmentHelper(videos, [Fill(width=width, height=height)],
+                                  'thumbnail')
+        try:
+            helper.adjust()
+        except Exception:
+            logging.warn('Error adjusting thumbnails to %ix%i', width, height,
+                         exc_info=True)
+            continue
+        for video, info_dict in helper.info_dicts():
+            if info_dict:
+                adjusted[video.pk]['%ix%i' % (width, height)] = dict(
+                                                                    info_dict)
+
+    for video in videos:
+        data = {'thumbnail': video.thumbnail.name,
+                'sizes': adjusted[video.pk]}
+        # Don't record adjustments for a thumbnail which has since changed.
+        Video.objects.filter(pk=video.pk, thumbnail=video.thumbnail.name
+                    ).update(thumbnail_adjustments=simplejson.dumps(data))
+
+
+def _scrape_publish_dates(videos):
+    """
+    Loads the publish dates of a list of (pk, vidscraper video) pairs, one
+    at a time. Returns a list of (pk, publish datetime, exception) tuples.
 
-    f = video._meta.get_field('thumbnail')
-    format = im.format if im.format in KEEP_FORMATS else DEFAULT_FORMAT
-    args = (video.thumbnail_url, video.pk, datetime.datetime.now().isoformat())
-    filename = '.'.join((make_hash(*args, step=2), format.lower()))
-    storage_path = f.generate_filename(video, filename)
-
-    # We save the thumbnail file and then update the path on the instance
-    # to avoid overwriting other changes that might have happened
-    # simultaneously.
-    final_path = default_storage.save(storage_path, File(temp))
-    Video.objects.filter(pk=video.pk
-                ).update(thumbnail=final_path)
-    remote_file.close()
-    temp.close()
+    """
+    results = []
+    for pk, video in videos:
+        try:
+            with host_slot(video.url):
+                video.load()
+        except Exception, e:
+            logging.warn('Error scraping the publish date of video %i from '
+                         '%r', pk, video.url, exc_info=True)
+            results.append((pk, None, e))
+        else:
+            results.append((pk, video.publish_datetime, None))
+    return results
+
+
+def scrape_publish_dates(video_pks, threads=4, chunk_size=10):
+    """
+    Fills in the missing publish dates of the videos with the given pks by
+    scraping their website urls. Videos are grouped by the vidscraper suite
+    which handles them, and each group is scraped in chunks of
+    ``chunk_size`` videos, up to ``threads`` chunks at a time. The dates are
+    written with one update per chunk; the videos aren't saved or
+    reindexed.
 
+    Returns a dictionary with an ``updated`` list of pks, and the number of
+    videos which were ``undated``, ``unhandled`` by any suite, or ``failed``
+    to load.
+
+    """
+    stats = {'updated': [], 'undated': 0, 'unhandled': 0, 'failed': 0}
+    groups = {}
+    for pk, url in Video.objects.filter(pk__in=video_pks,
+                                        when_published__isnull=True
+                                ).values_list('pk', 'website_url'):
+        for suite in vidscraper_registry.suites:
+            try:
+                video = suite.get_video(url, fields=['publish_datetime'],
+                                        api_keys=API_KEYS)
+            except UnhandledVideo:
+                continue
+            groups.setdefault(suite.__class__, []).append((pk, video))
+            break
+        else:
+            stats['unhandled'] += 1
+
+    chunks = [group[i:i + chunk_size] for group in groups.values()
+              for i in xrange(0, len(group), chunk_size)]
+    if not chunks:
+        return stats
+    pool = ThreadPool(max(1, min(threads, len(chunks))))
+    try:
+        results = pool.map(_scrape_publish_dates, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    for chunk in results:
+        dates = []
+        for pk, publish_datetime, error in chunk:
+            if error is not None:
+                stats['failed'] += 1
+            elif publish_datetime is None:
+                stats['undated'] += 1
+            else:
+                dates.append((pk, publish_datetime))
+        if dates:
+            _update_publish_dates(dates)
+            stats['updated'].extend(pk for pk, publish_datetime in dates)
+    return stats
+
+
+def _update_publish_dates(dates):
+    """
+    Sets the publish dates given as ``(pk, datetime)`` pairs with a single
+    ``UPDATE``, leaving alone dates which were set in the meantime.
+
+    """
+    using = router.db_for_write(Video)
+    connection = db_connections[using]
+    qn = connection.ops.quote_name
+    opts = Video._meta
+    column = qn(opts.get_field('when_published').column)
+    pk_column = qn(opts.pk.column)
+    cases = []
+    params = []
+    for pk, publish_datetime in dates:
+        cases.append('WHEN %s THEN %s')
+        params.extend((pk, connection.ops.value_to_db_datetime(
+                                                    publish_datetime)))
+    pks = [pk for pk, publish_datetime in dates]
+    params.extend(pks)
+    sql = ('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s) '
+           'AND %s IS NULL' % (qn(opts.db_table), column, pk_column,
+                               ' '.join(cases), pk_column,
+                               ', '.join(['%s'] * len(pks)), column))
+    connection.cursor().execute(sql, params)
+    transaction.commit_unless_managed(using=using)
+
+
+@periodic_task(ignore_result=True,
+               run_every=datetime.timedelta(seconds=WATCH_BUFFER_FLUSH_INTERVAL))
+def flush_watch_buffer():
+    """
+    Saves any watches which have been buffered by :meth:`.Watch.add`.
+
+    """
+    saved = Watch.objects.flush_buffer()
+    logging.debug('flush_watch_buffer() saved %i watches', saved)
+
+
+@task(ignore_result=True)
+def update_popularity(batch_size=1000):
+    """
+    Reindexes the videos whose watch count has changed since it was last
+    indexed, including videos whose count has decayed to 0. Returns a
+    dictionary with the number of documents ``sent`` for reindexing and the
+    number of watched videos ``skipped`` because their count was unchanged.
+
+    If popularity is measured by viewers, the viewer sketches of the last
+    two days are first recalculated to take in watches saved since the last
+    run.
+
+    """
+    if POPULARITY_METRIC == 'viewers':
+        DailyWatchCount.objects.refresh_viewers(
+                        datetime.date.today() - datetime.timedelta(1))
+    counts = DailyWatchCount.objects.get_popularity_counts(
+                                                 video__status=Video.ACTIVE)
+    indexed = dict(IndexedWatchCount.objects.values_list('video', 'count'))
+
+    changed = [pk for pk, count in counts.iteritems()
+               if indexed.get(pk) != count]
+    decayed = [pk for pk in indexed if pk not in counts]
+    pks = changed + decayed
+
+    for start in xrange(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        IndexedWatchCount.objects.filter(video__in=batch).delete()
+        IndexedWatchCount.objects.bulk_create([
+            IndexedWatchCount(video_id=pk, count=counts[pk])
+            for pk in batch if pk in counts])
+
+    if pks:
+        opts = Video._meta
+        haystack_batch_update.delay(opts.app_label, opts.module_name, pks=pks)
+
+    stats = {'sent': len(pks), 'skipped': len(counts) - len(changed)}
+    logging.info('update_popularity(): %(sent)i documents sent, %(skipped)i '
+                 'skipped', stats)
+    return stats
+
+
+
+@task(ignore_result=True)
+def purge_watches(retention_days=WATCH_RETENTION_DAYS,
+                  history_days=WATCH_HISTORY_RETENTION_DAYS,
+                  chunk_size=PURGE_CHUNK_SIZE, pause=PURGE_CHUNK_PAUSE):
+    """
+    Deletes raw watches older than ``retention_days`` and daily rollup rows
+    older than ``history_days``, ``chunk_size`` rows at a time. Watches are
+    counted into the rollup as they are saved, so only the raw rows are lost.
+    ``None`` means "keep forever". Returns a dictionary with the number of
+    ``watches`` and ``days`` deleted.
+
+    """
+    for days in (retention_days, history_days):
+        if days is not None and days < POPULARITY_DAYS:
+            raise ImproperlyConfigured("Watch retention must be at least "
+                                       "%i days." % POPULARITY_DAYS)
+    today = datetime.date.today()
+    stats = {'watches': 0, 'days': 0}
+    if retention_days is not None:
+        cutoff = datetime.datetime.combine(
+                    today - datetime.timedelta(retention_days - 1),
+                    datetime.time())
+        stats['watches'] = delete_in_chunks(
+                    Watch.objects.filter(timestamp__lt=cutoff),
+                    chunk_size, pause)
+    if history_days is not None:
+        cutoff = today - datetime.timedelta(history_days - 1)
+        stats['days'] = delete_in_chunks(
+                    DailyWatchCount.objects.filter(day__lt=cutoff),
+                    chunk_size, pause)
+    logging.info('purge_watches(): %(watches)i watches and %(days)i daily '
+                 'counts deleted', stats)
+    return stats
+
+
+def _delete_video_chunk(pks):
+    """
+    Deletes the videos with the given ``pks``, removing their comments and
+    search index entries in bulk rather than through per-video signals.
+
+    """
+    from django.contrib.comments import get_model as get_comment_model
+    videos = list(Video.objects.filter(pk__in=pks))
+    get_comment_model()._default_manager.filter(
+        content_type=ContentType.objects.get_for_model(Video),
+        object_pk__in=[unicode(pk) for pk in pks]).delete()
+    for video in videos:
+        video._comments_deleted = True
+        video._update_index = False
+    collector = Collector(using=router.db_for_write(Video))
+    collector.collect(videos)
+    collector.delete()
+    if USE_HAYSTACK:
+        opts = Video._meta
+        haystack_remove.delay(opts.app_label, opts.module_name, pks)
+
+
+def delete_videos(queryset, chunk_size=PURGE_CHUNK_SIZE,
+                  pause=PURGE_CHUNK_PAUSE):
+    """
+    Deletes the videos in ``queryset`` ``chunk_size`` at a time, logging the
+    progress after each chunk. Returns the number of videos deleted.
+
+    """
+    total = queryset.count()
+
+    def progress(deleted):
+        logging.info('delete_videos(): deleted %i of %i videos', deleted,
+                     total)
+
+    return delete_in_chunks(queryset, chunk_size, pause,
+                            delete=_delete_video_chunk, progress=progress)
+
+
+@task(ignore_result=True)
+def delete_import_videos(import_app_label, import_model, import_pk):
+    """
+    Deletes the videos brought in by a failed import.
+
+    """
+    import_class = get_model(import_app_label, import_model)
+    try:
+        source_import = import_class._default_manager.get(pk=import_pk)
+    except import_class.DoesNotExist:
+        logging.warn('Expected %s instance (pk=%r) missing.',
+                     import_class.__name__, import_pk)
+        return
+    delete_videos(source_import.get_videos())
+
+
+@task(ignore_result=True)
+def delete_source(source_app_label, source_model, source_pk):
+    """
+    Deletes a feed or saved search, deleting its videos in chunks first so
+    that the source itself has little left to cascade to.
+
+    """
+    source_class = get_model(source_app_label, source_model)
+    try:
+        source = source_class._default_manager.get(pk=source_pk)
+    except source_class.DoesNotExist:
+        logging.warn('Expected %s instance (pk=%r) missing.',
+                     source_class.__name__, source_pk)
+        return
+    delete_videos(source.video_set.all())
+    source.delete()
 
 def _haystack_database_retry(task, callback):
     """
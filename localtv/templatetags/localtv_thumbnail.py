@@ -34,18 +34,26 @@ class ThumbnailNode(template.Node):
             })
         else:
             storage_path = None
+            info_dict = None
 
             if video.has_thumbnail:
                 storage_path = video.thumbnail_path
+                if hasattr(video, 'get_thumbnail_adjustment'):
+                    # Made when the thumbnail was saved.
+                    info_dict = video.get_thumbnail_adjustment(self.width,
+                                                               self.height)
             elif video.feed_id and video.feed.has_thumbnail:
                 storage_path = video.feed.thumbnail_path
             elif video.search_id and video.search.has_thumbnail:
                 storage_path = video.search.thumbnail_path
 
-            helper = AdjustmentHelper([storage_path],
-                                      [Fill(width=self.width,
-                                            height=self.height)])
-            info_dict = helper.info_dicts()[0][1]
+            if info_dict is not None:
+                info_dict = AdjustmentInfoDict(info_dict)
+            else:
+                helper = AdjustmentHelper([storage_path],
+                                          [Fill(width=self.width,
+                                                height=self.height)])
+                info_dict = helper.info_dicts()[0][1]
 
             # localtv_thumbnail has always fallen back in the code.
             if not info_dict:
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.sites.models import Site
 from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
 from django.core.management import call_command
 from django.db import transaction
 from django.http import QueryDict
@@ -21,8 +22,9 @@ from tagging.models import Tag
 import vidscraper
 
 import localtv
+from localtv import utils
 from localtv.models import (Video, SiteSettings, Watch, Category, Feed,
-                            SavedSearch)
+                            SavedSearch, clear_author_cache)
 from localtv.middleware import UserIsAdminMiddleware
 from localtv.playlists.models import Playlist
 
@@ -105,6 +107,9 @@ class BaseTestCase(TestCase):
         super(BaseTestCase, self).setUp()
         self.factory = FakeRequestFactory()
         SiteSettings.objects.clear_cache()
+        utils.clear_tag_cache()
+        clear_author_cache()
+        cache.clear()
 
     @classmethod
     def create_video(cls, name='Test.', status=Video.ACTIVE, site_id=1,
@@ -201,10 +206,8 @@ class BaseTestCase(TestCase):
         :param days: Number of days to place the :class:`Watch` in the past.
 
         """
-        watch = Watch.objects.create(video=video, ip_address=ip_address)
-        watch.timestamp = datetime.now() - timedelta(days)
-        watch.save()
-        return watch
+        return Watch.objects.create(video=video, ip_address=ip_address,
+                                    timestamp=datetime.now() - timedelta(days))
 
     @classmethod
     def create_feed(cls, feed_url, name=None, description='Lorem ipsum',
@@ -19,8 +19,8 @@ class AdminFeedImportIntegrationTestCase(BaseTestCase):
         patcher = patch.object(GenericFeed, 'get_page', lambda *args, **kwargs: feed)
         patcher.start()
         self.addCleanup(patcher.stop)
-        patcher = patch.object(tasks, 'video_save_thumbnail')
-        self.save_thumbnail = patcher.start()
+        patcher = patch.object(tasks, 'videos_save_thumbnails')
+        self.save_thumbnails = patcher.start()
         self.addCleanup(patcher.stop)
         self.create_user(username='admin', password='admin', is_superuser=True)
         self.client.login(username='admin', password='admin')
@@ -54,7 +54,8 @@ class AdminFeedImportIntegrationTestCase(BaseTestCase):
         self.assertEqual(feed_import.total_videos, 6)
         self.assertEqual(feed_import.videos_imported, 2)
         self.assertEqual(feed_import.videos_skipped, 4)
-        self.assertEqual(self.save_thumbnail.delay.call_count, 2)
+        self.assertEqual(self.save_thumbnails.delay.call_count, 1)
+        self.assertEqual(len(self.save_thumbnails.delay.call_args[0][0]), 2)
 
         self.assertEqual(
             feed.video_set.filter(status=Video.UNAPPROVED).count(), 2)
@@ -83,7 +84,8 @@ class AdminFeedImportIntegrationTestCase(BaseTestCase):
         self.assertEqual(feed_import.total_videos, 6)
         self.assertEqual(feed_import.videos_imported, 2)
         self.assertEqual(feed_import.videos_skipped, 4)
-        self.assertEqual(self.save_thumbnail.delay.call_count, 2)
+        self.assertEqual(self.save_thumbnails.delay.call_count, 1)
+        self.assertEqual(len(self.save_thumbnails.delay.call_args[0][0]), 2)
 
         self.assertEqual(
             feed.video_set.filter(status=Video.ACTIVE).count(), 2)
@@ -31,7 +31,8 @@ import localtv
 import localtv.templatetags.filters
 from localtv.middleware import UserIsAdminMiddleware
 from localtv import models
-from localtv.models import Watch, Category, SiteSettings, Video, Feed
+from localtv.models import (Watch, Category, SiteSettings, Video, Feed,
+                            DailyWatchCount)
 from localtv import utils
 import localtv.feeds.views
 from localtv.search.utils import NormalizedVideoList
@@ -256,6 +257,7 @@ class ViewTestCase(BaseTestCase):
         the base categories (those without parents).
         """
         Watch.objects.update(timestamp=datetime.datetime.now())
+        DailyWatchCount.objects.rebuild()
         # Rebuild index to work around https://bitbucket.org/mchaput/whoosh/issue/237
         #haystack_batch_update.apply(args=(Video._meta.app_label,
         #                                  Video._meta.module_name))
@@ -331,6 +333,7 @@ class ViewTestCase(BaseTestCase):
             watched.timestamp = datetime.datetime.now() # so that they're
                                                         # recent
             watched.save()
+        DailyWatchCount.objects.rebuild()
         self._rebuild_index()
 
         video = Video.objects.get(pk=20)
@@ -754,6 +757,7 @@ class ListingViewTestCase(BaseTestCase):
         all the videos, sorted by popularity.
         """
         Watch.objects.update(timestamp=datetime.datetime.now())
+        DailyWatchCount.objects.rebuild()
         haystack_batch_update.apply(args=(Video._meta.app_label,
                                           Video._meta.module_name))
 
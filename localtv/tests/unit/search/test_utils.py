@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
+from django.db.models.query import QuerySet
 from haystack.query import SearchQuerySet
 
 from localtv.models import Video, SiteSettings, Category, Watch
@@ -188,6 +189,19 @@ class PopularSortUnitTestCase(BaseTestCase):
         results = [r.object for r in self.sort.sort(SearchQuerySet())]
         self.assertEqual(results, expected)
 
+    def test_sort__queryset(self):
+        """
+        Sorting a QuerySet should return a single lazy QuerySet which can be
+        counted and sliced, and which includes unwatched videos.
+
+        """
+        results = self.sort.sort(Video.objects.all())
+        self.assertIsInstance(results, QuerySet)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(list(results[:2]), [self.video3, self.video2])
+        self.assertEqual(list(results[4:]), [self.video0])
+        self.assertEqual([v.watch_count for v in results], [4, 3, 2, 1, 0])
+
 
 class ModelFilterFieldUnitTestCase(BaseTestCase):
     def setUp(self):
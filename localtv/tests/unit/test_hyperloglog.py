@@ -0,0 +1,47 @@
+from django.utils.unittest import TestCase
+
+from localtv.hyperloglog import HyperLogLog
+
+
+class HyperLogLogTestCase(TestCase):
+    def assertAbout(self, estimate, expected, error=0.1):
+        self.assertTrue(abs(estimate - expected) <= expected * error,
+                        '%i is not within %i%% of %i' % (estimate, error * 100,
+                                                         expected))
+
+    def test_empty(self):
+        self.assertEqual(len(HyperLogLog()), 0)
+
+    def test_duplicates(self):
+        """Adding the same value repeatedly should only count it once."""
+        sketch = HyperLogLog()
+        self.assertTrue(sketch.add('ip:127.0.0.1'))
+        for i in xrange(100):
+            self.assertFalse(sketch.add('ip:127.0.0.1'))
+        self.assertEqual(len(sketch), 1)
+
+    def test_estimate(self):
+        sketch = HyperLogLog()
+        for i in xrange(10000):
+            sketch.add('user:%i' % i)
+        self.assertAbout(len(sketch), 10000)
+
+    def test_merge(self):
+        """Merging sketches should count values in both only once."""
+        sketch1 = HyperLogLog()
+        sketch2 = HyperLogLog()
+        for i in xrange(3000):
+            sketch1.add(str(i))
+        for i in xrange(2000, 5000):
+            sketch2.add(str(i))
+        sketch1.merge(sketch2)
+        self.assertAbout(len(sketch1), 5000)
+
+    def test_serialize(self):
+        sketch = HyperLogLog()
+        for i in xrange(500):
+            sketch.add(str(i))
+        data = sketch.serialize()
+        self.assertEqual(HyperLogLog.deserialize(data).registers,
+                         sketch.registers)
+        self.assertEqual(len(HyperLogLog.deserialize('')), 0)
@@ -1,15 +1,25 @@
 import datetime
+import time
 
 from celery.signals import task_postrun
+from django.conf import settings
+from django.contrib.auth.models import User
+import feedparser
 from haystack.query import SearchQuerySet
 import mock
+from tagging.models import Tag
 import vidscraper
+from vidscraper.suites.generic import Feed as GenericFeed
 from vidscraper.suites.youtube import Suite as YouTubeSuite
 from vidscraper.videos import (Video as VidscraperVideo,
                                VideoFile as VidscraperVideoFile)
 
-from localtv.models import Source, Feed, FeedImport, Video, FeedImportIndex
-from localtv.tasks import haystack_update, haystack_remove, video_save_thumbnail
+from localtv.models import (Source, Feed, FeedImport, Video, FeedImportIndex,
+                            _get_vidscraper_authors)
+from localtv import tasks, utils
+from localtv.tasks import (haystack_update, haystack_remove,
+                           videos_save_thumbnails,
+                           videos_from_vidscraper_videos, mark_import_pending)
 from localtv.tests import BaseTestCase
 
 
@@ -48,6 +58,81 @@ class SourceImportUnitTestCase(BaseTestCase):
         self.assertEqual(feed_import.errors.count(), 1)
 
 
+    def test_mark_pending_if_done(self):
+        """
+        An import should move to its second stage exactly once, as soon as
+        all its videos have been imported or skipped.
+
+        """
+        feed = self.create_feed('http://google.com/')
+        feed_import = FeedImport.objects.create(source=feed, total_videos=3,
+                                                videos_imported=1,
+                                                videos_skipped=1)
+        with mock.patch.object(mark_import_pending, 'delay') as delay:
+            self.assertFalse(feed_import.mark_pending_if_done())
+            FeedImport.objects.filter(pk=feed_import.pk).update(
+                                                           videos_skipped=2)
+            self.assertTrue(feed_import.mark_pending_if_done())
+            self.assertFalse(feed_import.mark_pending_if_done())
+        delay.assert_called_once_with(import_app_label='localtv',
+                                      import_model='feedimport',
+                                      import_pk=feed_import.pk)
+        self.assertEqual(FeedImport.objects.get(pk=feed_import.pk).status,
+                         FeedImport.PENDING)
+
+    def test_progress_counters(self):
+        """
+        Progress should be spread over counter shards while the import runs,
+        and folded into the import when it moves to its second stage.
+
+        """
+        feed = self.create_feed('http://google.com/')
+        feed_import = FeedImport.objects.create(source=feed)
+        with mock.patch('localtv.settings.IMPORT_COUNTER_SHARDS', 2):
+            feed_import.add_progress(imported=3)
+            feed_import.add_progress(imported=1, skipped=1)
+            feed_import.handle_error('Skipped', is_skip=True)
+        self.assertTrue(1 <= feed_import.counters.count() <= 2)
+        self.assertEqual(feed_import.get_progress(),
+                         {'imported': 4, 'skipped': 2})
+
+        FeedImport.objects.filter(pk=feed_import.pk).update(total_videos=6)
+        with mock.patch.object(mark_import_pending, 'delay'):
+            self.assertTrue(feed_import.mark_pending_if_done())
+        feed_import = FeedImport.objects.get(pk=feed_import.pk)
+        self.assertEqual((feed_import.videos_imported,
+                          feed_import.videos_skipped), (4, 2))
+        self.assertFalse(feed_import.counters.exists())
+        self.assertEqual(feed_import.get_progress(),
+                         {'imported': 4, 'skipped': 2})
+
+    def test_progress_counters__late_increment(self):
+        """
+        Progress added after the counters are read for folding should stay in
+        the counters rather than being lost.
+
+        """
+        feed = self.create_feed('http://google.com/')
+        feed_import = FeedImport.objects.create(source=feed, total_videos=1)
+        read_counters = feed_import._read_counters
+
+        def read_then_increment():
+            result = read_counters()
+            feed_import.add_progress(skipped=1)
+            return result
+
+        with mock.patch('localtv.settings.IMPORT_COUNTER_SHARDS', 1):
+            feed_import.add_progress(imported=1)
+            with mock.patch.object(feed_import, '_read_counters',
+                                   side_effect=read_then_increment):
+                with mock.patch.object(mark_import_pending, 'delay'):
+                    self.assertTrue(feed_import.mark_pending_if_done())
+        feed_import = FeedImport.objects.get(pk=feed_import.pk)
+        self.assertEqual((feed_import.videos_imported,
+                          feed_import.videos_skipped), (1, 0))
+        self.assertEqual(feed_import.get_progress(),
+                         {'imported': 1, 'skipped': 1})
+
 class FeedImportUnitTestCase(BaseTestCase):
     def create_vidscraper_video(self, url='http://youtube.com/watch/?v=fake',
                                 loaded=True, embed_code='hi', title='Test',
@@ -60,6 +145,16 @@ class FeedImportUnitTestCase(BaseTestCase):
 
         return video
 
+    def _update_offline(self, feed, video_iter, feed_import):
+        """
+        Runs :meth:`Source.update` without loading the videos from the
+        network again once they reach the import tasks.
+
+        """
+        with mock.patch.object(VidscraperVideo, 'load'):
+            with mock.patch('localtv.tasks.host_slot'):
+                Source.update(feed, video_iter, feed_import)
+
     def test_update_approved_feed(self):
         feed = self.create_feed('http://google.com', status=Feed.INACTIVE)
         feed_import = FeedImport.objects.create(source=feed)
@@ -86,6 +181,8 @@ class FeedImportUnitTestCase(BaseTestCase):
         self.assertEqual(Video.objects.count(), 2)
         self.assertEqual(Video.objects.filter(
                 status=Video.ACTIVE).count(), 2)
+        self.assertEqual(FeedImport.objects.get(pk=feed_import.pk).status,
+                         FeedImport.COMPLETE)
 
     def test_auto_approve_False(self):
         """
@@ -296,6 +393,155 @@ Original Link: <a href="http://example.com/link">http://example.com/link</a>
         self.assertEqual(v.website_url, video_iter[0].link)
         self.assertEqual(v.file_url, video_iter[0].files[0].url)
 
+    def test_batches(self):
+        """
+        Entries should be handed to import tasks in batches of
+        LOCALTV_IMPORT_BATCH_SIZE.
+
+        """
+        feed = self.create_feed('http://google.com')
+        feed_import = FeedImport.objects.create(source=feed)
+        video_iter = [
+            self.create_vidscraper_video(guid='1'),
+            self.create_vidscraper_video(guid='2'),
+            self.create_vidscraper_video(guid='3'),
+        ]
+        with mock.patch('localtv.settings.IMPORT_BATCH_SIZE', 2):
+            with mock.patch.object(videos_from_vidscraper_videos,
+                                   'delay') as delay:
+                Source.update(feed, video_iter, feed_import)
+        self.assertEqual([len(call[0][0]) for call in delay.call_args_list],
+                         [2, 1])
+        feed_import = FeedImport.objects.get(pk=feed_import.pk)
+        self.assertEqual(feed_import.total_videos, 3)
+
+    def test_batch_fallback(self):
+        """
+        If saving a batch fails, its videos should be imported one by one.
+
+        """
+        feed = self.create_feed('http://google.com')
+        feed_import = FeedImport.objects.create(source=feed)
+        video_iter = [
+            self.create_vidscraper_video(guid='1', tags=['tag1']),
+            self.create_vidscraper_video(guid='2'),
+        ]
+        with mock.patch.object(Video, 'bulk_save_from_vidscraper',
+                               side_effect=Exception):
+            self._update_offline(feed, video_iter, feed_import)
+        feed_import = FeedImport.objects.get(pk=feed_import.pk)
+        self.assertEqual(feed_import.videos_imported, 2)
+        self.assertEqual(feed_import.videos_skipped, 0)
+        self.assertEqual(Video.objects.get(guid='1').tags.get().name, 'tag1')
+
+    def test_batch_tags(self):
+        """
+        Tags for a batch should be normalized, created in bulk where missing,
+        and cached for later imports.
+
+        """
+        Tag.objects.create(name='tag1')
+        feed = self.create_feed('http://google.com')
+        feed_import = FeedImport.objects.create(source=feed)
+        video_iter = [
+            self.create_vidscraper_video(guid='1', tags=['Tag1', ' tag2 ']),
+            self.create_vidscraper_video(guid='2', tags=['TAG2', 'tag3']),
+        ]
+        with mock.patch.object(settings, 'FORCE_LOWERCASE_TAGS', True):
+            self._update_offline(feed, video_iter, feed_import)
+        self.assertEqual(sorted(Tag.objects.values_list('name', flat=True)),
+                         ['tag1', 'tag2', 'tag3'])
+        self.assertEqual(
+            sorted(tag.name for tag in Video.objects.get(guid='1').tags.all()),
+            ['tag1', 'tag2'])
+        self.assertEqual(
+            sorted(tag.name for tag in Video.objects.get(guid='2').tags.all()),
+            ['tag2', 'tag3'])
+        with self.assertNumQueries(0):
+            utils.get_tags(['tag1'])
+
+    def test_batch_authors(self):
+        """
+        Users for a batch's service authors should be created in bulk with
+        profiles, and existing users reused and cached.
+
+        """
+        existing = self.create_user(username='existing')
+        feed = self.create_feed('http://google.com')
+        feed_import = FeedImport.objects.create(source=feed)
+        video_iter = [
+            self.create_vidscraper_video(guid='1', user='New Author',
+                                         user_url='http://example.com/new'),
+            self.create_vidscraper_video(guid='2', user='New Author'),
+            self.create_vidscraper_video(guid='3', user='existing'),
+        ]
+        self._update_offline(feed, video_iter, feed_import)
+        author = User.objects.get(username='New Author')
+        self.assertEqual((author.first_name, author.last_name),
+                         ('New', 'Author'))
+        self.assertFalse(author.has_usable_password())
+        self.assertEqual(author.get_profile().website,
+                         'http://example.com/new')
+        self.assertEqual(list(Video.objects.get(guid='2').authors.all()),
+                         [author])
+        self.assertEqual(list(Video.objects.get(guid='3').authors.all()),
+                         [existing])
+
+        video = self.create_vidscraper_video(user='existing')
+        with self.assertNumQueries(0):
+            authors = _get_vidscraper_authors([video])
+        self.assertEqual(authors, {'existing': existing})
+
+        # Renaming the user should drop it from the cache.
+        existing.username = 'renamed'
+        existing.save()
+        authors = _get_vidscraper_authors([video])
+        self.assertNotEqual(authors['existing'].pk, existing.pk)
+
+    def test_checkpoints(self):
+        """
+        The import's position in the source should be saved every
+        LOCALTV_IMPORT_CHECKPOINT_SIZE videos.
+
+        """
+        feed = self.create_feed('http://google.com')
+        feed_import = FeedImport.objects.create(source=feed)
+        video_iter = [self.create_vidscraper_video(guid=str(i))
+                      for i in range(5)]
+        cursors = []
+
+        def delay(*args, **kwargs):
+            cursors.append(FeedImport.objects.get(pk=feed_import.pk).cursor)
+
+        with mock.patch('localtv.settings.IMPORT_BATCH_SIZE', 1):
+            with mock.patch('localtv.settings.IMPORT_CHECKPOINT_SIZE', 2):
+                with mock.patch.object(videos_from_vidscraper_videos,
+                                       'delay', delay):
+                    Source.update(feed, video_iter, feed_import)
+        self.assertEqual(cursors, [0, 0, 2, 2, 4])
+        feed_import = FeedImport.objects.get(pk=feed_import.pk)
+        self.assertEqual((feed_import.cursor, feed_import.total_videos),
+                         (5, 5))
+
+    def test_wait_for_capacity(self):
+        """
+        Queueing should wait while too many videos are outstanding.
+
+        """
+        feed = self.create_feed('http://google.com')
+        feed_import = FeedImport.objects.create(source=feed)
+        feed_import.add_progress(imported=2)
+
+        def sleep(seconds):
+            feed_import.add_progress(imported=2)
+
+        with mock.patch('localtv.settings.IMPORT_MAX_OUTSTANDING', 1):
+            with mock.patch('time.sleep', side_effect=sleep) as mock_sleep:
+                feed_import.wait_for_capacity(3)
+                self.assertFalse(mock_sleep.called)
+                feed_import.wait_for_capacity(5)
+                self.assertEqual(mock_sleep.call_count, 1)
+
     def test_index_updates(self):
         """Test that index updates are only run at the end of an update."""
         self.updates = 0
@@ -319,10 +565,149 @@ Original Link: <a href="http://example.com/link">http://example.com/link</a>
             self.create_vidscraper_video(),
         ]
         Source.update(feed, video_iter, feed_import)
-        self.assertEqual(self.updates, 1)
+        # The import's videos are indexed in the process which completes it,
+        # rather than by haystack_update tasks.
+        self.assertEqual(self.updates, 0)
         self.assertEqual(self.removals, 0)
         self.assertEqual(SearchQuerySet().count(), len(video_iter))
 
+    def test_index_error(self):
+        """
+        If indexing an import's videos fails, the import should be left
+        pending and mark_import_pending retried.
+
+        """
+        feed = self.create_feed('http://google.com')
+        feed_import = FeedImport.objects.create(source=feed,
+                                                status=FeedImport.PENDING)
+        video = self.create_video(update_index=False)
+        FeedImportIndex.objects.create(source_import=feed_import,
+                                       video=video)
+
+        class MockException(Exception):
+            pass
+
+        with mock.patch('localtv.tasks.connections') as connections:
+            backend = connections.__getitem__.return_value.get_backend()
+            backend.update.side_effect = ValueError
+            with mock.patch.object(mark_import_pending, 'retry',
+                                   side_effect=MockException) as retry:
+                self.assertRaises(MockException, mark_import_pending.apply,
+                                  args=('localtv', 'feedimport',
+                                        feed_import.pk))
+        self.assertTrue(backend.update.called)
+        self.assertTrue(isinstance(retry.call_args[1]['exc'], ValueError))
+        feed_import = FeedImport.objects.get(pk=feed_import.pk)
+        self.assertEqual(feed_import.status, FeedImport.PENDING)
+
+
+
+class FeedUpdateTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        with self._data_file('feeds/qa1.rss') as f:
+            self.response = feedparser.parse(f.read())
+        patcher = mock.patch.object(GenericFeed, 'get_page',
+                                    lambda *args, **kwargs: self.response)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks, 'video_save_thumbnail')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks, 'videos_save_thumbnails')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged_content(self):
+        """
+        If an active feed's videos haven't changed since the last update, no
+        import should be started and the skip should be counted.
+
+        """
+        feed = self.create_feed('http://google.com/')
+        feed.update()
+        self.assertEqual(feed.imports.count(), 1)
+        feed = Feed.objects.get(pk=feed.pk)
+        self.assertTrue(feed.content_hash)
+
+        feed.update()
+        self.assertEqual(feed.imports.count(), 1)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).skipped_updates, 1)
+
+        feed.update(clear_rejected=True)
+        self.assertEqual(feed.imports.count(), 2)
+
+    def test_not_modified(self):
+        """
+        The stored etag should be sent with the request, and a 304 response
+        should skip the import.
+
+        """
+        feed = self.create_feed('http://google.com/', etag='"etag"')
+        response = feedparser.FeedParserDict(status=304, entries=[],
+                                             feed=feedparser.FeedParserDict())
+        etags = []
+
+        def get_page(video_iter, *args, **kwargs):
+            etags.append(video_iter.get_request_kwargs()['etag'])
+            return response
+
+        with mock.patch.object(GenericFeed, 'get_page', get_page):
+            feed.update()
+        self.assertEqual(etags, ['"etag"'])
+        self.assertEqual(feed.imports.count(), 0)
+        feed = Feed.objects.get(pk=feed.pk)
+        self.assertEqual(feed.skipped_updates, 1)
+        self.assertEqual(feed.etag, '"etag"')
+
+    def test_resume(self):
+        """
+        An import which was interrupted while queueing videos should be
+        resumed from its last checkpoint; one which is still running should
+        be left alone.
+
+        """
+        feed = self.create_feed('http://google.com/', status=Feed.INACTIVE)
+        feed_import = FeedImport.objects.create(source=feed, cursor=50)
+        with mock.patch.object(vidscraper, 'auto_feed') as auto_feed:
+            feed.update()
+        self.assertFalse(auto_feed.called)
+
+        FeedImport.objects.filter(pk=feed_import.pk).update(
+                start=datetime.datetime.now() - datetime.timedelta(days=1))
+        with mock.patch.object(vidscraper, 'auto_feed') as auto_feed:
+            with mock.patch.object(Source, 'update') as update:
+                feed.update()
+        self.assertEqual(auto_feed.call_args[1]['start_index'], 51)
+        self.assertEqual(auto_feed.call_args[1]['max_results'], None)
+        update.assert_called_once_with(auto_feed.return_value,
+                                       source_import=feed_import, start=50)
+
+    def test_resume__unpaged(self):
+        """
+        Feeds which can't start part of the way through, such as those of
+        the generic suite, should be read from the start when they're
+        resumed, skipping the videos which were already queued.
+
+        """
+        feed = self.create_feed('http://google.com/', status=Feed.INACTIVE)
+        feed_import = FeedImport.objects.create(source=feed, cursor=2)
+        FeedImport.objects.filter(pk=feed_import.pk).update(
+                start=datetime.datetime.now() - datetime.timedelta(days=1))
+        resumed = []
+
+        def update(source, video_iter, **kwargs):
+            resumed.extend(video_iter)
+
+        with mock.patch.object(Source, 'update', update):
+            feed.update()
+        feed_import = FeedImport.objects.get(pk=feed_import.pk)
+        self.assertNotEqual(feed_import.status, FeedImport.FAILED)
+        video_iter = vidscraper.auto_feed('http://google.com/')
+        video_iter.load()
+        self.assertEqual([video.link for video in resumed],
+                         [video.link for video in video_iter][2:])
+
 
 class SavedSearch(BaseTestCase):
     def _search(self, query, *args, **kwargs):
@@ -345,12 +730,12 @@ class SavedSearch(BaseTestCase):
         self.assertEqual(search.video_set.count(), 0)
         with mock.patch.object(VidscraperVideo, 'load', self._load):
             with mock.patch.object(vidscraper, 'auto_search', self._search):
-                with mock.patch.object(video_save_thumbnail, 'delay'):
+                with mock.patch.object(videos_save_thumbnails, 'delay'):
                     search.update()
         self.assertEqual(search.video_set.count(), 5)
         with mock.patch.object(VidscraperVideo, 'load', self._load):
             with mock.patch.object(vidscraper, 'auto_search', self._search):
-                with mock.patch.object(video_save_thumbnail, 'delay'):
+                with mock.patch.object(videos_save_thumbnails, 'delay'):
                     search.update()
         self.assertEqual(search.video_set.count(), 5)
 
@@ -364,7 +749,7 @@ class SavedSearch(BaseTestCase):
         search.auto_authors = [user]
         with mock.patch.object(VidscraperVideo, 'load', self._load):
             with mock.patch.object(vidscraper, 'auto_search', self._search):
-                with mock.patch.object(video_save_thumbnail, 'delay'):
+                with mock.patch.object(videos_save_thumbnails, 'delay'):
                     search.update()
         self.assertTrue(user in list(search.video_set.all()[0].authors.all()))
 
@@ -377,6 +762,34 @@ class SavedSearch(BaseTestCase):
         self.assertFalse(search.auto_authors.all().exists())
         with mock.patch.object(VidscraperVideo, 'load', self._load):
             with mock.patch.object(vidscraper, 'auto_search', self._search):
-                with mock.patch.object(video_save_thumbnail, 'delay'):
+                with mock.patch.object(videos_save_thumbnails, 'delay'):
                     search.update()
         self.assertTrue(search.video_set.all()[0].authors.all().exists())
+
+    def test_update_slow_backends(self):
+        """
+        Backends which fail or don't load before the deadline should be
+        skipped, and the results of the others imported.
+
+        """
+        search = self.create_search('blah rocket')
+
+        def slow_load():
+            time.sleep(1)
+        slow = mock.Mock(load=slow_load)
+        broken = mock.Mock(load=mock.Mock(side_effect=KeyError))
+
+        def auto_search(query, *args, **kwargs):
+            return self._search(query) + [slow, broken]
+
+        with mock.patch('localtv.settings.SEARCH_LOAD_DEADLINE', 0.2):
+            with mock.patch.object(VidscraperVideo, 'load', self._load):
+                with mock.patch.object(vidscraper, 'auto_search', auto_search):
+                    with mock.patch.object(videos_save_thumbnails, 'delay'):
+                        search.update()
+        self.assertEqual(search.video_set.count(), 5)
+        search_import = search.imports.get()
+        self.assertEqual(search_import.errors.count(), 2)
+        self.assertTrue(search_import.errors.filter(
+                            message__endswith='not loaded within 0.2s'
+                        ).exists())
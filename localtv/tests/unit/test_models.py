@@ -1,10 +1,19 @@
 from __future__ import with_statement
 
+from datetime import date, datetime, timedelta
+
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.core.files.base import File
 from django.core.urlresolvers import reverse
+from django.http import HttpRequest
+from django.utils import simplejson
+import mock
 
-from localtv.models import SiteSettings, SiteRelatedManager, WidgetSettings
+from localtv.models import (SiteSettings, SiteRelatedManager, WidgetSettings,
+                            Watch, DailyWatchCount, Video, VideoIdentifier,
+                            Feed)
 from localtv.tests import BaseTestCase
 
 
@@ -140,3 +149,383 @@ class VideoTestCase(BaseTestCase):
         url = reverse('localtv_view_video',
                       kwargs={'video_id': video.pk, 'slug': slug})
         self.assertEqual(video.get_absolute_url(), url)
+
+    def test_identifiers(self):
+        """
+        A video's identifiers should follow changes to its guid and urls.
+
+        """
+        video = self.create_video(guid='guid', update_index=False,
+                                  website_url='http://example.com/video')
+        self.assertEqual(set(video.identifiers.values_list('kind', flat=True)),
+                         set((VideoIdentifier.GUID,
+                              VideoIdentifier.WEBSITE_URL)))
+        video.guid = ''
+        video.file_url = 'http://example.com/video.ogv'
+        video.save(update_index=False)
+        self.assertEqual(set(video.identifiers.values_list('kind', 'hash')),
+                         set(video.get_identifiers()))
+        self.assertEqual(video.identifiers.count(), 2)
+
+    def test_check_for_duplicates(self):
+        """
+        Duplicates should be found through normalized identifiers, ignoring
+        the url fragment and the case of the host.
+
+        """
+        self.create_video(website_url='http://example.com/video',
+                          update_index=False)
+        video = Video(site_id=1, embed_code='<embed>',
+                      website_url='  http://EXAMPLE.com/video#t=10')
+        self.assertRaises(ValidationError, video._check_for_duplicates)
+        video.website_url = 'http://example.com/VIDEO'
+        video._check_for_duplicates()
+
+    def test_find_duplicates__batch(self):
+        """
+        Videos in a batch should be checked against each other as well as
+        against existing videos, in a single query.
+
+        """
+        self.create_video(guid='existing', update_index=False)
+        videos = [Video(site_id=1, embed_code='<embed>', guid=guid)
+                  for guid in ('existing', 'new', 'new', 'other')]
+        with self.assertNumQueries(1):
+            errors = Video._find_duplicates(videos)
+        self.assertEqual([error is not None for error in errors],
+                         [True, False, True, False])
+
+    def test_clear_rejected_duplicates(self):
+        """
+        Only rejected videos on the same site with a matching identifier
+        should be deleted.
+
+        """
+        rejected = self.create_video(status=Video.REJECTED, guid='guid',
+                                     update_index=False)
+        active = self.create_video(guid='guid', update_index=False)
+        other = self.create_video(status=Video.REJECTED, guid='other',
+                                  update_index=False)
+        video = Video(site_id=1, guid='guid')
+        video.clear_rejected_duplicates()
+        self.assertEqual(set(Video.objects.values_list('pk', flat=True)),
+                         set((active.pk, other.pk)))
+        self.assertFalse(VideoIdentifier.objects.filter(
+                                                video=rejected.pk).exists())
+
+    def test_get_thumbnail_adjustment(self):
+        """
+        Recorded adjustments should only be returned for the thumbnail they
+        were made from.
+
+        """
+        info_dict = {'width': 88, 'height': 68, 'url': '/media/small.png'}
+        video = Video(site_id=1, thumbnail='localtv/video/thumbnail/a.png',
+                      thumbnail_adjustments=simplejson.dumps({
+                          'thumbnail': 'localtv/video/thumbnail/a.png',
+                          'sizes': {'88x68': info_dict}}))
+        self.assertEqual(video.get_thumbnail_adjustment(88, 68), info_dict)
+        self.assertTrue(video.get_thumbnail_adjustment(140, 110) is None)
+        video.thumbnail = 'localtv/video/thumbnail/b.png'
+        self.assertTrue(video.get_thumbnail_adjustment(88, 68) is None)
+        video.thumbnail_adjustments = 'not json'
+        self.assertTrue(video.get_thumbnail_adjustment(88, 68) is None)
+
+
+class WatchManagerTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        cache.clear()
+        self.video = self.create_video(update_index=False)
+
+    def test_add__buffered(self):
+        """
+        If watch buffering is enabled, Watch.add should buffer the watch
+        instead of saving it.
+
+        """
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '123.123.123.123'
+        with mock.patch('localtv.models.lsettings.WATCH_BUFFER_ENABLED',
+                        True):
+            with mock.patch.object(Watch.objects, 'buffer_is_shared',
+                                   return_value=True):
+                Watch.add(request, self.video)
+        self.assertEqual(Watch.objects.count(), 0)
+
+        self.assertEqual(Watch.objects.flush_buffer(), 1)
+        watch = Watch.objects.get()
+        self.assertEqual(watch.video, self.video)
+        self.assertEqual(watch.ip_address, '123.123.123.123')
+        self.assertTrue(watch.user is None)
+
+    def test_add__buffered_robot(self):
+        """
+        Robots should be ignored even if watch buffering is enabled.
+
+        """
+        request = HttpRequest()
+        request.META['HTTP_USER_AGENT'] = 'Mozilla/5.0 Googlebot'
+        with mock.patch('localtv.models.lsettings.WATCH_BUFFER_ENABLED',
+                        True):
+            with mock.patch.object(Watch.objects, 'buffer_is_shared',
+                                   return_value=True):
+                Watch.add(request, self.video)
+        self.assertEqual(Watch.objects.flush_buffer(), 0)
+        self.assertEqual(Watch.objects.count(), 0)
+
+    def test_add__unshared_cache(self):
+        """
+        If the cache is local to the process, Watch.add should save watches
+        directly even if buffering is enabled.
+
+        """
+        request = HttpRequest()
+        with mock.patch('localtv.models.lsettings.WATCH_BUFFER_ENABLED',
+                        True):
+            # The test project uses the locmem cache.
+            self.assertFalse(Watch.objects.buffer_is_shared())
+            Watch.add(request, self.video)
+        self.assertEqual(Watch.objects.count(), 1)
+        self.assertEqual(Watch.objects.flush_buffer(), 0)
+
+    def test_flush_buffer__batches(self):
+        """
+        Buffered watches should be saved in batches, keeping their original
+        timestamps.
+
+        """
+        timestamp = datetime.now() - timedelta(1)
+        for i in xrange(5):
+            Watch.objects.buffer(self.video, timestamp=timestamp)
+        with mock.patch.object(Watch.objects, 'bulk_create',
+                               wraps=Watch.objects.bulk_create) as bulk_create:
+            self.assertEqual(Watch.objects.flush_buffer(batch_size=2), 5)
+        self.assertEqual(bulk_create.call_count, 3)
+        self.assertEqual(Watch.objects.filter(timestamp=timestamp).count(), 5)
+
+        # Flushed watches shouldn't be saved twice.
+        self.assertEqual(Watch.objects.flush_buffer(), 0)
+        self.assertEqual(Watch.objects.count(), 5)
+
+    def test_flush_buffer__locked(self):
+        """
+        Only one flush should run at a time.
+
+        """
+        Watch.objects.buffer(self.video)
+        cache.add('localtv_watch_buffer:lock', True)
+        self.assertEqual(Watch.objects.flush_buffer(), 0)
+        cache.delete('localtv_watch_buffer:lock')
+        self.assertEqual(Watch.objects.flush_buffer(), 1)
+
+    def test_flush_buffer__lock_timeout(self):
+        """
+        The flush lock should expire after LOCALTV_WATCH_BUFFER_LOCK_TIMEOUT,
+        not after the much longer buffer timeout.
+
+        """
+        with mock.patch('localtv.managers.lsettings.WATCH_BUFFER_LOCK_TIMEOUT',
+                        300):
+            with mock.patch('localtv.managers.cache') as mocked:
+                mocked.add.return_value = False
+                self.assertEqual(Watch.objects.flush_buffer(), 0)
+        mocked.add.assert_called_once_with('localtv_watch_buffer:lock', True,
+                                           300)
+
+
+class DailyWatchCountTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        cache.clear()
+        self.video = self.create_video(update_index=False)
+
+    def test_watch_saved(self):
+        """
+        Saving a new watch should increment the rollup for its day.
+
+        """
+        self.create_watch(self.video)
+        self.create_watch(self.video)
+        self.create_watch(self.video, days=3)
+        today = date.today()
+        self.assertEqual(DailyWatchCount.objects.get(video=self.video,
+                                                     day=today).count, 2)
+        self.assertEqual(DailyWatchCount.objects.get(
+                     video=self.video, day=today - timedelta(3)).count, 1)
+
+    def test_flush_buffer(self):
+        """
+        Flushed watches should be added to the rollup.
+
+        """
+        for i in xrange(3):
+            Watch.objects.buffer(self.video)
+        Watch.objects.flush_buffer()
+        self.assertEqual(DailyWatchCount.objects.get(video=self.video,
+                                                     day=date.today()).count,
+                         3)
+
+    def test_get_watch_count(self):
+        """
+        Only watches within the popularity window should be counted.
+
+        """
+        for days in (0, 1, 6, 7, 10):
+            self.create_watch(self.video, days=days)
+        self.assertEqual(DailyWatchCount.objects.get_watch_count(self.video),
+                         3)
+
+    def test_viewers(self):
+        """
+        Saving a watch should only update the day's count; refreshing should
+        bring in its unique viewers. Popularity by viewers should be the sum
+        of each day's unique viewers, both for the index and for querysets.
+
+        """
+        for i in xrange(3):
+            self.create_watch(self.video, ip_address='1.1.1.1')
+        self.create_watch(self.video, ip_address='2.2.2.2')
+        self.create_watch(self.video, ip_address='1.1.1.1', days=1)
+        today = DailyWatchCount.objects.get(video=self.video, day=date.today())
+        self.assertEqual(today.count, 4)
+        self.assertEqual(today.viewer_count, 0)
+
+        self.assertEqual(DailyWatchCount.objects.refresh_viewers(
+                                        date.today() - timedelta(1)), 2)
+        today = DailyWatchCount.objects.get(video=self.video, day=date.today())
+        self.assertEqual(today.viewer_count, 2)
+        # Nothing changed since the last refresh.
+        self.assertEqual(DailyWatchCount.objects.refresh_viewers(
+                                        date.today() - timedelta(1)), 0)
+        self.assertEqual(DailyWatchCount.objects.get_viewer_count(self.video),
+                         2)
+        with mock.patch('localtv.managers.lsettings.POPULARITY_METRIC',
+                        'viewers'):
+            counts = DailyWatchCount.objects.get_popularity_counts()
+            video = Video.objects.with_watch_count().get(pk=self.video.pk)
+        self.assertEqual(counts, {self.video.pk: 3})
+        self.assertEqual(video.watch_count, 3)
+
+    def test_rebuild(self):
+        """
+        Rebuilding should recalculate the rollup from the watch table.
+
+        """
+        watch = self.create_watch(self.video, days=2)
+        Watch.objects.filter(pk=watch.pk).update(timestamp=datetime.now())
+        DailyWatchCount.objects.rebuild()
+        self.assertEqual(list(DailyWatchCount.objects.values_list('day',
+                                                                  'count')),
+                         [(date.today(), 1)])
+
+    def test_rebuild__chunks(self):
+        """
+        Rebuilding in chunks of videos should give the same rollup, and drop
+        rows for videos which no longer have watches.
+
+        """
+        other = self.create_video(update_index=False)
+        unwatched = self.create_video(update_index=False)
+        for i in xrange(2):
+            self.create_watch(self.video, ip_address='1.1.1.%i' % i)
+        self.create_watch(other)
+        DailyWatchCount.objects.create(video=unwatched, day=date.today(),
+                                       count=5)
+        DailyWatchCount.objects.filter(video=self.video).update(count=10)
+        DailyWatchCount.objects.rebuild(chunk_size=1)
+        self.assertEqual(dict(DailyWatchCount.objects.values_list(
+                                                'video', 'count')),
+                         {self.video.pk: 2, other.pk: 1})
+        self.assertEqual(DailyWatchCount.objects.get(video=self.video
+                                                     ).viewer_count, 2)
+
+
+class SourcePollTestCase(BaseTestCase):
+    def test_reschedule_poll(self):
+        """
+        Sources with new videos should be polled more often, and quiet ones
+        less often, within the configured bounds.
+
+        """
+        feed = self.create_feed('http://google.com/', poll_interval=3600)
+        feed.reschedule_poll(changed=True)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).poll_interval, 1800)
+        feed.reschedule_poll(changed=True)
+        feed.reschedule_poll(changed=True)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).poll_interval, 900)
+
+        feed.reschedule_poll(changed=False)
+        feed = Feed.objects.get(pk=feed.pk)
+        self.assertEqual(feed.poll_interval, 1800)
+        self.assertTrue(datetime.now() + timedelta(minutes=25) <
+                        feed.next_poll_at <
+                        datetime.now() + timedelta(minutes=35))
+
+        with mock.patch('localtv.settings.POLL_MAX_INTERVAL', 2000):
+            feed.reschedule_poll(changed=False)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).poll_interval, 2000)
+
+
+class FeedSourceTypeTestCase(BaseTestCase):
+    def test_rename(self):
+        """
+        Renaming a feed should update its videos' source type with a single
+        query and queue one reindex for all of them, leaving videos which
+        came from a saved search alone.
+
+        """
+        feed = self.create_feed('http://google.com/', name='Old')
+        videos = [self.create_video(feed=feed, update_index=False)
+                  for i in range(2)]
+        search = self.create_search('rocket')
+        searched = self.create_video(feed=feed, search=search,
+                                     update_index=False)
+        # The source is only taken into account once the video has an id.
+        for video in videos + [searched]:
+            video.save(update_index=False)
+        self.assertEqual(Video.objects.get(pk=videos[0].pk
+                                           ).calculated_source_type,
+                         u'Feed: Old')
+
+        feed.name = 'New'
+        with mock.patch('localtv.tasks.haystack_batch_update.delay') as delay:
+            feed.save()
+        self.assertEqual(
+            set(Video.objects.filter(pk__in=[v.pk for v in videos]
+                         ).values_list('calculated_source_type', flat=True)),
+            set([u'Feed: New']))
+        self.assertEqual(Video.objects.get(pk=searched.pk
+                                           ).calculated_source_type,
+                         u'Search: rocket')
+        self.assertEqual(delay.call_count, 1)
+        self.assertEqual(delay.call_args[0], ('localtv', 'video'))
+        self.assertEqual(sorted(delay.call_args[1]['pks']),
+                         [v.pk for v in videos])
+
+    def test_video_save(self):
+        """
+        A video's source type should only be recalculated when the fields it
+        depends on change, and sources should be looked up once.
+
+        """
+        feed = self.create_feed('http://google.com/', name='Feed')
+        video = self.create_video(feed=feed, update_index=False)
+        video.save(update_index=False)
+        self.assertEqual(video.calculated_source_type, u'Feed: Feed')
+
+        video = Video.objects.get(pk=video.pk)
+        with mock.patch('localtv.models._get_video_source_type') as get:
+            video.name = 'Renamed'
+            video.save(update_index=False)
+        self.assertFalse(get.called)
+
+        other = self.create_video(feed=feed, update_index=False)
+        with self.assertNumQueries(0):
+            self.assertEqual(other.source_type(), u'Feed: Feed')
+
+        video.search = self.create_search('rocket')
+        video.save(update_index=False)
+        self.assertEqual(Video.objects.get(pk=video.pk
+                                           ).calculated_source_type,
+                         u'Search: rocket')
@@ -0,0 +1,52 @@
+from django.core.cache import cache
+import mock
+
+from localtv.outbound import fetch, get_host_limits, host_slot
+from localtv.tests import BaseTestCase
+
+
+class OutboundTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        cache.clear()
+
+    def test_get_host_limits(self):
+        """
+        Per-domain limits should apply to subdomains, and fall back to the
+        defaults for other hosts.
+
+        """
+        limits = {'youtube.com': {'concurrency': 2},
+                  'gdata.youtube.com': {'rate': 1}}
+        with mock.patch('localtv.settings.HTTP_HOST_LIMITS', limits):
+            self.assertEqual(get_host_limits('www.youtube.com'), (2, 5))
+            self.assertEqual(get_host_limits('gdata.youtube.com'), (4, 1))
+            self.assertEqual(get_host_limits('notyoutube.com'), (4, 5))
+
+    def test_host_slot(self):
+        """
+        Requests beyond a host's concurrency limit should wait for a slot,
+        and slots should be released afterwards.
+
+        """
+        key = 'localtv_http_active:example.com'
+        with mock.patch('localtv.settings.HTTP_HOST_CONCURRENCY', 1):
+            with mock.patch('localtv.settings.HTTP_HOST_WAIT', 0):
+                with host_slot('http://EXAMPLE.com/feed'):
+                    self.assertEqual(cache.get(key), 1)
+                    with host_slot('http://example.com/other'):
+                        # Gave up waiting without taking a slot.
+                        self.assertEqual(cache.get(key), 1)
+                    with host_slot('http://example.org/'):
+                        self.assertEqual(cache.get(key), 1)
+        self.assertEqual(cache.get(key), 0)
+
+    def test_fetch(self):
+        """
+        fetch() should use the shared session.
+
+        """
+        with mock.patch('localtv.outbound.get_session') as get_session:
+            fetch('http://example.com/', method='HEAD', timeout=5)
+        get_session.return_value.request.assert_called_once_with(
+                                'HEAD', 'http://example.com/', timeout=5)
@@ -0,0 +1,57 @@
+import mock
+
+from localtv import sanitizer
+from localtv.sanitizer import sanitize_description
+from localtv.tests import BaseTestCase
+
+
+class SanitizeDescriptionTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        sanitizer.clear_cache()
+
+    def test_plain_text(self):
+        """
+        Plain-text descriptions should have their links and line breaks
+        converted to HTML.
+
+        """
+        self.assertEqual(sanitize_description(u'See http://example.com/\nok'),
+                         u'See <a href="http://example.com/" rel="nofollow">'
+                         u'http://example.com/</a><br/>ok')
+
+    def test_whitelist(self):
+        """
+        Disallowed tags should be unwrapped (or dropped, for scripts),
+        disallowed attributes removed, and javascript links defused.
+
+        """
+        self.assertEqual(sanitize_description(
+            u'<div>a<script>alert(1)</script>b <!-- c -->'
+            u'<a href="javascript:x()" onclick="y()">link</a> '
+            u'<img src="/i.png"/><b class="x">bold</b></div>'),
+            u'ab <a href=":x()">link</a> <b>bold</b>')
+
+    def test_miro_community_description(self):
+        """
+        Only the contents of a miro-community-description div should be
+        kept.
+
+        """
+        self.assertEqual(sanitize_description(
+            u'<div class="miro-community-description">Original <i>Desc'
+            u'</i></div>\n<p>Original Link: <a href="http://example.com/">'
+            u'http://example.com/</a></p>'),
+            u'Original <i>Desc</i>')
+
+    def test_cache(self):
+        """
+        Repeated descriptions should be served from the cache.
+
+        """
+        description = u'<p>Hello</p>'
+        self.assertEqual(sanitize_description(description), u'<p>Hello</p>')
+        with mock.patch.object(sanitizer, '_sanitize') as _sanitize:
+            self.assertEqual(sanitize_description(description),
+                             u'<p>Hello</p>')
+        self.assertFalse(_sanitize.called)
@@ -1,16 +1,24 @@
 from datetime import datetime, timedelta
 
 from celery.signals import task_postrun
+from django.contrib.comments import get_model as get_comment_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.db import connections
 from django.test.utils import override_settings
 from haystack.query import SearchQuerySet
 import mock
 from vidscraper.videos import Video as VidscraperVideo
 
-from localtv.models import Video
+from localtv.models import (Video, IndexedWatchCount, Watch,
+                            DailyWatchCount, Feed, CommandCheckpoint)
 from localtv.tasks import (haystack_update, haystack_remove,
                            haystack_batch_update, video_from_vidscraper_video,
-                           video_save_thumbnail)
+                           video_save_thumbnail, update_popularity,
+                           purge_watches, update_sources, feed_update,
+                           delete_videos, delete_source,
+                           videos_save_thumbnails, scrape_publish_dates,
+                           videos_adjust_thumbnails, _update_publish_dates)
 from localtv.tests import BaseTestCase
 
 
@@ -257,7 +265,193 @@ class HaystackBatchUpdateUnitTestCase(BaseTestCase):
                                           [video1.pk], remove=True)
 
 
+class UpdatePopularityTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.video1 = self.create_video(name='Video1', update_index=False,
+                                        watches=2)
+        self.video2 = self.create_video(name='Video2', update_index=False,
+                                        watches=1)
+        self.video3 = self.create_video(name='Video3', update_index=False)
+
+    def _update(self):
+        with mock.patch.object(haystack_batch_update, 'delay') as delay:
+            stats = update_popularity.apply().get()
+        if delay.called:
+            pks = set(delay.call_args[1]['pks'])
+        else:
+            pks = set()
+        return stats, pks
+
+    def test_changed_only(self):
+        """
+        Only videos whose watch count has changed since they were last indexed
+        should be reindexed.
+
+        """
+        stats, pks = self._update()
+        self.assertEqual(pks, set((self.video1.pk, self.video2.pk)))
+        self.assertEqual(stats, {'sent': 2, 'skipped': 0})
+        self.assertEqual(IndexedWatchCount.objects.get(video=self.video1).count,
+                         2)
+
+        stats, pks = self._update()
+        self.assertEqual(pks, set())
+        self.assertEqual(stats, {'sent': 0, 'skipped': 2})
+
+        self.create_watch(self.video2)
+        stats, pks = self._update()
+        self.assertEqual(pks, set((self.video2.pk,)))
+        self.assertEqual(stats, {'sent': 1, 'skipped': 1})
+
+    def test_decayed(self):
+        """
+        Videos whose count has dropped to zero should be reindexed once.
+
+        """
+        self._update()
+        self.video2.dailywatchcount_set.all().delete()
+        stats, pks = self._update()
+        self.assertEqual(pks, set((self.video2.pk,)))
+        self.assertFalse(IndexedWatchCount.objects.filter(
+                                                video=self.video2).exists())
+
+        stats, pks = self._update()
+        self.assertEqual(pks, set())
+
+
+class PurgeWatchesTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.video = self.create_video(update_index=False)
+        self.old = self.create_watch(self.video, days=40)
+        self.new = self.create_watch(self.video)
+
+    def test_purge(self):
+        """
+        Watches older than the retention window should be deleted, in chunks,
+        without touching the daily counts.
+
+        """
+        self.create_watch(self.video, days=35)
+        stats = purge_watches.apply(kwargs={'retention_days': 30,
+                                            'history_days': None,
+                                            'chunk_size': 1}).get()
+        self.assertEqual(stats, {'watches': 2, 'days': 0})
+        self.assertEqual(list(Watch.objects.values_list('pk', flat=True)),
+                         [self.new.pk])
+        self.assertEqual(DailyWatchCount.objects.get_watch_count(
+                              self.video, datetime.now().date() -
+                                          timedelta(60)), 3)
+
+    def test_purge_history(self):
+        """
+        Daily counts older than the history window should be deleted.
+
+        """
+        stats = purge_watches.apply(kwargs={'retention_days': None,
+                                            'history_days': 30}).get()
+        self.assertEqual(stats, {'watches': 0, 'days': 1})
+        self.assertEqual(Watch.objects.count(), 2)
+        self.assertEqual(list(DailyWatchCount.objects.values_list('day',
+                                                                  flat=True)),
+                         [self.new.timestamp.date()])
+
+    def test_too_short(self):
+        """
+        Retention windows shorter than the popularity window are an error.
+
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            purge_watches.apply(kwargs={'retention_days': 1}).get()
+        self.assertEqual(Watch.objects.count(), 2)
+
+
+class DeleteVideosTestCase(BaseTestCase):
+    def test_delete_videos(self):
+        """
+        Videos should be deleted in chunks, with their comments and index
+        entries removed once per chunk.
+
+        """
+        feed = self.create_feed('http://google.com/')
+        videos = [self.create_video(feed=feed, update_index=False)
+                  for i in range(3)]
+        other = self.create_video(update_index=False)
+        for video in videos + [other]:
+            get_comment_model().objects.create(content_object=video,
+                                               site_id=1, comment='Hi')
+        with mock.patch.object(haystack_remove, 'delay') as delay:
+            deleted = delete_videos(Video.objects.filter(feed=feed),
+                                    chunk_size=2)
+        self.assertEqual(deleted, 3)
+        self.assertEqual(list(Video.objects.all()), [other])
+        self.assertEqual(get_comment_model().objects.get().object_pk,
+                         unicode(other.pk))
+        self.assertEqual([call[0][2] for call in delay.call_args_list],
+                         [[videos[0].pk, videos[1].pk], [videos[2].pk]])
+
+    def test_delete_source(self):
+        """
+        delete_source() should remove the source's videos, then the source.
+
+        """
+        feed = self.create_feed('http://google.com/')
+        self.create_video(feed=feed, update_index=False)
+        delete_source.apply(args=('localtv', 'feed', feed.pk))
+        self.assertFalse(Feed.objects.exists())
+        self.assertFalse(Video.objects.exists())
+
+
+class UpdateSourcesTestCase(BaseTestCase):
+    def _update(self):
+        with mock.patch.object(feed_update, 'delay') as delay:
+            update_sources.apply()
+        return [call[0][0] for call in delay.call_args_list]
+
+    def test_unscheduled(self):
+        """
+        Sources which have never been scheduled should be given a start time
+        within the minimum interval rather than being updated right away.
+
+        """
+        feed = self.create_feed('http://google.com/')
+        self.assertEqual(self._update(), [])
+        next_poll_at = Feed.objects.get(pk=feed.pk).next_poll_at
+        self.assertTrue(datetime.now() <= next_poll_at <=
+                        datetime.now() + timedelta(minutes=15))
+
+    def test_due(self):
+        """
+        Only sources which are due should be updated, and their next poll
+        should be pushed back by their interval.
+
+        """
+        due = self.create_feed('http://google.com/', poll_interval=3600,
+                               next_poll_at=datetime.now() - timedelta(1))
+        self.create_feed('http://google.com/2',
+                         next_poll_at=datetime.now() + timedelta(1))
+        self.assertEqual(self._update(), [due.pk])
+        due = Feed.objects.get(pk=due.pk)
+        self.assertTrue(datetime.now() + timedelta(minutes=50) <
+                        due.next_poll_at <
+                        datetime.now() + timedelta(minutes=70))
+        self.assertEqual(self._update(), [])
+
+def _thumbnail_response(headers=None):
+    thumbnail_data = BaseTestCase._data_file('logo.png').read()
+    return mock.Mock(status_code=200, headers=headers or {},
+                     iter_content=lambda size: iter([thumbnail_data]))
+
+
 class VideoSaveThumbnailTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        # Don't write adjusted thumbnails into the media directory.
+        patcher = mock.patch('localtv.tasks.videos_adjust_thumbnails')
+        self.adjust_thumbnails = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_thumbnail_not_200(self):
         """
         If a video's thumbnail url returns a non-200 status code, the task
@@ -271,13 +465,16 @@ class VideoSaveThumbnailTestCase(BaseTestCase):
         class MockException(Exception):
             pass
 
-        with mock.patch('localtv.tasks.urllib.urlopen') as urlopen:
+        response = mock.Mock(status_code=404)
+        with mock.patch('localtv.tasks.fetch',
+                        return_value=response) as fetch:
             with mock.patch.object(video_save_thumbnail, 'retry',
                                    side_effect=MockException):
                 self.assertRaises(MockException,
                                   video_save_thumbnail.apply,
                                   args=(video.pk,))
-                urlopen.assert_called_once_with(thumbnail_url)
+                fetch.assert_called_once_with(thumbnail_url, prefetch=False,
+                                              timeout=30)
         new_video = Video.objects.get(pk=video.pk)
         self.assertEqual(new_video.thumbnail_url, video.thumbnail_url)
 
@@ -290,13 +487,10 @@ class VideoSaveThumbnailTestCase(BaseTestCase):
         thumbnail_url = 'http://pculture.org/path/to/logo.png'
         video = self.create_video(update_index=False,
                                   thumbnail_url=thumbnail_url)
-        thumbnail_data = self._data_file('logo.png').read()
-        remote_file = mock.Mock(read=lambda: thumbnail_data,
-                                getcode=lambda: 200)
+        response = _thumbnail_response()
 
         self.assertTrue(video.thumbnail._file is None)
-        with mock.patch('localtv.tasks.urllib.urlopen',
-                        return_value=remote_file):
+        with mock.patch('localtv.tasks.fetch', return_value=response):
             video_save_thumbnail.apply(args=(video.pk,))
         self.assertFalse(video.thumbnail is None)
         self.assertTrue(video.thumbnail._committed)
@@ -304,3 +498,313 @@ class VideoSaveThumbnailTestCase(BaseTestCase):
         self.assertTrue(new_video.thumbnail)
         self.assertTrue(new_video.thumbnail._committed)
         self.assertEqual(new_video.thumbnail_url, thumbnail_url)
+        self.adjust_thumbnails.delay.assert_called_once_with([video.pk])
+
+    def test_too_large(self):
+        """
+        Thumbnails larger than THUMBNAIL_MAX_BYTES should be given up on and
+        their urls erased, whether or not the server says how large they
+        are.
+
+        """
+        video = self.create_video(update_index=False,
+                                  thumbnail_url='http://pculture.org/big.png')
+        for headers in ({'content-length': '2000'}, {}):
+            Video.objects.filter(pk=video.pk).update(
+                            thumbnail_url='http://pculture.org/big.png')
+            response = _thumbnail_response(headers)
+            with mock.patch('localtv.tasks.fetch', return_value=response):
+                with mock.patch('localtv.tasks.THUMBNAIL_MAX_BYTES', 1000):
+                    video_save_thumbnail.apply(args=(video.pk,))
+            new_video = Video.objects.get(pk=video.pk)
+            self.assertEqual(new_video.thumbnail_url, '')
+            self.assertFalse(new_video.thumbnail)
+
+    def test_shared_content(self):
+        """
+        Identical images should be stored once, under a name derived from
+        their content, and shared by every video which uses them.
+
+        """
+        video1 = self.create_video(update_index=False,
+                                   thumbnail_url='http://pculture.org/1.png')
+        video2 = self.create_video(update_index=False,
+                                   thumbnail_url='http://pculture.org/2.png')
+        with mock.patch('localtv.tasks.fetch',
+                        side_effect=lambda *a, **k: _thumbnail_response()):
+            video_save_thumbnail.apply(args=(video1.pk,))
+            video_save_thumbnail.apply(args=(video2.pk,))
+        video1 = Video.objects.get(pk=video1.pk)
+        video2 = Video.objects.get(pk=video2.pk)
+        self.assertTrue(video1.thumbnail.name.startswith(
+                                            'localtv/video/thumbnail/'))
+        self.assertEqual(video1.thumbnail.name, video2.thumbnail.name)
+
+
+class VideosSaveThumbnailsTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        # Don't write adjusted thumbnails into the media directory.
+        patcher = mock.patch('localtv.tasks.videos_adjust_thumbnails')
+        self.adjust_thumbnails = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch(self):
+        """
+        Each distinct thumbnail url should be downloaded once. Videos with
+        unusable thumbnails should have their urls erased, and videos whose
+        downloads failed temporarily should be retried together.
+
+        """
+        shared = [self.create_video(update_index=False,
+                                    thumbnail_url='http://pculture.org/1.png')
+                  for i in range(3)]
+        invalid = self.create_video(update_index=False,
+                                    thumbnail_url='pculture.org/2.png')
+        down = self.create_video(update_index=False,
+                                 thumbnail_url='http://pculture.org/3.png')
+        none = self.create_video(update_index=False)
+
+        def fetch(url, **kwargs):
+            if url.endswith('1.png'):
+                return _thumbnail_response()
+            if url.endswith('2.png'):
+                from requests.exceptions import MissingSchema
+                raise MissingSchema(url)
+            return mock.Mock(status_code=503)
+
+        class MockException(Exception):
+            pass
+
+        pks = [video.pk for video in shared + [invalid, down, none]]
+        with mock.patch('localtv.tasks.fetch', side_effect=fetch) as mocked:
+            with mock.patch.object(videos_save_thumbnails, 'retry',
+                                   side_effect=MockException) as retry:
+                self.assertRaises(MockException,
+                                  videos_save_thumbnails.apply, args=(pks,))
+        self.assertEqual(mocked.call_count, 3)
+        retry.assert_called_once_with(args=([down.pk],))
+
+        names = set(Video.objects.filter(pk__in=[video.pk
+                                                 for video in shared]
+                            ).values_list('thumbnail', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names.pop())
+        self.assertEqual(Video.objects.get(pk=invalid.pk).thumbnail_url, '')
+        down = Video.objects.get(pk=down.pk)
+        self.assertEqual(down.thumbnail_url, 'http://pculture.org/3.png')
+        self.assertFalse(down.thumbnail)
+
+
+class UpdateThumbnailsTestCase(BaseTestCase):
+    def test_missing(self):
+        """
+        update_thumbnails should refetch only the thumbnails which are missing
+        from the storage listing, in batches, starting after --after.
+
+        """
+        skipped = self.create_video(update_index=False,
+                                    thumbnail_url='http://pculture.org/1.png')
+        missing = self.create_video(update_index=False,
+                                    thumbnail_url='http://pculture.org/2.png',
+                                    thumbnail='localtv/video/thumbnail/a.png')
+        stored = self.create_video(update_index=False,
+                                   thumbnail_url='http://pculture.org/3.png',
+                                   thumbnail='localtv/video/thumbnail/b.png')
+        empty = self.create_video(update_index=False,
+                                  thumbnail_url='http://pculture.org/4.png')
+        self.create_video(update_index=False)
+
+        stats = {'saved': 1, 'erased': 0, 'failed': []}
+        command = 'localtv.management.commands.update_thumbnails'
+        with mock.patch(command + '.site_too_old', return_value=False):
+            with mock.patch(command + '.list_storage',
+                    return_value=set(['localtv/video/thumbnail/b.png'])):
+                with mock.patch(command + '.save_thumbnails',
+                                return_value=stats) as save_thumbnails:
+                    call_command('update_thumbnails', after=skipped.pk,
+                                 batch_size=2, threads=2, verbosity=0)
+        self.assertEqual(save_thumbnails.call_args_list,
+                         [((([missing.pk],), {'threads': 2})),
+                          ((([empty.pk],), {'threads': 2}))])
+
+    def test_legacy_path(self):
+        """
+        Thumbnails stored outside THUMBNAIL_DIRECTORY by older versions
+        should be checked in storage directly rather than in the listing.
+
+        """
+        missing = self.create_video(update_index=False,
+                                    thumbnail_url='http://pculture.org/1.png')
+        stored = self.create_video(update_index=False,
+                                   thumbnail_url='http://pculture.org/2.png')
+        for video in (missing, stored):
+            Video.objects.filter(pk=video.pk).update(
+                thumbnail='localtv/video_thumbs/%i/orig.png' % video.pk)
+        stored_name = 'localtv/video_thumbs/%i/orig.png' % stored.pk
+
+        stats = {'saved': 1, 'erased': 0, 'failed': []}
+        command = 'localtv.management.commands.update_thumbnails'
+        with mock.patch(command + '.site_too_old', return_value=False):
+            with mock.patch(command + '.list_storage', return_value=set()):
+                with mock.patch(command + '.default_storage') as storage:
+                    storage.exists.side_effect = lambda name: (
+                        name == stored_name)
+                    with mock.patch(command + '.save_thumbnails',
+                                    return_value=stats) as save_thumbnails:
+                        call_command('update_thumbnails', verbosity=0)
+        self.assertEqual(storage.exists.call_count, 2)
+        save_thumbnails.assert_called_once_with([missing.pk],
+                                                threads=mock.ANY)
+
+
+class ScrapePublishDatesTestCase(BaseTestCase):
+    def test_scrape(self):
+        """
+        Publish dates should be scraped for the videos which handle them and
+        written without saving the videos. Videos without a suite, without a
+        date, or which fail to load should be counted.
+
+        """
+        from vidscraper.exceptions import UnhandledVideo
+        published = datetime(2012, 1, 1)
+
+        def get_video(url, **kwargs):
+            if 'unhandled' in url:
+                raise UnhandledVideo(url)
+            video = VidscraperVideo(url)
+            video.publish_datetime = (published if 'dated' in url
+                                      else None)
+            load = mock.Mock(side_effect=ValueError if 'fail' in url
+                             else None)
+            video.load = load
+            return video
+
+        suite = mock.Mock(get_video=get_video)
+        videos = [self.create_video(update_index=False,
+                                    website_url='http://pculture.org/%s' % s)
+                  for s in ('dated1', 'dated2', 'none', 'unhandled', 'fail')]
+        already = self.create_video(update_index=False,
+                                    website_url='http://pculture.org/dated3',
+                                    when_published=datetime(2011, 1, 1))
+        pks = [video.pk for video in videos + [already]]
+        with mock.patch('localtv.tasks.vidscraper_registry',
+                        suites=[suite]):
+            with mock.patch.object(Video, 'save') as save:
+                stats = scrape_publish_dates(pks, threads=2, chunk_size=1)
+        self.assertFalse(save.called)
+        self.assertEqual(sorted(stats.pop('updated')),
+                         [videos[0].pk, videos[1].pk])
+        self.assertEqual(stats, {'undated': 1, 'unhandled': 1, 'failed': 1})
+        self.assertEqual(Video.objects.get(pk=videos[0].pk).when_published,
+                         published)
+        self.assertEqual(Video.objects.get(pk=already.pk).when_published,
+                         datetime(2011, 1, 1))
+
+    def test_scrape__one_update_per_chunk(self):
+        """
+        The dates scraped in a chunk should be written with a single update,
+        even if they differ.
+
+        """
+        def get_video(url, **kwargs):
+            video = VidscraperVideo(url)
+            video.publish_datetime = datetime(2012, 1, int(url[-1]))
+            video.load = mock.Mock()
+            return video
+
+        suite = mock.Mock(get_video=get_video)
+        videos = [self.create_video(update_index=False,
+                                    website_url='http://pculture.org/%i' % i)
+                  for i in (1, 2, 3)]
+        with mock.patch('localtv.tasks.vidscraper_registry',
+                        suites=[suite]):
+            with mock.patch('localtv.tasks._update_publish_dates',
+                    wraps=_update_publish_dates) as update:
+                stats = scrape_publish_dates([video.pk for video in videos],
+                                             threads=1, chunk_size=2)
+        self.assertEqual(update.call_count, 2)
+        self.assertEqual(sorted(stats['updated']),
+                         [video.pk for video in videos])
+        for i, video in enumerate(videos):
+            self.assertEqual(Video.objects.get(pk=video.pk).when_published,
+                             datetime(2012, 1, i + 1))
+
+
+class UpdatePublishDateTestCase(BaseTestCase):
+    def test_checkpoint(self):
+        """
+        update_publish_date should save its cursor and counts after each
+        batch, pick up an interrupted run where it stopped, and start from
+        the beginning again once a run has finished.
+
+        """
+        videos = [self.create_video(update_index=False) for i in range(3)]
+        pks = [video.pk for video in videos]
+        scraped = []
+
+        def scrape(batch, **kwargs):
+            if len(scraped) == 1 and interrupt:
+                raise KeyboardInterrupt
+            scraped.append(batch)
+            return {'updated': [], 'undated': len(batch), 'unhandled': 0,
+                    'failed': 0}
+
+        command = 'localtv.management.commands.update_publish_date'
+        with mock.patch(command + '.site_too_old', return_value=False):
+            with mock.patch(command + '.scrape_publish_dates',
+                            side_effect=scrape):
+                interrupt = True
+                self.assertRaises(KeyboardInterrupt, call_command,
+                                  'update_publish_date', batch_size=1,
+                                  verbosity=0)
+                checkpoint = CommandCheckpoint.objects.get(
+                                                command='update_publish_date')
+                self.assertEqual(checkpoint.cursor, pks[0])
+                self.assertEqual(checkpoint.get_stats()['undated'], 1)
+
+                interrupt = False
+                call_command('update_publish_date', batch_size=1,
+                             verbosity=0)
+                checkpoint = CommandCheckpoint.objects.get(pk=checkpoint.pk)
+                self.assertEqual(checkpoint.cursor, None)
+                self.assertEqual(checkpoint.get_stats()['undated'], 3)
+
+                call_command('update_publish_date', batch_size=1,
+                             after=pks[1], verbosity=0)
+        self.assertEqual(scraped, [[pks[0]], [pks[1]], [pks[2]], [pks[2]]])
+
+
+class VideosAdjustThumbnailsTestCase(BaseTestCase):
+    def test_record(self):
+        """
+        Each size should be adjusted in one pass over the videos, and the
+        results recorded for videos with thumbnails.
+
+        """
+        with_thumbnail = self.create_video(update_index=False,
+                                thumbnail='localtv/video/thumbnail/a.png')
+        without = self.create_video(update_index=False)
+
+        sizes = iter(((88, 68), (140, 110)))
+
+        def helper(videos, adjustments, lookup):
+            width, height = sizes.next()
+            info_dicts = [(video, {'width': width, 'height': height,
+                                   'url': '/media/%s.png' % video.pk})
+                          for video in videos]
+            return mock.Mock(info_dicts=mock.Mock(return_value=info_dicts))
+
+        with mock.patch('localtv.tasks.AdjustmentHelper',
+                        side_effect=helper) as AdjustmentHelper:
+            videos_adjust_thumbnails.apply(args=([with_thumbnail.pk,
+                                                  without.pk],),
+                                           kwargs={'sizes': ((88, 68),
+                                                             (140, 110))})
+        self.assertEqual(AdjustmentHelper.call_count, 2)
+        video = Video.objects.get(pk=with_thumbnail.pk)
+        self.assertEqual(video.get_thumbnail_adjustment(140, 110),
+                         {'width': 140, 'height': 110,
+                          'url': '/media/%s.png' % video.pk})
+        self.assertEqual(Video.objects.get(pk=without.pk
+                                           ).thumbnail_adjustments, '')
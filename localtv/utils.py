@@ -7,11 +7,14 @@ import types
 import os
 import os.path
 import logging
+import time
+import urlparse
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files.storage import default_storage
 from django.core.mail import EmailMessage
+from django.db import IntegrityError, transaction
 from django.db.models import get_model, Q
 from django.db.models.query import QuerySet
 from django.utils.encoding import force_unicode, smart_str
@@ -22,23 +25,113 @@ from notification import models as notification
 from localtv.settings import API_KEYS
 
 
+#: The most tags kept in the :func:`get_tags` cache before it's emptied.
+TAG_CACHE_SIZE = 10000
+
+_tag_cache = {}
+
+
+def normalize_tag_name(tag_text):
+    """
+    Returns ``tag_text`` cleaned up for use as a tag name: stripped, cut to
+    the 50 characters a tag can hold, and lowercased if
+    ``FORCE_LOWERCASE_TAGS`` is set.
+
+    """
+    tag_text = tag_text.strip()[:50]
+    if settings.FORCE_LOWERCASE_TAGS:
+        tag_text = tag_text.lower()
+    return tag_text
+
+
+def _match_tags(names, tags):
+    by_name = dict((tag.name, tag) for tag in tags)
+    # MySQL doesn't do case-sensitive equals on strings, so it may return a
+    # tag whose name differs from the one asked for only in case.
+    by_lower = dict((tag.name.lower(), tag) for tag in tags)
+    matched = {}
+    for name in names:
+        tag = by_name.get(name) or by_lower.get(name.lower())
+        if tag is not None:
+            matched[name] = tag
+    return matched
+
+
+def get_tags(names):
+    """
+    Returns a dictionary mapping each of ``names`` to a
+    :class:`tagging.models.Tag`. Tags which don't exist yet are created with
+    a single bulk insert. Tags are cached for the life of the process, so
+    imports of similarly-tagged videos only look up new names. Tags created
+    here aren't cached until they're seen again, in case the surrounding
+    transaction is rolled back.
+
+    """
+    tags = {}
+    missing = set()
+    for name in names:
+        if name in _tag_cache:
+            tags[name] = _tag_cache[name]
+        else:
+            missing.add(name)
+    if not missing:
+        return tags
+
+    manager = tagging.models.Tag._default_manager
+    found = _match_tags(missing, manager.filter(name__in=missing))
+    if len(_tag_cache) + len(found) > TAG_CACHE_SIZE:
+        _tag_cache.clear()
+    _tag_cache.update(found)
+    tags.update(found)
+
+    to_create = missing - set(found)
+    if to_create:
+        sid = transaction.savepoint()
+        try:
+            manager.bulk_create([tagging.models.Tag(name=name)
+                                 for name in to_create])
+        except IntegrityError:
+            # Someone else created some of the tags first.
+            transaction.savepoint_rollback(sid)
+            for name in to_create:
+                get_tag(name)
+        else:
+            transaction.savepoint_commit(sid)
+        # bulk_create doesn't set primary keys, so fetch the new tags.
+        tags.update(_match_tags(to_create,
+                                manager.filter(name__in=to_create)))
+    return tags
+
+
+def forget_tag(tag):
+    """Removes ``tag`` from the :func:`get_tags` cache."""
+    for name, cached in _tag_cache.items():
+        if cached.pk == tag.pk:
+            del _tag_cache[name]
+
+
+def clear_tag_cache():
+    """Empties the :func:`get_tags` cache."""
+    _tag_cache.clear()
+
+
 def get_tag(tag_text):
-    while True:
+    manager = tagging.models.Tag._default_manager
+    for attempt in xrange(3):
+        tag = _match_tags([tag_text],
+                          manager.filter(name=tag_text)).get(tag_text)
+        if tag is not None:
+            return tag
+        sid = transaction.savepoint()
         try:
-            tags = tagging.models.Tag.objects.filter(
-                name=tag_text)
-            if not tags.count():
-                return tagging.models.Tag.objects.create(
-                    name=tag_text)
-            elif tags.count() == 1:
-                return tags[0]
-            else:
-                for tag in tags:
-                    if tag.name == tag:
-                        # MySQL doesn't do case-sensitive equals on strings
-                        return tag
-        except Exception:
-            pass # try again to create the tag
+            tag = manager.create(name=tag_text)
+        except IntegrityError:
+            # Someone else created the tag first; look it up again.
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+            return tag
+    raise tagging.models.Tag.DoesNotExist(tag_text)
 
 
 def edit_string_for_tags(tag_list):
@@ -66,9 +159,8 @@ def get_or_create_tags(tag_list):
             tag_text = tag_text[:50] # tags can only by 50 chars
         if settings.FORCE_LOWERCASE_TAGS:
             tag_text = tag_text.lower()
-        tag = get_tag(tag_text)
-        tag_set.add(tag)
-    return edit_string_for_tags(list(tag_set))
+        tag_set.add(tag_text)
+    return edit_string_for_tags(list(set(get_tags(tag_set).values())))
 
 
 def hash_file_obj(file_obj, hash_constructor=hashlib.sha1, close_it=True):
@@ -401,3 +493,73 @@ class UploadTo(object):
         if len(basename) > max_left:
             basename = hashlib.sha1(unicode(datetime.datetime.now()) + unicode(filename)).hexdigest()[:max_left]
         return os.path.join(dir_name, "".join((basename, ext)))
+
+
+def delete_in_chunks(queryset, chunk_size=1000, pause=0, delete=None,
+                     progress=None):
+    """
+    Deletes the objects in ``queryset`` in chunks of at most ``chunk_size``
+    objects, in primary key order, so that no single statement holds locks
+    for long. Waits ``pause`` seconds between chunks. Returns the number of
+    objects deleted.
+
+    If given, ``delete`` is called with each chunk's list of primary keys to
+    do the deleting, and ``progress`` is called after each chunk with the
+    number of objects deleted so far.
+
+    """
+    manager = queryset.model._default_manager.db_manager(queryset.db)
+    deleted = 0
+    while True:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True
+                                                       )[:chunk_size])
+        if not pks:
+            break
+        if delete is None:
+            manager.filter(pk__in=pks).delete()
+        else:
+            delete(pks)
+        deleted += len(pks)
+        if progress is not None:
+            progress(deleted)
+        if len(pks) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def list_storage(directory, storage=None):
+    """
+    Returns a set of the names of all the files below ``directory`` in
+    ``storage`` (by default, the default storage), listing each directory
+    once. Missing directories are treated as empty.
+
+    """
+    storage = storage or default_storage
+    names = set()
+    pending = [directory.rstrip('/')]
+    while pending:
+        path = pending.pop()
+        try:
+            dirs, files = storage.listdir(path)
+        except OSError:
+            continue
+        names.update(u'%s/%s' % (path, name) for name in files)
+        pending.extend(u'%s/%s' % (path, name) for name in dirs)
+    return names
+
+
+def identifier_hash(value, is_url=False):
+    """
+    Returns a SHA1 hex digest identifying ``value`` for duplicate detection.
+    Surrounding whitespace is ignored; if ``is_url`` is ``True``, so are the
+    URL's fragment and the case of its scheme and host.
+
+    """
+    value = value.strip()
+    if is_url:
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(value)
+        value = urlparse.urlunsplit((scheme.lower(), netloc.lower(), path,
+                                     query, ''))
+    return hashlib.sha1(smart_str(value)).hexdigest()